@@ -0,0 +1,132 @@
+# functions/alert_rules.py
+
+# --- Reglas de alertas configurables (Firestore: config/alertRules) ---
+# Vocabulario por categoría y umbrales de riesgo en un documento de
+# configuración, para ajustarlos sin redesplegar:
+#   {
+#     "version": "2024-10-01",            (si falta, se usa update_time)
+#     "categories": {"exam": {"weight": 3, "keywords": ["examen", ...]}, ...},
+#     "thresholds": {"highInsistence": 0.5, "mediumInsistence": 0.3, "riskAlert": 0.6}
+#   }
+# Las reglas se guardan en memoria para todo el proceso. La primera llamada de
+# la instancia lee el documento; después, pasado ALERT_RULES_TTL_SECONDS, se
+# relee en segundo plano mientras se siguen sirviendo las reglas vigentes. El
+# matcher solo se recompila cuando cambia la versión.
+import os
+import time
+import threading
+import traceback
+
+import keyword_matcher
+
+ALERT_RULES_DOC = os.environ.get('ALERT_RULES_DOC', 'config/alertRules')
+ALERT_RULES_TTL_SECONDS = int(os.environ.get('ALERT_RULES_TTL_SECONDS', '300'))
+
+DEFAULT_VERSION = 'default'
+DEFAULT_THRESHOLDS = {
+    # get_proactive_alerts: insistencia alta / media según el riesgo
+    'highInsistence': 0.5,
+    'mediumInsistence': 0.3,
+    # Job nocturno: riesgo a partir del cual se crea la alerta de riesgo
+    'riskAlert': 0.6,
+}
+
+_lock = threading.Lock()
+_rules = None
+_loaded_at = 0.0
+_refreshing = False
+
+
+class AlertRules:
+    """Reglas vigentes: versión, umbrales y matcher compilado."""
+
+    def __init__(self, version, categories, thresholds):
+        self.version = version
+        self.categories = categories
+        self.thresholds = thresholds
+        self.matcher = keyword_matcher.KeywordMatcher(categories)
+
+    def threshold(self, name):
+        return self.thresholds[name]
+
+
+def default_rules():
+    return AlertRules(DEFAULT_VERSION, keyword_matcher.DEFAULT_KEYWORD_CATEGORIES, dict(DEFAULT_THRESHOLDS))
+
+def parse_categories(raw):
+    if not isinstance(raw, dict) or not raw:
+        raise ValueError("'categories' debe ser un mapa no vacío.")
+    categories = {}
+    for name, spec in raw.items():
+        if not isinstance(spec, dict) or not isinstance(spec.get('keywords'), list):
+            raise ValueError(f"Categoría '{name}' sin lista 'keywords'.")
+        categories[name] = {
+            'weight': float(spec.get('weight', 1.0)),
+            'keywords': [str(keyword) for keyword in spec['keywords'] if str(keyword).strip()],
+        }
+    return categories
+
+def parse_thresholds(raw):
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for name, value in (raw or {}).items():
+        if name not in DEFAULT_THRESHOLDS:
+            continue
+        value = float(value)
+        if not 0.0 <= value <= 1.0:
+            raise ValueError(f"Umbral '{name}' fuera de [0, 1]: {value}")
+        thresholds[name] = value
+    return thresholds
+
+def config_version(snapshot, data):
+    if data.get('version') is not None:
+        return str(data['version'])
+    update_time = getattr(snapshot, 'update_time', None)
+    return str(update_time) if update_time is not None else DEFAULT_VERSION
+
+def load_rules(db):
+    """
+    Lee el documento de configuración y devuelve las reglas nuevas, o las
+    vigentes si la versión no cambió (sin recompilar el matcher).
+    """
+    snapshot = db.document(ALERT_RULES_DOC).get()
+    if not snapshot.exists:
+        return _rules if _rules is not None and _rules.version == DEFAULT_VERSION else default_rules()
+
+    data = snapshot.to_dict() or {}
+    version = config_version(snapshot, data)
+    if _rules is not None and _rules.version == version:
+        return _rules
+
+    categories = parse_categories(data['categories']) if 'categories' in data \
+        else keyword_matcher.DEFAULT_KEYWORD_CATEGORIES
+    rules = AlertRules(version, categories, parse_thresholds(data.get('thresholds')))
+    print(f"🔁 Reglas de alertas cargadas (versión {version}, {len(rules.matcher)} palabras clave).")
+    return rules
+
+def refresh(db):
+    global _rules, _loaded_at, _refreshing
+    try:
+        rules = load_rules(db)
+    except Exception as e:
+        # Config inválida o Firestore no disponible: se mantienen las reglas vigentes
+        print(f"WARN: No se pudieron cargar las reglas de alertas ({ALERT_RULES_DOC}): {e}")
+        traceback.print_exc(limit=1)
+        rules = _rules or default_rules()
+    with _lock:
+        _rules = rules
+        _loaded_at = time.monotonic()
+        _refreshing = False
+    return rules
+
+def get_rules(db):
+    """Reglas vigentes; nunca bloquea salvo en la primera llamada de la instancia."""
+    global _refreshing
+    if _rules is None:
+        return refresh(db)
+    if ALERT_RULES_TTL_SECONDS > 0 and time.monotonic() - _loaded_at >= ALERT_RULES_TTL_SECONDS:
+        with _lock:
+            start = not _refreshing
+            _refreshing = True
+        if start:
+            threading.Thread(target=refresh, args=(db,), name='alert-rules-refresh', daemon=True).start()
+    return _rules
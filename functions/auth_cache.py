@@ -0,0 +1,150 @@
+# functions/auth_cache.py
+
+# --- Verificación de tokens compartida por las funciones HTTP ---
+# auth.verify_id_token descarga (con caché HTTP) los certificados públicos de
+# Google y verifica la firma RSA en cada llamada. Aquí se guardan los claims
+# ya verificados en un LRU acotado, indexado por el SHA-256 del token (el
+# token nunca se guarda en claro) y válido solo hasta su 'exp'.
+#
+# Los certificados públicos los descarga y cachea el propio verify_id_token.
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from firebase_admin import auth
+
+# --- CONFIGURACIÓN ---
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', '2048'))
+# Margen antes de 'exp' en el que el token ya no se sirve desde la caché
+AUTH_CACHE_EXPIRY_MARGIN_SECONDS = int(os.environ.get('AUTH_CACHE_EXPIRY_MARGIN_SECONDS', '30'))
+# Cada cuántas verificaciones se emite la línea de métricas (0 = nunca)
+AUTH_STATS_LOG_EVERY = int(os.environ.get('AUTH_STATS_LOG_EVERY', '500'))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'failures': 0, 'evictions': 0}
+
+
+class AuthError(Exception):
+    """Token ausente, mal formado, inválido o expirado (siempre 401)."""
+
+
+def token_key(id_token):
+    return hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+
+def extract_bearer_token(req):
+    auth_header = req.headers.get('authorization', '')
+    parts = auth_header.split(None, 1)
+    if len(parts) != 2 or parts[0].lower() != 'bearer' or not parts[1].strip():
+        raise AuthError('Auth token missing or invalid format (Bearer).')
+    return parts[1].strip()
+
+def _count(name):
+    with _cache_lock:
+        _stats[name] += 1
+        total = _stats['hits'] + _stats['misses']
+    if AUTH_STATS_LOG_EVERY and name in ('hits', 'misses') and total % AUTH_STATS_LOG_EVERY == 0:
+        log_auth_stats()
+
+def _cached_claims(key, now):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        expires_at, claims = entry
+        if now >= expires_at:
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return claims
+
+def _store_claims(key, claims, now):
+    try:
+        expires_at = float(claims['exp']) - AUTH_CACHE_EXPIRY_MARGIN_SECONDS
+    except (KeyError, TypeError, ValueError):
+        return
+    if expires_at <= now or AUTH_CACHE_MAX_ENTRIES <= 0:
+        return
+    with _cache_lock:
+        _cache[key] = (expires_at, claims)
+        _cache.move_to_end(key)
+        while len(_cache) > AUTH_CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+            _stats['evictions'] += 1
+
+def verify_token(id_token):
+    """Devuelve los claims del token (desde la caché si sigue vigente)."""
+    key = token_key(id_token)
+    now = time.time()
+    claims = _cached_claims(key, now)
+    if claims is not None:
+        _count('hits')
+        return claims
+
+    _count('misses')
+    try:
+        claims = auth.verify_id_token(id_token)
+    except Exception as auth_error:
+        _count('failures')
+        raise AuthError(f'Invalid or expired token: {auth_error}') from auth_error
+    _store_claims(key, claims, now)
+    return claims
+
+def verify_request(req):
+    """Extrae el token Bearer de la petición y devuelve sus claims verificados."""
+    return verify_token(extract_bearer_token(req))
+
+def invalidate(id_token):
+    with _cache_lock:
+        _cache.pop(token_key(id_token), None)
+
+def stats():
+    with _cache_lock:
+        snapshot = dict(_stats, size=len(_cache))
+    lookups = snapshot['hits'] + snapshot['misses']
+    snapshot['hitRate'] = round(snapshot['hits'] / lookups, 4) if lookups else 0.0
+    return snapshot
+
+def log_auth_stats():
+    # Línea JSON: Cloud Logging la indexa como jsonPayload para métricas basadas en logs
+    print(json.dumps(dict(stats(), severity='INFO', message='auth_token_cache', metric='auth_token_cache')))
+
+
+# ===============================================================
+#  MICROBENCHMARK
+# ===============================================================
+def benchmark(id_token, runs=200):
+    """Compara la latencia por petición de verify_id_token con la ruta en caché."""
+    auth.verify_id_token(id_token)  # certificados en caché para ambas mediciones
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        auth.verify_id_token(id_token)
+    direct_ms = (time.perf_counter() - started) * 1000 / runs
+
+    invalidate(id_token)
+    started = time.perf_counter()
+    for _ in range(runs):
+        verify_token(id_token)
+    cached_ms = (time.perf_counter() - started) * 1000 / runs
+
+    print(f"⏱️ Verificación por petición: verify_id_token={direct_ms:.3f}ms, "
+          f"caché={cached_ms:.4f}ms ({runs} peticiones). {json.dumps(stats())}")
+
+def main(argv):
+    from firebase_admin import initialize_app
+
+    if len(argv) < 2 or argv[0] != 'bench':
+        print("Uso: python auth_cache.py bench ID_TOKEN [peticiones]")
+        return 2
+    initialize_app()
+    benchmark(argv[1], int(argv[2]) if len(argv) > 2 else 200)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
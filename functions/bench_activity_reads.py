@@ -0,0 +1,118 @@
+# functions/bench_activity_reads.py
+
+# --- Benchmark: lectura de métricas de actividad contra el emulador ---
+# Compara, para un usuario con el historial de un semestre, el cálculo
+# anterior (stream de todas las tareas y todos los eventos, filtrados en
+# Python) con el actual (COUNT en el servidor y solo la ventana de 7 días) y
+# con la lectura del rollup (stats/activity). Comprueba además que las tres
+# variantes devuelven las mismas métricas.
+#
+# Uso (con el emulador de Firestore arrancado):
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 GCLOUD_PROJECT=demo-agenda \
+#       python bench_activity_reads.py [eventos ...]     (por defecto 500 3000)
+import os
+import sys
+import time
+import random
+import datetime
+
+import main
+
+TASKS_PER_EVENT = 0.5
+HABITS = 5
+REPEATS = 5
+BENCH_USER_PREFIX = 'bench_activity_'
+
+
+def legacy_scan_metrics(db, user_id, now):
+    """Cálculo anterior: recorre todas las tareas y todos los eventos del usuario."""
+    metrics = main.empty_activity_metrics()
+
+    for task_doc in db.collection(f"users/{user_id}/tasks").stream():
+        task = task_doc.to_dict() or {}
+        if task.get("completed"):
+            metrics["completedTasks"] += 1
+        else:
+            metrics["pendingTasks"] += 1
+            due_date = main.normalize_datetime(task.get("dueDate"))
+            if due_date and due_date < now:
+                metrics["overdueTasks"] += 1
+
+    habit_rates = [main.habit_completion_rate(habit_doc.to_dict() or {})
+                   for habit_doc in db.collection(f"users/{user_id}/habits").stream()]
+    if habit_rates:
+        metrics["habitCompletionRate"] = sum(habit_rates) / len(habit_rates)
+
+    week_ahead = now + datetime.timedelta(days=7)
+    for event_doc in db.collection(f"users/{user_id}/events").stream():
+        event = event_doc.to_dict() or {}
+        start = main.normalize_datetime(event.get("start"))
+        end = main.normalize_datetime(event.get("end"))
+        if start and end and now <= start <= week_ahead:
+            metrics["upcomingEvents"] += 1
+            metrics["weeklyLoadHours"] += max((end - start).total_seconds() / 3600, 0)
+
+    return metrics
+
+def seed_user(db, user_id, event_count, now, seed):
+    """Eventos repartidos en ~4 meses antes y después de now, tareas y hábitos."""
+    rng = random.Random(seed)
+    user_ref = db.collection('users').document(user_id)
+    with main.ChunkedBatchWriter(db, label='seed') as writer:
+        writer.set(user_ref, {'onboardingComplete': True})
+        for index in range(event_count):
+            start = now + datetime.timedelta(minutes=rng.randint(-120 * 24 * 60, 120 * 24 * 60))
+            writer.set(user_ref.collection('events').document(f'event{index:06d}'), {
+                'title': f'Clase {index}',
+                'start': start,
+                'end': start + datetime.timedelta(minutes=rng.choice([60, 90, 120])),
+                'notes': 'Evento de benchmark.',
+            })
+        for index in range(int(event_count * TASKS_PER_EVENT)):
+            writer.set(user_ref.collection('tasks').document(f'task{index:06d}'), {
+                'title': f'Tarea {index}',
+                'completed': rng.random() < 0.7,
+                'dueDate': now + datetime.timedelta(days=rng.randint(-90, 30)),
+            })
+        for index in range(HABITS):
+            writer.set(user_ref.collection('habits').document(f'habit{index}'), {
+                'completedDays': [rng.random() < 0.5 for _ in range(7)],
+            })
+
+def timed(fn, *args):
+    """(media en ms, resultado) de REPEATS ejecuciones."""
+    result = None
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        result = fn(*args)
+    return (time.perf_counter() - started) * 1000 / REPEATS, result
+
+def same_metrics(a, b):
+    return all(abs((a[key] or 0) - (b[key] or 0)) < 1e-9 for key in a)
+
+def main_cli(argv):
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        print("⚠️ Define FIRESTORE_EMULATOR_HOST: este benchmark solo debe ejecutarse contra el emulador.")
+        return 2
+
+    db = main.firestore.client()
+    now = datetime.datetime.now()
+    for event_count in [int(arg) for arg in argv] or [500, 3000]:
+        user_id = f'{BENCH_USER_PREFIX}{event_count}'
+        seed_user(db, user_id, event_count, now, seed=event_count)
+        main.rebuild_activity_rollup(db, user_id, now)
+
+        before_ms, before = timed(legacy_scan_metrics, db, user_id, now)
+        after_ms, after = timed(main.scan_user_activity_metrics, db, user_id, now)
+        rollup_ms, rollup = timed(main.load_user_activity_metrics, db, user_id, now)
+        parity = same_metrics(before, after) and same_metrics(before, rollup)
+        print(f"⏱️ {event_count} eventos / {int(event_count * TASKS_PER_EVENT)} tareas: "
+              f"escaneo completo={before_ms:.0f}ms, consultas acotadas={after_ms:.0f}ms (x{before_ms / after_ms:.1f}), "
+              f"rollup={rollup_ms:.0f}ms (x{before_ms / rollup_ms:.1f}), métricas iguales={parity}")
+        if not parity:
+            print(f"   antes={before}\n   ahora={after}\n   rollup={rollup}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
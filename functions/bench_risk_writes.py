@@ -0,0 +1,92 @@
+# functions/bench_risk_writes.py
+
+# --- Benchmark: escritura de resultados nocturnos contra el emulador ---
+# Compara un update() por usuario (más un add() por alerta), repartidos en
+# RISK_JOB_CONCURRENCY hilos como hacía el job nocturno, con el flush por
+# lotes de ChunkedBatchWriter.
+#
+# Uso (con el emulador de Firestore arrancado):
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 GCLOUD_PROJECT=demo-agenda \
+#       python bench_risk_writes.py [usuarios ...]     (por defecto 1000 10000)
+import os
+import sys
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+
+# Cada 'usuario' recibe una alerta con esta probabilidad (riesgo > 0.6)
+ALERT_RATIO = 0.2
+BENCH_COLLECTION = 'bench_users'
+
+
+def risk_payload(rng):
+    return {
+        'riskScore': rng.random(),
+        'riskBaseScore': rng.random(),
+        'riskFactors': [{'id': 'overdue_tasks', 'label': 'Tareas vencidas', 'impact': 0.1}],
+        'riskMetrics': {'pendingTasks': rng.randint(0, 20), 'overdueTasks': rng.randint(0, 5)},
+        'riskUpdatedAt': main.firestore.SERVER_TIMESTAMP,
+    }
+
+def alert_payload():
+    return {
+        'text': main.RISK_ALERT_TEXT,
+        'type': 'risk_alert',
+        'createdAt': main.firestore.SERVER_TIMESTAMP,
+        'viewed': False,
+    }
+
+def seed_users(db, count):
+    with main.ChunkedBatchWriter(db, label='seed') as writer:
+        for index in range(count):
+            writer.set(db.collection(BENCH_COLLECTION).document(f'user{index:06d}'), {'onboardingComplete': True})
+
+def run_per_document(db, count, seed):
+    rng = random.Random(seed)
+    jobs = [(f'user{index:06d}', risk_payload(rng), rng.random() < ALERT_RATIO) for index in range(count)]
+
+    def write(job):
+        user_id, payload, alert = job
+        user_ref = db.collection(BENCH_COLLECTION).document(user_id)
+        user_ref.update(payload)
+        if alert:
+            user_ref.collection('recommendations').add(alert_payload())
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=main.RISK_JOB_CONCURRENCY) as executor:
+        list(executor.map(write, jobs))
+    return time.perf_counter() - started, len(jobs) + sum(1 for job in jobs if job[2])
+
+def run_bulk(db, count, seed):
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    with main.ChunkedBatchWriter(db, label='bench') as writer:
+        for index in range(count):
+            user_id = f'user{index:06d}'
+            user_ref = db.collection(BENCH_COLLECTION).document(user_id)
+            writer.update(user_ref, risk_payload(rng), kind='risk', key=user_id)
+            if rng.random() < ALERT_RATIO:
+                writer.set(user_ref.collection('recommendations').document(), alert_payload(), kind='alerts', key=user_id)
+    summary = writer.drain()
+    return time.perf_counter() - started, sum(summary['committed'].values())
+
+def main_cli(argv):
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        print("⚠️ Define FIRESTORE_EMULATOR_HOST: este benchmark solo debe ejecutarse contra el emulador.")
+        return 2
+
+    db = main.firestore.client()
+    for count in [int(arg) for arg in argv] or [1000, 10000]:
+        seed_users(db, count)
+        per_doc_s, per_doc_writes = run_per_document(db, count, seed=count)
+        bulk_s, bulk_writes = run_bulk(db, count, seed=count)
+        print(f"⏱️ {count} usuarios: por documento={per_doc_s:.2f}s ({per_doc_writes / per_doc_s:.0f} escrituras/s), "
+              f"por lotes={bulk_s:.2f}s ({bulk_writes / bulk_s:.0f} escrituras/s), "
+              f"x{per_doc_s / bulk_s:.1f} (chunk={main.WRITE_CHUNK_SIZE}, paralelismo={main.WRITE_PARALLELISM})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
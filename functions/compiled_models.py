@@ -0,0 +1,350 @@
+# functions/compiled_models.py
+
+# --- Modelos compilados: inferencia solo con numpy ---
+# Convierte un ColumnTransformer (escaladores / one-hot) junto con un KMeans o
+# una LogisticRegression ya entrenados en arrays planos (medias, escalas,
+# tablas one-hot, centroides, coeficientes) guardados en un .npz. En runtime
+# se puntúa sin importar pandas ni sklearn.
+#
+# Exportar y verificar la paridad contra el pipeline de sklearn:
+#   python compiled_models.py export preprocessor.pkl modelo.pkl salida.npz muestras.json
+# La exportación guarda en el .npz las muestras y las salidas de sklearn
+# (transformación y predicción). load_compiled vuelve a puntuarlas cada vez
+# que carga el artefacto y lo rechaza si no coinciden bit a bit, así que un
+# modelo compilado sin paridad exacta nunca llega a atender peticiones.
+import json
+import math
+import numpy as np
+
+COMPILED_FORMAT_VERSION = 2
+PARITY_MAX_SAMPLES = 200
+
+
+class ParityError(ValueError):
+    """El pipeline compilado no reproduce exactamente la salida de sklearn."""
+
+
+# ===============================================================
+#  EXPORTACIÓN (requiere sklearn, solo se usa fuera del runtime)
+# ===============================================================
+def _affine_ops(step):
+    """Operaciones elementales, en el mismo orden que aplica sklearn."""
+    from sklearn.preprocessing import StandardScaler, MinMaxScaler
+    from sklearn.impute import SimpleImputer
+
+    if isinstance(step, StandardScaler):
+        ops = []
+        if step.with_mean:
+            ops.append(('sub', np.asarray(step.mean_, dtype=np.float64)))
+        if step.with_std:
+            ops.append(('div', np.asarray(step.scale_, dtype=np.float64)))
+        return ops
+    if isinstance(step, MinMaxScaler):
+        if step.clip:
+            raise NotImplementedError("MinMaxScaler(clip=True) no soportado.")
+        return [('mul', np.asarray(step.scale_, dtype=np.float64)),
+                ('add', np.asarray(step.min_, dtype=np.float64))]
+    if isinstance(step, SimpleImputer):
+        # Las filas con nulos se rechazan antes de puntuar: el imputador es identidad
+        return []
+    if step == 'passthrough' or step is None:
+        return []
+    raise NotImplementedError(f"Paso no soportado: {type(step).__name__}")
+
+def _onehot_block(encoder, columns):
+    if getattr(encoder, '_infrequent_enabled', False):
+        raise NotImplementedError("OneHotEncoder con categorías infrecuentes no soportado.")
+    drop_idx = getattr(encoder, 'drop_idx_', None)
+    return {
+        'kind': 'onehot',
+        'columns': list(columns),
+        'categories': [[c.item() if hasattr(c, 'item') else c for c in cats] for cats in encoder.categories_],
+        'drop': [None if drop_idx is None or drop_idx[i] is None else int(drop_idx[i]) for i in range(len(columns))],
+        'handleUnknown': encoder.handle_unknown,
+    }
+
+def _compile_transformer(trans, columns):
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder
+
+    steps = [step for _, step in trans.steps] if isinstance(trans, Pipeline) else [trans]
+    if isinstance(steps[-1], OneHotEncoder):
+        for step in steps[:-1]:
+            if _affine_ops(step):
+                raise NotImplementedError("Escalado antes de un OneHotEncoder no soportado.")
+        return _onehot_block(steps[-1], columns)
+
+    ops = []
+    for step in steps:
+        ops.extend(_affine_ops(step))
+    return {'kind': 'numeric', 'columns': list(columns), 'ops': ops}
+
+def compile_pipeline(preprocessor, model):
+    """Devuelve (spec_json, arrays) a partir de los objetos de sklearn ya entrenados."""
+    from sklearn.cluster import KMeans
+    from sklearn.linear_model import LogisticRegression
+
+    feature_names = [str(c) for c in preprocessor.feature_names_in_]
+    blocks = []
+    for name, trans, columns in preprocessor.transformers_:
+        if trans == 'drop':
+            continue
+        if not isinstance(columns, (list, tuple, np.ndarray)):
+            columns = [columns]
+        columns = [feature_names[c] if isinstance(c, (int, np.integer)) else str(c) for c in columns]
+        if not columns:
+            continue
+        blocks.append(_compile_transformer(trans, columns))
+
+    arrays = {}
+    for b_idx, block in enumerate(blocks):
+        if block['kind'] == 'numeric':
+            op_names = []
+            for o_idx, (op, values) in enumerate(block.pop('ops')):
+                key = f'b{b_idx}_op{o_idx}'
+                arrays[key] = values
+                op_names.append([op, key])
+            block['ops'] = op_names
+
+    if isinstance(model, KMeans):
+        model_spec = {'kind': 'kmeans'}
+        arrays['centers'] = np.asarray(model.cluster_centers_, dtype=np.float64)
+    elif isinstance(model, LogisticRegression):
+        multi_class = getattr(model, 'multi_class', 'auto')
+        model_spec = {
+            'kind': 'logistic',
+            'classes': [c.item() if hasattr(c, 'item') else c for c in model.classes_],
+            'ovr': multi_class in ('ovr', 'warn') or (multi_class == 'auto' and model.solver == 'liblinear'),
+        }
+        arrays['coef'] = np.asarray(model.coef_, dtype=np.float64)
+        arrays['intercept'] = np.asarray(model.intercept_, dtype=np.float64)
+    else:
+        raise NotImplementedError(f"Modelo no soportado: {type(model).__name__}")
+
+    spec = {
+        'formatVersion': COMPILED_FORMAT_VERSION,
+        'featureNames': feature_names,
+        'blocks': blocks,
+        'model': model_spec,
+    }
+    return spec, arrays
+
+def sklearn_reference(preprocessor, model, samples):
+    """Salidas de sklearn (X transformada, predicción) para las muestras."""
+    import pandas as pd
+
+    df = pd.DataFrame(samples).reindex(columns=list(preprocessor.feature_names_in_))
+    X = preprocessor.transform(df)
+    if hasattr(X, 'toarray'):
+        X = X.toarray()
+    X = np.asarray(X, dtype=np.float64)
+    output = model.predict(X) if hasattr(model, 'cluster_centers_') else model.predict_proba(X)
+    return X, np.asarray(output)
+
+def attach_parity(spec, arrays, preprocessor, model, samples):
+    """Añade al artefacto las muestras de paridad y las salidas esperadas."""
+    samples = list(samples)[:PARITY_MAX_SAMPLES]
+    if not samples:
+        raise ValueError("Se necesitan muestras para verificar la paridad.")
+    expected_X, expected_output = sklearn_reference(preprocessor, model, samples)
+    spec['parity'] = {'samples': samples}
+    arrays['parity_X'] = expected_X
+    arrays['parity_output'] = expected_output
+
+def save_compiled(spec, arrays, path):
+    spec_bytes = np.frombuffer(json.dumps(spec).encode('utf-8'), dtype=np.uint8)
+    with open(path, 'wb') as f:
+        np.savez(f, spec=spec_bytes, **arrays)
+
+
+# ===============================================================
+#  RUNTIME (solo numpy)
+# ===============================================================
+def _expit(values):
+    # Misma fórmula que scipy.special.expit con la exp de libm (math.exp):
+    # la exp vectorizada de numpy puede diferir en el último bit.
+    flat = [0.0 if v < -709.0 else 1.0 / (1.0 + math.exp(-v)) for v in values.ravel().tolist()]
+    return np.array(flat, dtype=np.float64).reshape(values.shape)
+
+class CompiledPipeline:
+    """Preprocesador + modelo compilados. API mínima: transform/predict/predict_proba."""
+
+    def __init__(self, spec, arrays):
+        if spec.get('formatVersion') != COMPILED_FORMAT_VERSION:
+            raise ValueError(f"Formato de modelo compilado no soportado: {spec.get('formatVersion')}")
+        self.spec = spec
+        self.feature_names_in_ = spec['featureNames']
+        self.model_kind = spec['model']['kind']
+        self._blocks = []
+        for block in spec['blocks']:
+            if block['kind'] == 'numeric':
+                ops = [(op, arrays[key]) for op, key in block['ops']]
+                self._blocks.append(('numeric', block['columns'], ops))
+            else:
+                lookups = []
+                widths = []
+                for cats, drop in zip(block['categories'], block['drop']):
+                    lookup = {}
+                    pos = 0
+                    for c_idx, cat in enumerate(cats):
+                        if c_idx == drop:
+                            lookup[cat] = None
+                            continue
+                        lookup[cat] = pos
+                        pos += 1
+                    lookups.append(lookup)
+                    widths.append(pos)
+                self._blocks.append(('onehot', block['columns'], (lookups, widths, block['handleUnknown'])))
+        self.n_features_out = sum(
+            len(cols) if kind == 'numeric' else sum(extra[1])
+            for kind, cols, extra in self._blocks
+        )
+        if self.model_kind == 'kmeans':
+            self.centers = arrays['centers']
+        else:
+            self.coef = arrays['coef']
+            self.intercept = arrays['intercept']
+            self.classes_ = spec['model']['classes']
+            self.ovr = spec['model']['ovr']
+        self._parity = (spec.get('parity', {}).get('samples'), arrays.get('parity_X'), arrays.get('parity_output'))
+
+    def check_parity(self):
+        """Exige que las muestras guardadas en la exportación den exactamente la salida de sklearn."""
+        samples, expected_X, expected_output = self._parity
+        if not samples or expected_X is None or expected_output is None:
+            raise ParityError("El artefacto compilado no incluye muestras de paridad.")
+        got_X = self.transform(samples)
+        if not np.array_equal(got_X, expected_X):
+            raise ParityError("La transformación compilada no coincide bit a bit con sklearn.")
+        got_output = self.predict(got_X) if self.model_kind == 'kmeans' else self.predict_proba(got_X)
+        if not np.array_equal(got_output, expected_output):
+            raise ParityError("La predicción compilada no coincide bit a bit con sklearn.")
+
+    def missing_columns(self, row):
+        return [col for col in self.feature_names_in_ if row.get(col) is None]
+
+    def transform(self, rows):
+        """rows: lista de dicts con las claves de feature_names_in_ (sin nulos)."""
+        n_rows = len(rows)
+        out = np.empty((n_rows, self.n_features_out), dtype=np.float64)
+        offset = 0
+        for kind, columns, extra in self._blocks:
+            if kind == 'numeric':
+                block = np.array([[row[col] for col in columns] for row in rows], dtype=np.float64)
+                for op, values in extra:
+                    if op == 'sub':
+                        block -= values
+                    elif op == 'div':
+                        block /= values
+                    elif op == 'mul':
+                        block *= values
+                    else:
+                        block += values
+                out[:, offset:offset + len(columns)] = block
+                offset += len(columns)
+            else:
+                lookups, widths, handle_unknown = extra
+                for col, lookup, width in zip(columns, lookups, widths):
+                    out[:, offset:offset + width] = 0.0
+                    for r_idx, row in enumerate(rows):
+                        value = row[col]
+                        if value not in lookup:
+                            if handle_unknown == 'error':
+                                raise ValueError(f"Found unknown categories [{value!r}] in column '{col}' during transform")
+                            continue
+                        pos = lookup[value]
+                        if pos is not None:
+                            out[r_idx, offset + pos] = 1.0
+                    offset += width
+        return out
+
+    def predict(self, X):
+        if self.model_kind != 'kmeans':
+            raise AttributeError("predict solo está disponible para K-Means compilado.")
+        distances = ((X[:, np.newaxis, :] - self.centers[np.newaxis, :, :]) ** 2).sum(axis=2)
+        return distances.argmin(axis=1)
+
+    def predict_proba(self, X):
+        if self.model_kind != 'logistic':
+            raise AttributeError("predict_proba solo está disponible para Regresión compilada.")
+        decision = X @ self.coef.T + self.intercept
+        if decision.shape[1] == 1:
+            prob = _expit(decision[:, 0])
+            return np.vstack([1 - prob, prob]).T
+        if self.ovr:
+            prob = _expit(decision)
+            return prob / prob.sum(axis=1).reshape((-1, 1))
+        decision = decision - decision.max(axis=1, keepdims=True)
+        prob = np.exp(decision)
+        return prob / prob.sum(axis=1, keepdims=True)
+
+def load_compiled(path):
+    """
+    Carga un .npz compilado (sin pickle) y comprueba su paridad con sklearn.
+    Los arrays se leen a memoria: numpy no mapea los miembros de un .npz.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        spec = json.loads(data['spec'].tobytes().decode('utf-8'))
+        arrays = {key: data[key] for key in data.files if key != 'spec'}
+    compiled = CompiledPipeline(spec, arrays)
+    compiled.check_parity()
+    return compiled
+
+
+# ===============================================================
+#  VERIFICACIÓN DE PARIDAD Y LATENCIA (CLI de exportación)
+# ===============================================================
+def verify_parity(preprocessor, model, compiled, samples):
+    """Compara bit a bit el pipeline de sklearn con el compilado en todas las muestras."""
+    import time
+    import pandas as pd
+
+    expected_X, expected = sklearn_reference(preprocessor, model, samples)
+    got_X = compiled.transform(samples)
+    if not np.array_equal(expected_X, got_X):
+        raise ParityError(f"La transformación compilada no coincide bit a bit con sklearn "
+                          f"(diferencia máxima {np.abs(expected_X - got_X).max():.3g}).")
+    got = compiled.predict(got_X) if compiled.model_kind == 'kmeans' else compiled.predict_proba(got_X)
+    if not np.array_equal(expected, got):
+        raise ParityError("La predicción compilada no coincide bit a bit con sklearn.")
+
+    # Latencia de una predicción individual (el caso de las funciones HTTP)
+    cols = list(preprocessor.feature_names_in_)
+    runs = 200
+    row = samples[:1]
+    started = time.perf_counter()
+    for _ in range(runs):
+        X = preprocessor.transform(pd.DataFrame(row).reindex(columns=cols))
+        model.predict(X) if compiled.model_kind == 'kmeans' else model.predict_proba(X)
+    sklearn_ms = (time.perf_counter() - started) * 1000 / runs
+    started = time.perf_counter()
+    for _ in range(runs):
+        X = compiled.transform(row)
+        compiled.predict(X) if compiled.model_kind == 'kmeans' else compiled.predict_proba(X)
+    compiled_ms = (time.perf_counter() - started) * 1000 / runs
+    print(f"✅ Paridad bit a bit OK en {len(samples)} filas. "
+          f"Latencia por predicción: sklearn={sklearn_ms:.3f}ms, compilado={compiled_ms:.3f}ms")
+
+def main(argv):
+    import joblib
+
+    if len(argv) < 5 or argv[0] != 'export':
+        print("Uso: python compiled_models.py export preprocessor.pkl modelo.pkl salida.npz muestras.json")
+        return 2
+    preprocessor = joblib.load(argv[1])
+    model = joblib.load(argv[2])
+    with open(argv[4]) as f:
+        samples = json.load(f)
+    spec, arrays = compile_pipeline(preprocessor, model)
+    attach_parity(spec, arrays, preprocessor, model, samples)
+    save_compiled(spec, arrays, argv[3])
+    # load_compiled comprueba las muestras guardadas, igual que en runtime
+    compiled = load_compiled(argv[3])
+    print(f"💾 Modelo compilado guardado en {argv[3]} ({compiled.n_features_out} columnas de salida).")
+    verify_parity(preprocessor, model, compiled, samples)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,193 @@
+# functions/keyword_matcher.py
+
+# --- Búsqueda de palabras clave en títulos de eventos ---
+# Las palabras clave (normalizadas) se compilan una sola vez por instancia en
+# una única expresión regular de alternativas, de modo que cada título se
+# recorre en una sola pasada en lugar de buscar ~50 subcadenas por separado.
+# La normalización de títulos se memoriza: los mismos títulos ("Examen",
+# "Tarea de ...") se repiten mucho entre usuarios y semanas.
+import re
+import sys
+import time
+import random
+import unicodedata
+from functools import lru_cache
+
+# categoría -> peso (para ordenar alertas) y palabras clave
+DEFAULT_KEYWORD_CATEGORIES = {
+    'exam': {
+        'weight': 3.0,
+        'keywords': [
+            "examen", "evaluacion", "evaluación", "prueba", "quiz", "test",
+            "parcial", "final", "midterm", "ordinario", "extraordinario",
+        ],
+    },
+    'homework': {
+        'weight': 1.5,
+        'keywords': [
+            "tarea", "entrega", "entregar", "actividad", "homework", "assignment",
+            "pendiente", "subir", "deadline", "fecha limite", "fecha límite",
+        ],
+    },
+    'project': {
+        'weight': 2.0,
+        'keywords': [
+            "proyecto", "trabajo", "ensayo", "informe", "reporte", "monografia",
+            "investigacion", "investigación", "documento", "avance", "propuesta",
+        ],
+    },
+    'presentation': {
+        'weight': 2.0,
+        'keywords': ["presentacion", "presentación", "expo", "exposición", "pitch"],
+    },
+    'review': {
+        'weight': 1.0,
+        'keywords': [
+            "revision", "revisión", "retroalimentacion", "retroalimentación",
+            "feedback",
+        ],
+    },
+    'planning': {
+        'weight': 1.0,
+        'keywords': ["fecha importante", "planificacion", "planificación", "agenda"],
+    },
+}
+
+NORMALIZE_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize(text: str):
+    """
+    Convierte a minúsculas, quita acentos y caracteres diacríticos.
+    Memorizada: cada título distinto se normaliza una sola vez por instancia.
+    """
+    text = text.lower()
+    if text.isascii():
+        return text
+    text = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+
+
+class KeywordMatch:
+    __slots__ = ('keyword', 'category', 'weight')
+
+    def __init__(self, keyword, category, weight):
+        self.keyword = keyword
+        self.category = category
+        self.weight = weight
+
+    def to_dict(self):
+        return {'keyword': self.keyword, 'category': self.category, 'weight': self.weight}
+
+
+class KeywordMatcher:
+    """
+    Compila las palabras clave por categoría en una regex de alternativas
+    (más largas primero) con la misma semántica que `keyword in title` sobre
+    el texto normalizado. Si una palabra está en varias categorías gana la de
+    mayor peso.
+    """
+
+    def __init__(self, categories):
+        self.categories = categories
+        self._keywords = {}
+        for category, spec in categories.items():
+            weight = float(spec.get('weight', 1.0))
+            for keyword in spec.get('keywords', []):
+                keyword_norm = normalize(keyword).strip()
+                if not keyword_norm:
+                    continue
+                current = self._keywords.get(keyword_norm)
+                if current is None or weight > current.weight:
+                    self._keywords[keyword_norm] = KeywordMatch(keyword_norm, category, weight)
+
+        alternatives = sorted(self._keywords, key=len, reverse=True)
+        # En cada posición la regex solo devuelve la alternativa más larga; las
+        # palabras que son prefijo suyo ("entrega" en "entregar") también están
+        self._prefixes = {
+            keyword: [other for other in self._keywords if other != keyword and keyword.startswith(other)]
+            for keyword in self._keywords
+        }
+        # Lookahead: encuentra también coincidencias solapadas (como `in`)
+        self._pattern = re.compile('(?=(' + '|'.join(map(re.escape, alternatives)) + '))') if alternatives else None
+
+    def __len__(self):
+        return len(self._keywords)
+
+    def find_all(self, title):
+        """Todas las palabras clave distintas que aparecen en el título."""
+        if not title or self._pattern is None:
+            return []
+        found = {}
+        for match in self._pattern.finditer(normalize(title)):
+            keyword = match.group(1)
+            for hit in [keyword] + self._prefixes[keyword]:
+                if hit not in found:
+                    found[hit] = self._keywords[hit]
+        return list(found.values())
+
+    def match(self, title):
+        """La palabra clave de mayor peso del título (la primera en empate), o None."""
+        best = None
+        for keyword_match in self.find_all(title):
+            if best is None or keyword_match.weight > best.weight:
+                best = keyword_match
+        return best
+
+
+# ===============================================================
+#  MICROBENCHMARK
+# ===============================================================
+def synthetic_titles(count, seed=7):
+    rng = random.Random(seed)
+    words = ["Clase", "Reunión", "Comida", "Gimnasio", "Laboratorio", "Asesoría", "Cálculo",
+             "Física", "Química", "Historia", "Programación", "Biología", "Inglés", "Álgebra"]
+    keywords = [keyword for spec in DEFAULT_KEYWORD_CATEGORIES.values() for keyword in spec['keywords']]
+    titles = []
+    for _ in range(count):
+        title = " ".join(rng.sample(words, 2))
+        if rng.random() < 0.3:
+            title = f"{rng.choice(keywords).capitalize()} de {title}"
+        titles.append(title)
+    return titles
+
+def unicode_normalize(text):
+    # La normalización original, sin memorizar
+    text = unicodedata.normalize("NFD", text.lower())
+    return "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+
+def benchmark(events=5000, calendars=20):
+    """Compara el `any(keyword in title)` original con el matcher compilado."""
+    keyword_list = [keyword for spec in DEFAULT_KEYWORD_CATEGORIES.values() for keyword in spec['keywords']]
+    calendars_titles = [synthetic_titles(events, seed=seed) for seed in range(calendars)]
+
+    started = time.perf_counter()
+    keywords_normalized = [unicode_normalize(keyword) for keyword in keyword_list]
+    expected = [[any(keyword in unicode_normalize(title) for keyword in keywords_normalized) for title in titles]
+                for titles in calendars_titles]
+    baseline_s = time.perf_counter() - started
+
+    normalize.cache_clear()
+    started = time.perf_counter()
+    matcher = KeywordMatcher(DEFAULT_KEYWORD_CATEGORIES)
+    got = [[matcher.match(title) is not None for title in titles] for titles in calendars_titles]
+    matcher_s = time.perf_counter() - started
+
+    total = events * calendars
+    print(f"⏱️ {total} eventos ({calendars} calendarios): original={baseline_s * 1e6 / total:.2f}µs/evento, "
+          f"matcher={matcher_s * 1e6 / total:.2f}µs/evento (x{baseline_s / matcher_s:.1f}), "
+          f"mismos resultados: {expected == got}. {normalize.cache_info()}")
+
+def main(argv):
+    if not argv or argv[0] != 'bench':
+        print("Uso: python keyword_matcher.py bench [eventos_por_calendario] [calendarios]")
+        return 2
+    events = int(argv[1]) if len(argv) > 1 else 5000
+    calendars = int(argv[2]) if len(argv) > 2 else 20
+    benchmark(events, calendars)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,43 +1,45 @@
 # functions/main.py
 
 # --- Imports ESTRICTAMENTE necesarios globalmente ---
-from firebase_functions import https_fn, scheduler_fn
-from firebase_admin import initialize_app, firestore, auth
+from firebase_functions import https_fn, scheduler_fn, firestore_fn, tasks_fn
+from firebase_functions.options import RetryConfig, RateLimits
+from firebase_admin import initialize_app, firestore
 import os
 import json
+import math
+import time
+import random
+import bisect
+import hashlib
+import tempfile
+import threading
 import traceback
+import contextlib
 import pytz # --- CORRECCIÓN 1.3: Importamos pytz para manejar zonas horarias ---
 import datetime # --- CORRECCIÓN 3.2: Importamos datetime para el cálculo de la semana ---
-import unicodedata  # <-- ✅ 1. IMPORTACIÓN AÑADIDA
 from dateutil import rrule, parser as date_parser
 
 # Inicializar Firebase (solo una vez, es ligero)
 initialize_app()
 
+# Registro de modelos: al importarse lanza la precarga en segundo plano de
+# los artefactos que usa esta función (ver model_registry.py)
+import model_registry
+import compiled_models
+# Verificación de tokens con caché de claims (ver auth_cache.py)
+import auth_cache
+# Vocabulario y umbrales de alertas desde Firestore con caché (ver alert_rules.py)
+import alert_rules
+# Expansión vectorizada de clases semanales (ver schedule_expander.py)
+import schedule_expander
+# Extracción del horario con Gemini y caché por contenido (ver schedule_extraction.py)
+import schedule_extraction
+# Lectura por streaming del archivo subido (ver schedule_upload.py)
+import schedule_upload
+
 # --- CACHÉ GLOBAL (Inicializados a None) ---
-# Models
-preprocessor_kmeans = None
-kmeans_model = None
-preprocessor_regression = None
-regression_model = None
 # Clients
 db_client = None
-storage_client = None
-vision_model = None
-# Flags
-vertexai_initialized = False
-
-# --- CONFIGURACIÓN DE GCS ---
-GCS_BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME', 'agenda-b616a-models')
-KMEANS_PREPROCESSOR_GCS = 'preprocessor_kmeans.pkl'
-KMEANS_MODEL_GCS = 'modelo_kmeans_4clusters.pkl'
-REGRESSION_PREPROCESSOR_GCS = 'preprocessor_regresion.pkl'
-REGRESSION_MODEL_GCS = 'modelo_regresion_aprobacion.pkl'
-# Rutas locales temporales
-KMEANS_PREPROCESSOR_LOCAL = '/tmp/preprocessor_kmeans.pkl'
-KMEANS_MODEL_LOCAL = '/tmp/modelo_kmeans_4clusters.pkl'
-REGRESSION_PREPROCESSOR_LOCAL = '/tmp/preprocessor_regresion.pkl'
-REGRESSION_MODEL_LOCAL = '/tmp/modelo_regresion_aprobacion.pkl'
 
 # --- Colores predeterminados ---
 presetColors = ["#46487A","#7786C6","#D9534F","#F0AD4E","#FFC212","#5CB85C","#5BC0DE","#F9B0C3","#6C757D","#343A40"]
@@ -62,37 +64,231 @@ def get_cors_headers(request_origin=''):
     return {
         'Access-Control-Allow-Origin': origin,
         'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Requested-With',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Requested-With, If-None-Match',
+        'Access-Control-Expose-Headers': 'ETag',
         'Access-Control-Max-Age': '3600',
     }
 
+# --- AUTENTICACIÓN ---
+def authenticate_request(req, headers):
+    """Devuelve (claims, None) si el token es válido o (None, respuesta 401)."""
+    try:
+        return auth_cache.verify_request(req), None
+    except auth_cache.AuthError as auth_error:
+        print(f"Auth verification error: {auth_error}")
+        return None, https_fn.Response(
+            json.dumps({'error': 'Invalid or expired token.'}),
+            status=401,
+            headers=dict(headers, **{'WWW-Authenticate': 'Bearer'})
+        )
+
 # ===============================================================
-#  FUNCIÓN HELPER: DESCARGAR DE GCS
+#  FUNCIÓN HELPER: ESCRITURAS FIRESTORE POR LOTES (CHUNKS)
 # ===============================================================
-def download_blob(bucket_name, source_blob_name, destination_file_name):
-    """Descarga un archivo desde GCS al sistema de archivos temporal /tmp/."""
-    from google.cloud import storage
-    global storage_client
-    
-    if storage_client is None:
+# Firestore limita cada batch a 500 escrituras. Las escrituras se agrupan en
+# chunks que se confirman en paralelo y se reintentan con backoff exponencial.
+# Si un chunk sigue fallando (o falla por un error no reintentable), sus
+# escrituras se confirman una a una para no perder las que sí son válidas.
+FIRESTORE_BATCH_LIMIT = 500
+WRITE_CHUNK_SIZE = int(os.environ.get('WRITE_CHUNK_SIZE', '400'))
+WRITE_PARALLELISM = int(os.environ.get('WRITE_PARALLELISM', '4'))
+WRITE_MAX_RETRIES = int(os.environ.get('WRITE_MAX_RETRIES', '4'))
+WRITE_RETRY_BASE_DELAY = float(os.environ.get('WRITE_RETRY_BASE_DELAY', '0.5'))
+
+class ChunkedBatchWriter:
+    """
+    Acumula escrituras (set/update/delete) y las confirma en batches de como
+    máximo `chunk_size` operaciones en cuanto se llena cada chunk. Cada
+    escritura lleva un `kind` para reportar el progreso parcial por tipo y,
+    opcionalmente, una `key` (p. ej. el user_id) con la que se reportan las
+    escrituras que fallan individualmente en `failed_items`. Las escrituras
+    hechas dentro de `with writer.group():` van siempre en el mismo batch
+    (se confirman o fallan juntas). Es seguro compartirlo entre hilos: la
+    lista pendiente y los futures solo se tocan con `_pending_lock`.
+    """
+
+    def __init__(self, db, chunk_size=WRITE_CHUNK_SIZE, parallelism=WRITE_PARALLELISM,
+                 max_retries=WRITE_MAX_RETRIES, label='writer'):
+        from concurrent.futures import ThreadPoolExecutor
+        self.db = db
+        self.chunk_size = max(1, min(chunk_size, FIRESTORE_BATCH_LIMIT))
+        self.max_retries = max(0, max_retries)
+        self.label = label
+        parallelism = max(1, parallelism)
+        self._executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix=label)
+        # Limita los chunks en vuelo para que el productor no acumule memoria
+        self._slots = threading.BoundedSemaphore(parallelism * 2)
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        self._futures = []
+        # Grupo abierto por cada hilo: [id, escrituras] (se encola entero al cerrar)
+        self._local = threading.local()
+        self._group_seq = 0
+        self.committed = {}
+        self.failed = {}
+        self.failed_items = []
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def set(self, ref, data, kind='doc', merge=False, key=None):
+        self._add('set', ref, data, merge, kind, key)
+
+    def update(self, ref, data, kind='doc', key=None):
+        self._add('update', ref, data, False, kind, key)
+
+    def delete(self, ref, kind='doc', key=None):
+        self._add('delete', ref, None, False, kind, key)
+
+    @contextlib.contextmanager
+    def group(self):
+        """
+        Agrupa las escrituras del bloque en un mismo batch atómico (no anidable).
+        Se acumulan en una lista del hilo y se encolan juntas al salir del
+        bloque, así que los grupos de hilos distintos no se mezclan ni se cortan.
+        """
+        if getattr(self._local, 'group', None) is not None:
+            raise RuntimeError("writer.group() no es anidable.")
+        with self._pending_lock:
+            self._group_seq += 1
+            group_id = self._group_seq
+        writes = []
+        self._local.group = (group_id, writes)
         try:
-            print("🔄 Inicializando cliente GCS...")
-            storage_client = storage.Client()
-            print("✅ Cliente GCS inicializado.")
-        except Exception as gcs_init_e:
-            print(f"❌ Error FATAL inicializando GCS: {gcs_init_e}")
-            raise
-    
-    try:
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(source_blob_name)
-        os.makedirs(os.path.dirname(destination_file_name), exist_ok=True)
-        print(f"⬇️ Descargando {source_blob_name} de gs://{bucket_name} a {destination_file_name}...")
-        blob.download_to_filename(destination_file_name)
-        print(f"✅ Descarga GCS completada: {destination_file_name}")
-    except Exception as e:
-        print(f"❌ Error descargando {source_blob_name} de GCS: {e}")
-        raise
+            yield self
+        finally:
+            self._local.group = None
+        if len(writes) > FIRESTORE_BATCH_LIMIT:
+            raise ValueError(f"Un grupo no puede superar {FIRESTORE_BATCH_LIMIT} escrituras ({len(writes)}).")
+        self._enqueue(writes)
+
+    def _add(self, op, ref, data, merge, kind, key):
+        group = getattr(self._local, 'group', None)
+        if group is not None:
+            group[1].append((op, ref, data, merge, kind, key, group[0]))
+        else:
+            self._enqueue([(op, ref, data, merge, kind, key, None)])
+
+    def _enqueue(self, writes):
+        """Encola escrituras como una unidad: nunca se reparten entre dos chunks."""
+        if not writes:
+            return
+        chunks = []
+        with self._pending_lock:
+            # Si la unidad no cabe en el chunk actual, este se cierra antes
+            if self._pending and len(self._pending) + len(writes) > self.chunk_size:
+                chunks.append(self._take_pending())
+            self._pending.extend(writes)
+            if len(self._pending) >= self.chunk_size:
+                chunks.append(self._take_pending())
+        for chunk in chunks:
+            self._submit(chunk)
+
+    def _take_pending(self):
+        # Llamar con _pending_lock
+        chunk, self._pending = self._pending, []
+        return chunk
+
+    def _submit(self, chunk):
+        # Fuera de _pending_lock: esperar un hueco no bloquea a los demás productores
+        self._slots.acquire()
+        future = self._executor.submit(self._commit_chunk, chunk)
+        with self._pending_lock:
+            self._futures.append(future)
+
+    def flush(self):
+        with self._pending_lock:
+            chunk = self._take_pending()
+        if chunk:
+            self._submit(chunk)
+
+    @staticmethod
+    def _is_retryable(error):
+        # Errores del request en sí (documento inexistente, datos inválidos...) no se reintentan
+        return type(error).__name__ not in ('NotFound', 'InvalidArgument', 'FailedPrecondition',
+                                            'PermissionDenied', 'AlreadyExists')
+
+    def _commit_writes(self, writes):
+        batch = self.db.batch()
+        for op, ref, data, merge, *_ in writes:
+            if op == 'set':
+                batch.set(ref, data, merge=merge)
+            elif op == 'update':
+                batch.update(ref, data)
+            else:
+                batch.delete(ref)
+        batch.commit()
+
+    def _commit_one_by_one(self, chunk):
+        """Aísla las escrituras inválidas de un chunk fallido (los grupos, juntos)."""
+        units = []
+        for write in chunk:
+            if write[6] is not None and units and units[-1][0][6] == write[6]:
+                units[-1].append(write)
+            else:
+                units.append([write])
+        for unit in units:
+            try:
+                self._commit_writes(unit)
+                self._record(self.committed, unit)
+            except Exception as item_error:
+                self._record(self.failed, unit)
+                with self._lock:
+                    for write in unit:
+                        self.failed_items.append({'kind': write[4], 'key': write[5], 'error': str(item_error)})
+                    self.errors.append(str(item_error))
+
+    def _commit_chunk(self, chunk):
+        try:
+            attempt = 0
+            while True:
+                try:
+                    self._commit_writes(chunk)
+                    self._record(self.committed, chunk)
+                    return
+                except Exception as commit_error:
+                    if attempt >= self.max_retries or not self._is_retryable(commit_error):
+                        print(f"❌ [{self.label}] Chunk de {len(chunk)} escrituras falló tras {attempt + 1} intentos: {commit_error}. Confirmando una a una...")
+                        self._commit_one_by_one(chunk)
+                        return
+                    delay = WRITE_RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random())
+                    print(f"WARN: [{self.label}] Reintentando chunk de {len(chunk)} escrituras en {delay:.1f}s: {commit_error}")
+                    time.sleep(delay)
+                    attempt += 1
+        finally:
+            self._slots.release()
+
+    def _record(self, counters, chunk):
+        with self._lock:
+            for write in chunk:
+                counters[write[4]] = counters.get(write[4], 0) + 1
+
+    def drain(self):
+        """Confirma lo pendiente y espera a que terminen los chunks en vuelo."""
+        self.flush()
+        with self._pending_lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+        with self._lock:
+            return {
+                'committed': dict(self.committed),
+                'failed': dict(self.failed),
+                'failedItems': list(self.failed_items),
+                'errors': list(self.errors),
+            }
+
+    def close(self):
+        """Confirma lo pendiente, espera a todos los chunks y devuelve el resumen."""
+        summary = self.drain()
+        self._executor.shutdown(wait=True)
+        return summary
 
 # ===============================================================
 #  FUNCIÓN HELPER: TRADUCIR CLAVES (Formulario -> Modelo)
@@ -164,24 +360,11 @@ def normalize_datetime(value):
     return None
 
 def load_regression_models():
-    import joblib
-    global preprocessor_regression, regression_model
-    if preprocessor_regression is None:
-        if not os.path.exists(REGRESSION_PREPROCESSOR_LOCAL):
-            download_blob(GCS_BUCKET_NAME, REGRESSION_PREPROCESSOR_GCS, REGRESSION_PREPROCESSOR_LOCAL)
-        print(f"🔄 Cargando preprocesador Regresión desde {REGRESSION_PREPROCESSOR_LOCAL}...")
-        preprocessor_regression = joblib.load(REGRESSION_PREPROCESSOR_LOCAL)
-        print("✅ Preprocesador Regresión cargado.")
-    if regression_model is None:
-        if not os.path.exists(REGRESSION_MODEL_LOCAL):
-            download_blob(GCS_BUCKET_NAME, REGRESSION_MODEL_GCS, REGRESSION_MODEL_LOCAL)
-        print(f"🔄 Cargando modelo Regresión desde {REGRESSION_MODEL_LOCAL}...")
-        regression_model = joblib.load(REGRESSION_MODEL_LOCAL)
-        print("✅ Modelo Regresión cargado.")
-    return preprocessor_regression, regression_model
+    """Devuelve ((preprocesador, modelo), versiones) de la Regresión."""
+    return load_scoring_models(model_registry.REGRESSION_COMPILED, model_registry.REGRESSION_ARTIFACTS)
 
-def load_user_activity_metrics(db, user_id, now):
-    metrics = {
+def empty_activity_metrics():
+    return {
         "pendingTasks": 0,
         "completedTasks": 0,
         "overdueTasks": 0,
@@ -190,18 +373,36 @@ def load_user_activity_metrics(db, user_id, now):
         "upcomingEvents": 0,
     }
 
+def count_query(query):
+    """Cuenta documentos con una agregación COUNT en el servidor."""
+    result = query.count(alias="total").get()
+    return int(result[0][0].value)
+
+def upcoming_events_query(db, user_id, start, days):
+    """Consulta por rango de 'start' sobre los eventos del usuario."""
+    end = start + datetime.timedelta(days=days) if days is not None else None
+    query = db.collection(f"users/{user_id}/events").where("start", ">=", start)
+    if end is not None:
+        query = query.where("start", "<=", end)
+    return query
+
+def scan_user_activity_metrics(db, user_id, now):
+    """Calcula las métricas recorriendo tareas, hábitos y eventos del usuario."""
+    metrics = empty_activity_metrics()
+
     try:
-        tasks_ref = db.collection(f"users/{user_id}/tasks").stream()
-        for task_doc in tasks_ref:
-            task = task_doc.to_dict() or {}
-            completed = bool(task.get("completed"))
-            if completed:
-                metrics["completedTasks"] += 1
-            else:
-                metrics["pendingTasks"] += 1
-                due_date = normalize_datetime(task.get("dueDate"))
-                if due_date and due_date < now:
-                    metrics["overdueTasks"] += 1
+        # Conteos agregados en el servidor: no se descargan documentos de tareas.
+        # dueDate puede guardarse como Timestamp o como cadena ISO; Firestore
+        # no mezcla tipos en un rango, así que se cuentan ambos por separado.
+        tasks_ref = db.collection(f"users/{user_id}/tasks")
+        pending_ref = tasks_ref.where("completed", "==", False)
+        metrics["completedTasks"] = count_query(tasks_ref.where("completed", "==", True))
+        metrics["pendingTasks"] = count_query(pending_ref)
+        if metrics["pendingTasks"]:
+            metrics["overdueTasks"] = (
+                count_query(pending_ref.where("dueDate", "<", now))
+                + count_query(pending_ref.where("dueDate", ">=", "").where("dueDate", "<", now.isoformat()))
+            )
     except Exception as task_error:
         print(f"WARN: Error cargando tareas para {user_id}: {task_error}")
 
@@ -221,22 +422,206 @@ def load_user_activity_metrics(db, user_id, now):
         print(f"WARN: Error cargando hábitos para {user_id}: {habit_error}")
 
     try:
-        week_ahead = now + datetime.timedelta(days=7)
-        events_ref = db.collection(f"users/{user_id}/events").stream()
+        # Solo se leen los eventos de la ventana [now, now+7d] y solo start/end
+        events_ref = upcoming_events_query(db, user_id, now, days=7).select(["start", "end", SERIES_INSTANCE_FIELD]).stream()
         for event_doc in events_ref:
             event = event_doc.to_dict() or {}
+            if not counts_as_event(event):
+                continue
             start = normalize_datetime(event.get("start"))
             end = normalize_datetime(event.get("end"))
             if not start or not end:
                 continue
-            if start <= week_ahead and start >= now:
+            if start >= now:
                 metrics["upcomingEvents"] += 1
                 metrics["weeklyLoadHours"] += max((end - start).total_seconds() / 3600, 0)
     except Exception as event_error:
         print(f"WARN: Error cargando eventos para {user_id}: {event_error}")
 
+    try:
+        add_series_load(metrics, load_class_series(db, user_id, schedule_expander.SERIES_SCHEDULE_FIELDS), now)
+    except Exception as series_error:
+        print(f"WARN: Error cargando series de clases para {user_id}: {series_error}")
+
     return metrics
 
+# ===============================================================
+#  HELPERS: SERIES DE CLASES (users/{uid}/classSeries)
+# ===============================================================
+# Con storeAs='series' (o IMPORT_STORE_AS=series), importSchedule guarda
+# además un documento por clase semanal (regla, horas, materia y excepciones;
+# ver schedule_expander.py). Las series solo las lee el servidor: el cliente
+# (src/) sigue leyendo las instancias de users/{uid}/events, que se escriben
+# igual en ambos modos. En modo series cada instancia lleva 'seriesId' y el
+# riesgo, el rollup y las alertas la cuentan desde su serie (expandida solo
+# dentro de su ventana), nunca dos veces.
+CLASS_SERIES_COLLECTION = 'classSeries'
+SERIES_INSTANCE_FIELD = 'seriesId'
+IMPORT_STORE_AS = os.environ.get('IMPORT_STORE_AS', 'events').lower()
+
+def class_series_ref(db, user_id):
+    return db.collection(f"users/{user_id}/{CLASS_SERIES_COLLECTION}")
+
+def series_schedule(series):
+    """Parte de la serie que determina sus ocurrencias (la que guarda el rollup)."""
+    return {field: series.get(field) for field in schedule_expander.SERIES_SCHEDULE_FIELDS}
+
+def counts_as_event(event):
+    """Evento que el servidor cuenta como tal (las instancias de una serie se cuentan desde la serie)."""
+    return event is not None and not event.get(SERIES_INSTANCE_FIELD)
+
+def load_class_series(db, user_id, fields=None):
+    query = class_series_ref(db, user_id)
+    if fields:
+        query = query.select(fields)
+    return {series_doc.id: series_doc.to_dict() or {} for series_doc in query.stream()}
+
+def add_series_load(metrics, series_by_id, now):
+    """Suma a las métricas las ocurrencias de las series en [now, now+7d]."""
+    if not series_by_id:
+        return
+    window_start = as_utc(now)
+    window_end = window_start + datetime.timedelta(days=7)
+    for _, event in schedule_expander.expand_series(series_by_id, window_start, window_end):
+        metrics["upcomingEvents"] += 1
+        metrics["weeklyLoadHours"] += max((event["end"] - event["start"]).total_seconds() / 3600, 0)
+
+# ===============================================================
+#  HELPERS: ROLLUP DE ACTIVIDAD POR USUARIO (users/{uid}/stats/activity)
+# ===============================================================
+# El documento se mantiene incrementalmente con triggers de Firestore:
+#   pendingTasks / completedTasks: contadores de tareas.
+#   pendingDue:   {taskId: dueDate} de las tareas pendientes con fecha límite.
+#   habitRates:   {habitId: tasa semanal de cumplimiento}.
+#   upcoming:     {eventId: {start, end}} de los eventos que empiezan dentro
+#                 del horizonte (ACTIVITY_UPCOMING_HORIZON_DAYS, no todo el semestre).
+#   upcomingUntil: fin del horizonte cubierto por la última reconstrucción.
+#   series:       {seriesId: {rrule, dtstart, ...}} horario de cada serie de clases.
+# Las partes que dependen de la hora (vencidas y ventana de 7 días) se
+# evalúan al leer. 'rebuiltAt' solo lo escribe la reconstrucción completa:
+# sin él, el documento se considera incompleto y se reconstruye. También se
+# reconstruye cuando la ventana de 7 días ya pasa de 'upcomingUntil' (el
+# horizonte debe cubrir al menos la ventana más el periodo de reconciliación).
+# 'changedAt' marca el último cambio de actividad (trigger o reconstrucción).
+ACTIVITY_ROLLUP_ENABLED = os.environ.get('ACTIVITY_ROLLUP_ENABLED', 'true').lower() == 'true'
+ACTIVITY_ROLLUP_DOC = 'stats/activity'
+ACTIVITY_WINDOW_DAYS = 7
+ACTIVITY_UPCOMING_HORIZON_DAYS = max(ACTIVITY_WINDOW_DAYS, int(os.environ.get('ACTIVITY_UPCOMING_HORIZON_DAYS', '14')))
+
+def activity_rollup_ref(db, user_id):
+    return db.document(f"users/{user_id}/{ACTIVITY_ROLLUP_DOC}")
+
+def habit_completion_rate(habit):
+    completed_days = habit.get("completedDays") or []
+    return len([day for day in completed_days if day]) / 7
+
+def is_upcoming_event(event, now):
+    """El evento empieza dentro del horizonte del rollup ([now, now+horizonte])."""
+    start = normalize_datetime(event.get("start"))
+    end = normalize_datetime(event.get("end"))
+    horizon = now + datetime.timedelta(days=ACTIVITY_UPCOMING_HORIZON_DAYS)
+    return bool(start and end and now <= start <= horizon)
+
+def rollup_covers_window(rollup, now):
+    """El horizonte de 'upcoming' cubre la ventana de 7 días que empieza en now."""
+    upcoming_until = normalize_datetime(rollup.get("upcomingUntil"))
+    return bool(upcoming_until and upcoming_until >= now + datetime.timedelta(days=ACTIVITY_WINDOW_DAYS))
+
+def build_activity_rollup(db, user_id, now):
+    """Reconstruye el rollup desde cero recorriendo las subcolecciones."""
+    rollup = {
+        "pendingTasks": 0,
+        "completedTasks": 0,
+        "pendingDue": {},
+        "habitRates": {},
+        "upcoming": {},
+        "upcomingUntil": now + datetime.timedelta(days=ACTIVITY_UPCOMING_HORIZON_DAYS),
+        "series": {},
+    }
+
+    tasks_ref = db.collection(f"users/{user_id}/tasks")
+    rollup["completedTasks"] = count_query(tasks_ref.where("completed", "==", True))
+    for task_doc in tasks_ref.where("completed", "==", False).select(["dueDate"]).stream():
+        task = task_doc.to_dict() or {}
+        rollup["pendingTasks"] += 1
+        if task.get("dueDate") is not None:
+            rollup["pendingDue"][task_doc.id] = task.get("dueDate")
+
+    for habit_doc in db.collection(f"users/{user_id}/habits").stream():
+        rollup["habitRates"][habit_doc.id] = habit_completion_rate(habit_doc.to_dict() or {})
+
+    for event_doc in upcoming_events_query(db, user_id, now, days=ACTIVITY_UPCOMING_HORIZON_DAYS).select(["start", "end", SERIES_INSTANCE_FIELD]).stream():
+        event = event_doc.to_dict() or {}
+        if counts_as_event(event) and is_upcoming_event(event, now):
+            rollup["upcoming"][event_doc.id] = {"start": event.get("start"), "end": event.get("end")}
+
+    for series_id, series in load_class_series(db, user_id, schedule_expander.SERIES_SCHEDULE_FIELDS).items():
+        rollup["series"][series_id] = series_schedule(series)
+
+    return rollup
+
+def rebuild_activity_rollup(db, user_id, now):
+    rollup = build_activity_rollup(db, user_id, now)
+    activity_rollup_ref(db, user_id).set({
+        **rollup,
+        "rebuiltAt": firestore.SERVER_TIMESTAMP,
+        "changedAt": firestore.SERVER_TIMESTAMP,
+    })
+    return rollup
+
+def metrics_from_rollup(rollup, now):
+    """Devuelve (métricas, ids de eventos ya pasados que pueden purgarse)."""
+    metrics = empty_activity_metrics()
+    metrics["pendingTasks"] = max(int(rollup.get("pendingTasks") or 0), 0)
+    metrics["completedTasks"] = max(int(rollup.get("completedTasks") or 0), 0)
+
+    for due_value in (rollup.get("pendingDue") or {}).values():
+        due_date = normalize_datetime(due_value)
+        if due_date and due_date < now:
+            metrics["overdueTasks"] += 1
+
+    habit_rates = list((rollup.get("habitRates") or {}).values())
+    if habit_rates:
+        metrics["habitCompletionRate"] = sum(habit_rates) / len(habit_rates)
+
+    week_ahead = now + datetime.timedelta(days=ACTIVITY_WINDOW_DAYS)
+    expired = []
+    for event_id, event in (rollup.get("upcoming") or {}).items():
+        start = normalize_datetime((event or {}).get("start"))
+        end = normalize_datetime((event or {}).get("end"))
+        if not start or not end or start < now:
+            expired.append(event_id)
+            continue
+        if start <= week_ahead:
+            metrics["upcomingEvents"] += 1
+            metrics["weeklyLoadHours"] += max((end - start).total_seconds() / 3600, 0)
+
+    add_series_load(metrics, rollup.get("series"), now)
+    return metrics, expired
+
+def load_user_activity_metrics(db, user_id, now):
+    if not ACTIVITY_ROLLUP_ENABLED:
+        return scan_user_activity_metrics(db, user_id, now)
+
+    try:
+        rollup_ref = activity_rollup_ref(db, user_id)
+        rollup_doc = rollup_ref.get()
+        rollup = rollup_doc.to_dict() if rollup_doc.exists else None
+        if not rollup or not rollup.get("rebuiltAt"):
+            print(f"🔄 Rollup de actividad ausente para {user_id}, reconstruyendo...")
+            rollup = rebuild_activity_rollup(db, user_id, now)
+        elif not rollup_covers_window(rollup, now):
+            print(f"🔄 Rollup de actividad de {user_id} no cubre la ventana actual, reconstruyendo...")
+            rollup = rebuild_activity_rollup(db, user_id, now)
+
+        metrics, expired = metrics_from_rollup(rollup, now)
+        if expired:
+            rollup_ref.set({"upcoming": {event_id: firestore.DELETE_FIELD for event_id in expired}}, merge=True)
+        return metrics
+    except Exception as rollup_error:
+        print(f"WARN: Error leyendo rollup de actividad para {user_id}: {rollup_error}. Usando escaneo completo.")
+        return scan_user_activity_metrics(db, user_id, now)
+
 def build_risk_factors(metrics):
     factors = []
     adjustment = 0.0
@@ -282,33 +667,107 @@ def build_risk_factors(metrics):
 
     return factors, adjustment
 
-def calculate_risk_for_user(db, user_id, user_data, now):
+def missing_feature_columns(row, feature_names):
+    """Columnas requeridas por el modelo que faltan (o son nulas/NaN) en la fila."""
+    missing = []
+    for col in feature_names:
+        value = row.get(col)
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            missing.append(col)
+    return missing
+
+def load_scoring_models(compiled_names, sklearn_names):
+    """
+    Devuelve ((preprocesador, modelo), versiones). Si el modelo compilado
+    solo-numpy está publicado se usa para ambos papeles; si no, los .pkl de
+    sklearn.
+    """
+    if model_registry.MODEL_COMPILED_SCORING:
+        compiled = model_registry.get_optional_models_with_version(compiled_names)
+        if compiled is not None:
+            (scorer,), model_version = compiled
+            return (scorer, scorer), model_version
+    return model_registry.get_models_with_version(sklearn_names)
+
+def build_model_input(preprocessor, rows):
+    """El modelo compilado acepta dicts; sklearn necesita un DataFrame."""
+    if isinstance(preprocessor, compiled_models.CompiledPipeline):
+        return rows
     import pandas as pd
+    return pd.DataFrame(rows, columns=list(preprocessor.feature_names_in_))
 
-    profile_es = user_data.get("onboardingData")
-    if not isinstance(profile_es, dict):
-        raise ValueError("Perfil incompleto: onboardingData no disponible.")
+def run_batched_inference(preprocessor, method, rows):
+    """
+    Ejecuta un único transform + método del modelo (predict / predict_proba)
+    sobre todas las filas. Si el lote falla (ej. categoría desconocida) se
+    repite fila a fila. Devuelve una lista de (resultado, error) por fila.
+    """
+    try:
+        outputs = method(preprocessor.transform(build_model_input(preprocessor, rows)))
+        return [(output, None) for output in outputs]
+    except Exception as batch_error:
+        print(f"WARN: Fallo en inferencia por lote ({len(rows)} filas): {batch_error}. Reintentando por fila...")
 
-    preprocessor, model = load_regression_models()
-    profile_en = translate_keys(profile_es)
-    if not profile_en:
-        raise ValueError("Error traduciendo datos del perfil.")
+    results = []
+    for row in rows:
+        try:
+            results.append((method(preprocessor.transform(build_model_input(preprocessor, [row])))[0], None))
+        except Exception as row_error:
+            results.append((None, f"Error en inferencia: {row_error}"))
+    return results
 
-    df = pd.DataFrame([profile_en])
+def translate_profiles(profiles, feature_names):
+    """
+    Traduce y valida perfiles (lista de (user_id, onboardingData)). Devuelve
+    (ids_validos, filas, errores_por_usuario); una fila inválida no invalida
+    el lote.
+    """
+    valid_ids = []
+    rows = []
+    errors = {}
+    for user_id, profile_es in profiles:
+        if not isinstance(profile_es, dict):
+            errors[user_id] = "Perfil incompleto: onboardingData no disponible."
+            continue
+        profile_en = translate_keys(profile_es)
+        if not profile_en:
+            errors[user_id] = "Error traduciendo datos del perfil."
+            continue
+        missing_cols = missing_feature_columns(profile_en, feature_names)
+        if missing_cols:
+            errors[user_id] = f"Faltan datos del perfil: {', '.join(missing_cols)}"
+            continue
+        valid_ids.append(user_id)
+        rows.append(profile_en)
+    return valid_ids, rows, errors
+
+def predict_base_risks(profiles):
+    """
+    Calcula el riesgo base (probabilidad de no aprobar) para un lote de perfiles
+    con un único transform/predict_proba. Devuelve (riesgos, errores,
+    versión_modelo); riesgos y errores están indexados por user_id.
+    """
+    (preprocessor, model), model_version = load_regression_models()
     try:
         cols = preprocessor.feature_names_in_
     except AttributeError:
         raise RuntimeError("El preprocesador de Regresión no tiene 'feature_names_in_'.")
 
-    df = df.reindex(columns=cols, fill_value=None)
-    if df.isnull().values.any():
-        missing_cols = df.columns[df.isnull().any()].tolist()
-        raise ValueError(f"Faltan datos del perfil: {', '.join(missing_cols)}")
+    valid_ids, rows, errors = translate_profiles(profiles, cols)
+    risks = {}
+    if not valid_ids:
+        return risks, errors, model_version
+
+    for user_id, (row_probs, error) in zip(valid_ids, run_batched_inference(preprocessor, model.predict_proba, rows)):
+        if error:
+            errors[user_id] = error
+        else:
+            risks[user_id] = float(row_probs[0])
 
-    processed_data = preprocessor.transform(df)
-    probs = model.predict_proba(processed_data)
-    base_risk = float(probs[0][0])
+    return risks, errors, model_version
 
+def build_risk_result(db, user_id, base_risk, now, model_version=None):
+    """Combina el riesgo base con las métricas de actividad del usuario."""
     metrics = load_user_activity_metrics(db, user_id, now)
     factors, adjustment = build_risk_factors(metrics)
     final_risk = clamp(base_risk + adjustment)
@@ -318,18 +777,119 @@ def calculate_risk_for_user(db, user_id, user_data, now):
         "baseRisk": base_risk,
         "factors": factors,
         "metrics": metrics,
+        "modelVersion": model_version,
     }
 
+def calculate_risk_for_user(db, user_id, user_data, now):
+    risks, errors, model_version = predict_base_risks([(user_id, user_data.get("onboardingData"))])
+    if user_id in errors:
+        raise ValueError(errors[user_id])
+    return build_risk_result(db, user_id, risks[user_id], now, model_version)
+
+# ===============================================================
+#  HELPERS: PREDICCIÓN K-MEANS POR LOTES
+# ===============================================================
+# PROFILE_BATCH_MAX_ITEMS: máximo de cuestionarios por petición.
+# PROFILE_BATCH_CHUNK_SIZE: filas por inferencia vectorizada; al responder en
+# streaming (JSONL) se emite un chunk de resultados en cuanto está listo.
+PROFILE_BATCH_MAX_ITEMS = int(os.environ.get('PROFILE_BATCH_MAX_ITEMS', '5000'))
+PROFILE_BATCH_CHUNK_SIZE = int(os.environ.get('PROFILE_BATCH_CHUNK_SIZE', '500'))
+JSONL_MIME_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines')
+
+def is_jsonl_request(req):
+    return (req.mimetype or '').lower() in JSONL_MIME_TYPES
+
+def parse_profile_batch(req):
+    """
+    Devuelve la lista de cuestionarios de una petición por lotes, o None si
+    la petición es individual ({'data': {...}}). Acepta {'items': [...]}, una
+    lista JSON de cuestionarios o un cuerpo JSONL (una línea por cuestionario).
+    """
+    if is_jsonl_request(req):
+        items = []
+        for line_no, line in enumerate(req.get_data(as_text=True).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as line_error:
+                # Se conserva la posición para reportar el error por elemento
+                items.append(ValueError(f"Línea {line_no}: JSON inválido ({line_error.msg})."))
+    else:
+        if not req.is_json:
+            raise ValueError("La solicitud debe ser JSON.")
+        req_json = req.get_json()
+        if isinstance(req_json, list):
+            items = req_json
+        elif not isinstance(req_json, dict):
+            raise ValueError("El cuerpo JSON debe ser un objeto o una lista de cuestionarios.")
+        elif 'items' not in req_json:
+            return None
+        else:
+            items = req_json.get('items')
+            if not isinstance(items, list):
+                raise ValueError("El campo 'items' debe ser una lista.")
+
+    if len(items) > PROFILE_BATCH_MAX_ITEMS:
+        raise ValueError(f"Demasiados elementos: {len(items)} (máximo {PROFILE_BATCH_MAX_ITEMS}).")
+    return items
+
+def cluster_profile_chunk(preprocessor, model, items, offset):
+    """Valida, traduce y agrupa un chunk de cuestionarios con una sola inferencia."""
+    cols = preprocessor.feature_names_in_
+    results = [None] * len(items)
+    valid_pos = []
+    rows = []
+
+    for pos, item in enumerate(items):
+        result = {'index': offset + pos}
+        if isinstance(item, dict) and 'id' in item:
+            result['id'] = item['id']
+        results[pos] = result
+
+        if isinstance(item, Exception):
+            result['error'] = str(item)
+            continue
+        data_es = item.get('data') if isinstance(item, dict) and isinstance(item.get('data'), dict) else item
+        if not isinstance(data_es, dict):
+            result['error'] = "El elemento no es un objeto JSON."
+            continue
+        data_en = translate_keys(data_es)
+        if not data_en:
+            result['error'] = "Error traduciendo datos o datos vacíos."
+            continue
+        missing_cols = missing_feature_columns(data_en, cols)
+        if missing_cols:
+            result['error'] = f"Faltan datos del formulario: {', '.join(missing_cols)}"
+            continue
+        valid_pos.append(pos)
+        rows.append(data_en)
+
+    if rows:
+        for pos, (cluster, error) in zip(valid_pos, run_batched_inference(preprocessor, model.predict, rows)):
+            if error:
+                results[pos]['error'] = error
+            else:
+                results[pos]['cluster'] = int(cluster)
+    return results
+
+def cluster_profile_batch(preprocessor, model, items):
+    """Generador de listas de resultados, un chunk a la vez."""
+    chunk_size = max(1, PROFILE_BATCH_CHUNK_SIZE)
+    for offset in range(0, len(items), chunk_size):
+        yield cluster_profile_chunk(preprocessor, model, items[offset:offset + chunk_size], offset)
+
 # ===============================================================
 #  FUNCIÓN 1: PREDECIR PERFIL DE ESTUDIANTE (K-MEANS)
 # ===============================================================
 @https_fn.on_request(memory=512)
 def predict_student_profile(req: https_fn.Request) -> https_fn.Response:
-    """Recibe datos del cuestionario (JSON), predice clúster K-Means y devuelve JSON."""
-    import joblib
-    import pandas as pd
-    global preprocessor_kmeans, kmeans_model
-
+    """
+    Recibe datos del cuestionario (JSON), predice clúster K-Means y devuelve JSON.
+    Modo por lotes: {'items': [...]}, una lista JSON o cuerpo JSONL; devuelve
+    un resultado o un error por elemento (en JSONL y en streaming si la
+    entrada es JSONL o se pide ?stream=true).
+    """
     headers = get_cors_headers(req.headers.get('Origin', ''))
 
     if req.method == 'OPTIONS':
@@ -338,45 +898,53 @@ def predict_student_profile(req: https_fn.Request) -> https_fn.Response:
     headers['Content-Type'] = 'application/json'
 
     # --- Verificar token de autenticación ---
-    try:
-        auth_header = req.headers.get('authorization', '')
-        parts = auth_header.split(None, 1)
-        if len(parts) != 2 or parts[0].lower() != 'bearer':
-            raise ValueError("Token faltante o formato inválido (Bearer).")
-        decoded_token = auth.verify_id_token(parts[1].strip())
-        _ = decoded_token['uid']
-    except Exception as auth_err:
-        return https_fn.Response(
-            json.dumps({'error': f'Token inválido o expirado: {str(auth_err)}'}),
-            status=401, headers=headers
-        )
-    # --- Fin autenticación ---
+    decoded_token, auth_response = authenticate_request(req, headers)
+    if auth_response is not None:
+        return auth_response
 
-    # --- Carga perezosa de modelos desde GCS ---
+    # --- Modelos K-Means (precargados al arrancar o carga perezosa) ---
     try:
-        if preprocessor_kmeans is None:
-            if not os.path.exists(KMEANS_PREPROCESSOR_LOCAL):
-                download_blob(GCS_BUCKET_NAME, KMEANS_PREPROCESSOR_GCS, KMEANS_PREPROCESSOR_LOCAL)
-            print(f"🔄 Cargando preprocesador K-Means desde {KMEANS_PREPROCESSOR_LOCAL}...")
-            preprocessor_kmeans = joblib.load(KMEANS_PREPROCESSOR_LOCAL)
-            print("✅ Preprocesador K-Means cargado.")
-        
-        if kmeans_model is None:
-            if not os.path.exists(KMEANS_MODEL_LOCAL):
-                download_blob(GCS_BUCKET_NAME, KMEANS_MODEL_GCS, KMEANS_MODEL_LOCAL)
-            print(f"🔄 Cargando modelo K-Means desde {KMEANS_MODEL_LOCAL}...")
-            kmeans_model = joblib.load(KMEANS_MODEL_LOCAL)
-            print("✅ Modelo K-Means cargado.")
+        (preprocessor_kmeans, kmeans_model), model_version = load_scoring_models(
+            model_registry.KMEANS_COMPILED, model_registry.KMEANS_ARTIFACTS
+        )
     except Exception as e:
         print(f"❌ Error crítico K-Means (descarga/carga): {e}")
         traceback.print_exc()
         return https_fn.Response(json.dumps({'error': f"Error interno K-Means (carga): {str(e)}"}), status=500, headers=headers)
 
+    # --- Modo por lotes ---
+    try:
+        batch_items = parse_profile_batch(req)
+    except Exception as e:
+        print(f"❌ Error leyendo lote K-Means: {e}")
+        return https_fn.Response(json.dumps({'error': f"Error K-Means (lote): {str(e)}"}), status=400, headers=headers)
+
+    if batch_items is not None:
+        print(f"📦 Lote K-Means recibido: {len(batch_items)} elementos.")
+        stream = is_jsonl_request(req) or req.args.get('stream', '').lower() == 'true'
+        if stream:
+            def generate():
+                failed = 0
+                for chunk in cluster_profile_batch(preprocessor_kmeans, kmeans_model, batch_items):
+                    failed += sum(1 for result in chunk if 'error' in result)
+                    yield ''.join(json.dumps(result) + '\n' for result in chunk)
+                yield json.dumps({'summary': {'processed': len(batch_items), 'failed': failed, 'modelVersion': model_version}}) + '\n'
+
+            stream_headers = {**headers, 'Content-Type': 'application/x-ndjson'}
+            return https_fn.Response(generate(), status=200, headers=stream_headers)
+
+        results = [result for chunk in cluster_profile_batch(preprocessor_kmeans, kmeans_model, batch_items) for result in chunk]
+        failed = sum(1 for result in results if 'error' in result)
+        print(f"✅ Lote K-Means procesado: {len(results)} elementos, {failed} con error.")
+        return https_fn.Response(json.dumps({
+            'results': results,
+            'processed': len(results),
+            'failed': failed,
+            'modelVersion': model_version,
+        }), headers=headers, status=200)
+
     # --- Procesamiento de la solicitud ---
     try:
-        if not req.is_json: 
-            raise ValueError("La solicitud debe ser JSON.")
-        
         req_json = req.get_json()
         data_es = req_json.get('data')
         
@@ -387,32 +955,28 @@ def predict_student_profile(req: https_fn.Request) -> https_fn.Response:
         if not data_en: 
             raise ValueError("Error traduciendo datos o datos vacíos.")
         
-        df = pd.DataFrame([data_en])
-
         try: 
             kmeans_cols = preprocessor_kmeans.feature_names_in_
         except AttributeError: 
             raise RuntimeError("El preprocesador K-Means no tiene 'feature_names_in_'. Revisa el archivo .pkl.")
 
-        df = df.reindex(columns=kmeans_cols, fill_value=None)
-
         # --- CORRECCIÓN 2.1: Validación de Nulos en el Backend ---
         # El frontend debe validar con 'required', pero esta es la
         # validación de seguridad del servidor.
-        if df.isnull().values.any():
-            missing_cols = df.columns[df.isnull().any()].tolist()
+        missing_cols = missing_feature_columns(data_en, kmeans_cols)
+        if missing_cols:
             print(f"ERROR K-Means: Nulos encontrados en columnas: {missing_cols}.")
             # Lanzamos un error que será enviado al usuario como 400 Bad Request
             raise ValueError(f"Faltan datos del formulario: {', '.join(missing_cols)}")
         # --- Fin CORRECCIÓN 2.1 ---
 
-        data_processed = preprocessor_kmeans.transform(df)
+        data_processed = preprocessor_kmeans.transform(build_model_input(preprocessor_kmeans, [data_en]))
         cluster = kmeans_model.predict(data_processed)
         predicted_cluster = int(cluster[0])
 
         print(f"Cluster predicho: {predicted_cluster}")
 
-        return https_fn.Response(json.dumps({'cluster': predicted_cluster}), headers=headers, status=200)
+        return https_fn.Response(json.dumps({'cluster': predicted_cluster, 'modelVersion': model_version}), headers=headers, status=200)
 
     except Exception as e:
         print(f"❌ Error en predicción K-Means: {e}")
@@ -420,10 +984,532 @@ def predict_student_profile(req: https_fn.Request) -> https_fn.Response:
         status = 400 if isinstance(e, (ValueError, KeyError, RuntimeError, AttributeError)) else 500
         return https_fn.Response(json.dumps({'error': f"Error K-Means (predicción): {str(e)}"}), status=status, headers=headers)
 
+# ===============================================================
+#  HELPERS: PAGINACIÓN DE USUARIOS Y CHECKPOINTS DE JOBS
+# ===============================================================
+JOBS_COLLECTION = 'jobs'
+
+def iter_onboarded_user_pages(db, page_size, start_after_id=None, id_range=(None, None)):
+    """
+    Recorre los usuarios con onboarding completo en páginas ordenadas por id
+    (cursor start_after), en lugar de un único stream de larga duración.
+    id_range=(desde, hasta) acota la consulta a los ids desde <= id < hasta
+    (None = sin límite), de modo que cada shard solo lee sus propios usuarios.
+    """
+    users_ref = db.collection('users')
+    range_start, range_end = id_range
+    cursor = start_after_id
+    while True:
+        query = users_ref.where('onboardingComplete', '==', True)
+        if range_start is not None:
+            query = query.where('__name__', '>=', users_ref.document(range_start))
+        if range_end is not None:
+            query = query.where('__name__', '<', users_ref.document(range_end))
+        query = query.order_by('__name__').limit(page_size)
+        if cursor:
+            query = query.start_after({'__name__': users_ref.document(cursor)})
+        page = list(query.stream())
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        cursor = page[-1].id
+
+def job_checkpoint_ref(db, job_name):
+    return db.collection(JOBS_COLLECTION).document(job_name)
+
+# ===============================================================
+#  HELPERS: EJECUCIÓN CONCURRENTE Y POR SHARDS DEL ANÁLISIS NOCTURNO
+# ===============================================================
+# RISK_JOB_CONCURRENCY: número máximo de usuarios procesados en paralelo.
+# RISK_JOB_SHARD_COUNT: reparte la población entre varias invocaciones. Con
+# más de un shard, la función programada solo despacha una tarea por shard
+# (el índice del shard va en el payload de la tarea) y cada shard corre en su
+# propia invocación de continueRiskAnalysis con su propio checkpoint. Con un
+# solo shard se procesa todo en la invocación programada.
+RISK_JOB_CONCURRENCY = int(os.environ.get('RISK_JOB_CONCURRENCY', '16'))
+RISK_JOB_SHARD_COUNT = max(1, int(os.environ.get('RISK_JOB_SHARD_COUNT', '1')))
+# Número de perfiles que se puntúan juntos en un único predict_proba
+RISK_JOB_BATCH_SIZE = int(os.environ.get('RISK_JOB_BATCH_SIZE', '2000'))
+# Usuarios por página (cursor start_after); el checkpoint se guarda por página
+RISK_JOB_PAGE_SIZE = int(os.environ.get('RISK_JOB_PAGE_SIZE', '500'))
+# Modo incremental: el riesgo base solo depende del cuestionario, así que solo
+# se vuelve a inferir si cambió el perfil (riskProfileHash) o el modelo; al
+# resto se le recalculan desde el rollup las partes que dependen de la
+# actividad y del tiempo. RISK_JOB_FULL_SWEEP_WEEKDAY (0=lunes ... 6=domingo, vacío=nunca)
+# fija el día en que se hace el barrido completo de seguridad.
+RISK_JOB_INCREMENTAL = os.environ.get('RISK_JOB_INCREMENTAL', 'true').lower() == 'true'
+RISK_JOB_FULL_SWEEP_WEEKDAY = os.environ.get('RISK_JOB_FULL_SWEEP_WEEKDAY', '6')
+RISK_ALERT_TEXT = "He notado que podrías estar en riesgo de no cumplir con tus próximos objetivos. ¿Revisamos tu plan de estudio?"
+
+# Los shards son rangos contiguos de ids de documento: el espacio de prefijos
+# de dos caracteres del alfabeto de los uid de Firebase Auth (en el orden en
+# que Firestore compara los ids) se divide en RISK_JOB_SHARD_COUNT tramos
+# iguales. Así cada shard filtra en la consulta y no lee los usuarios de los
+# demás.
+USER_ID_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+USER_ID_PREFIX_SPACE = len(USER_ID_ALPHABET) ** 2
+
+def user_id_prefix(position):
+    high, low = divmod(position, len(USER_ID_ALPHABET))
+    return USER_ID_ALPHABET[high] + USER_ID_ALPHABET[low]
+
+def shard_id_range(shard_index, shard_count):
+    """(desde, hasta) de los ids del shard; None en los extremos abiertos."""
+    if shard_index is None or shard_count <= 1:
+        return None, None
+    range_start = user_id_prefix(shard_index * USER_ID_PREFIX_SPACE // shard_count) if shard_index > 0 else None
+    range_end = user_id_prefix((shard_index + 1) * USER_ID_PREFIX_SPACE // shard_count) if shard_index < shard_count - 1 else None
+    return range_start, range_end
+
+def user_shard(user_id, shard_count):
+    """Shard (rango de ids, ver shard_id_range) al que pertenece un user_id."""
+    if shard_count <= 1:
+        return 0
+    boundaries = [shard_id_range(index, shard_count)[0] for index in range(1, shard_count)]
+    return bisect.bisect_right(boundaries, user_id)
+
+def new_shard_stats():
+    return {
+        "processed": 0,
+        "errors": 0,
+        "alerts": 0,
+        "skipped": 0,
+        "refreshed": 0,
+        "rescored": 0,
+        "writeErrors": 0,
+        "latencyTotal": 0.0,
+        "latencyMax": 0.0,
+        "startedAt": time.monotonic(),
+        "finishedAt": None,
+    }
+
+def record_shard_result(stats, lock, shard, elapsed, ok, alert, outcome=None):
+    with lock:
+        shard_stats = stats.setdefault(shard, new_shard_stats())
+        if ok:
+            shard_stats["processed"] += 1
+            if outcome:
+                shard_stats[outcome] += 1
+        else:
+            shard_stats["errors"] += 1
+        if alert:
+            shard_stats["alerts"] += 1
+        shard_stats["latencyTotal"] += elapsed
+        shard_stats["latencyMax"] = max(shard_stats["latencyMax"], elapsed)
+        shard_stats["finishedAt"] = time.monotonic()
+
+def record_write_error(stats, lock, shard):
+    with lock:
+        stats.setdefault(shard, new_shard_stats())["writeErrors"] += 1
+
+def format_shard_summary(stats):
+    lines = []
+    for shard in sorted(stats):
+        shard_stats = stats[shard]
+        handled = shard_stats["processed"] + shard_stats["errors"]
+        wall = max((shard_stats["finishedAt"] or shard_stats["startedAt"]) - shard_stats["startedAt"], 1e-6)
+        avg_latency = shard_stats["latencyTotal"] / handled if handled else 0.0
+        lines.append(
+            f"   Shard {shard}: procesados={shard_stats['processed']} (omitidos={shard_stats['skipped']}, "
+            f"refrescados={shard_stats['refreshed']}, re-puntuados={shard_stats['rescored']}), errores={shard_stats['errors']}, "
+            f"escrituras fallidas={shard_stats['writeErrors']}, "
+            f"alertas={shard_stats['alerts']}, throughput={handled / wall:.2f} usuarios/s, "
+            f"latencia media={avg_latency * 1000:.0f}ms, latencia máx={shard_stats['latencyMax'] * 1000:.0f}ms"
+        )
+    return "\n".join(lines)
+
+def profile_hash(profile):
+    """Huella estable del cuestionario para detectar cambios de perfil."""
+    return hashlib.md5(json.dumps(profile, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def needs_full_rescore(user_data, model_version):
+    """True si hay que volver a inferir el riesgo base del usuario."""
+    updated_at = normalize_datetime(user_data.get('riskUpdatedAt'))
+    if updated_at is None or user_data.get('riskBaseScore') is None:
+        return True
+    if user_data.get('riskModelVersion') != model_version:
+        return True
+    return user_data.get('riskProfileHash') != profile_hash(user_data.get('onboardingData'))
+
+def is_full_sweep_day(now=None):
+    if not RISK_JOB_FULL_SWEEP_WEEKDAY.strip():
+        return False
+    now = now or datetime.datetime.now(pytz.timezone('America/Mexico_City'))
+    return now.weekday() == int(RISK_JOB_FULL_SWEEP_WEEKDAY)
+
+def plan_risk_alert(db, user_id, user_data, risk_score):
+    """
+    Decide si hay que crear la alerta de riesgo a partir del flag
+    openRiskAlert del documento del usuario (sin consultar recommendations).
+    Devuelve (campos a añadir al documento del usuario, (ref, datos) de la
+    alerta o None). El id de la alerta es determinista (risk_alert_<n>) para
+    que dos ejecuciones solapadas escriban el mismo documento.
+    """
+    if risk_score <= alert_rules.get_rules(db).threshold('riskAlert') or user_data.get('openRiskAlert'):
+        return {}, None
+
+    recommendations_ref = db.collection(f'users/{user_id}/recommendations')
+    if 'openRiskAlert' not in user_data:
+        # Usuarios anteriores al flag: se consulta una sola vez y se rellena
+        existing_alert_query = recommendations_ref.where('type', '==', 'risk_alert').where('viewed', '==', False).limit(1)
+        existing_alerts = list(existing_alert_query.stream())
+        if existing_alerts:
+            return {'openRiskAlert': True, 'openRiskAlertId': existing_alerts[0].id}, None
+
+    alert_number = int(user_data.get('riskAlertCount') or 0) + 1
+    alert_id = f'risk_alert_{alert_number}'
+    user_fields = {'openRiskAlert': True, 'openRiskAlertId': alert_id, 'riskAlertCount': alert_number}
+    alert = (recommendations_ref.document(alert_id), {
+        'text': RISK_ALERT_TEXT,
+        'type': 'risk_alert',
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'viewed': False
+    })
+    return user_fields, alert
+
+def write_user_risk(db, writer, user_id, user_data, update, risk_score):
+    """
+    Encola la actualización del riesgo y, si procede, la alerta en un mismo
+    batch: el flag y la alerta se escriben (o fallan) juntos. Con update
+    vacío solo se escribe la alerta (si toca). Devuelve True si generó alerta.
+    """
+    user_fields, alert = plan_risk_alert(db, user_id, user_data, risk_score)
+    if not update and not user_fields:
+        return False
+    with writer.group():
+        writer.update(db.collection('users').document(user_id), {**update, **user_fields}, kind='risk', key=user_id)
+        if alert is not None:
+            writer.set(alert[0], alert[1], kind='alerts', key=user_id)
+    if alert is not None:
+        print(f"⚠️ Alerta de riesgo generada para {user_id}.")
+    return alert is not None
+
+def process_user_risk(db, writer, user_id, user_data, base_risk, model_version=None):
+    """
+    Completa el riesgo de un usuario y encola su escritura (y la alerta) en
+    el writer por lotes. Devuelve True si generó alerta.
+    """
+    now = datetime.datetime.now()
+    risk_result = build_risk_result(db, user_id, base_risk, now, model_version)
+
+    update = {
+        'riskScore': risk_result["riskScore"],
+        'riskBaseScore': risk_result["baseRisk"],
+        'riskFactors': risk_result["factors"],
+        'riskMetrics': risk_result["metrics"],
+        'riskModelVersion': risk_result["modelVersion"],
+        'riskProfileHash': profile_hash(user_data.get('onboardingData')),
+        'riskUpdatedAt': firestore.SERVER_TIMESTAMP
+    }
+
+    print(f"Usuario {user_id} - Riesgo final: {risk_result['riskScore']:.2f}")
+    queue_alert_feed(db, writer, user_id, risk_result["riskScore"])
+    return write_user_risk(db, writer, user_id, user_data, update, risk_result["riskScore"])
+
+def refresh_user_risk(db, writer, user_id, user_data):
+    """
+    Recalcula solo la parte del riesgo que depende del tiempo (tareas vencidas,
+    ventana de 7 días) reutilizando el riesgo base guardado. Si el resultado no
+    cambia no se reescribe el riesgo, pero sí el feed de alertas y la alerta de
+    riesgo si el usuario ya cerró la anterior. Devuelve (cambió, generó_alerta).
+    """
+    now = datetime.datetime.now()
+    metrics = load_user_activity_metrics(db, user_id, now)
+    factors, adjustment = build_risk_factors(metrics)
+    risk_score = clamp(user_data['riskBaseScore'] + adjustment)
+
+    queue_alert_feed(db, writer, user_id, risk_score)
+    if metrics == user_data.get('riskMetrics') and risk_score == user_data.get('riskScore'):
+        return False, write_user_risk(db, writer, user_id, user_data, {}, risk_score)
+
+    update = {
+        'riskScore': risk_score,
+        'riskFactors': factors,
+        'riskMetrics': metrics,
+        'riskUpdatedAt': firestore.SERVER_TIMESTAMP
+    }
+    print(f"Usuario {user_id} - Riesgo refrescado: {risk_score:.2f}")
+    return True, write_user_risk(db, writer, user_id, user_data, update, risk_score)
+
+def run_risk_analysis(db, shard_index=None, shard_count=1, concurrency=RISK_JOB_CONCURRENCY, batch_size=RISK_JOB_BATCH_SIZE,
+                      incremental=False, page_size=RISK_JOB_PAGE_SIZE, start_after_id=None, on_page=None):
+    """
+    Recorre por páginas (cursor start_after) los usuarios con onboarding
+    completo y calcula su riesgo. Los perfiles se acumulan en lotes que se
+    puntúan con una sola inferencia; las métricas de actividad y la escritura
+    se reparten en un pool acotado de hilos. Si shard_index no es None, la
+    consulta se acota al rango de ids de ese shard (ver shard_id_range). Con
+    incremental=True los usuarios limpios (ver needs_full_rescore) solo se
+    refrescan. Los resultados y las
+    alertas se escriben con un ChunkedBatchWriter; las escrituras fallidas se
+    cuentan como 'writeErrors' en el shard del usuario.
+
+    Tras terminar cada página (con sus escrituras confirmadas) se llama a on_page(cursor, stats); si devuelve
+    False el recorrido se detiene. Devuelve (contadores por shard, último
+    cursor, True si se recorrieron todas las páginas).
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    # Cargar modelos antes de lanzar los hilos para no descargarlos en paralelo
+    _, current_version = load_regression_models()
+
+    concurrency = max(1, concurrency)
+    batch_size = max(1, batch_size)
+    stats = {}
+    stats_lock = threading.Lock()
+    # Limita las tareas en vuelo para no acumular toda la página en memoria
+    in_flight = threading.BoundedSemaphore(concurrency * 2)
+
+    def worker(user_id, user_data, base_risk, model_version, shard):
+        started = time.monotonic()
+        ok = False
+        alert = False
+        try:
+            alert = process_user_risk(db, writer, user_id, user_data, base_risk, model_version)
+            ok = True
+        except Exception as inner_e:
+            print(f"❌ Error procesando usuario {user_id} (Regresión): {inner_e}")
+            traceback.print_exc(limit=1)
+        finally:
+            record_shard_result(stats, stats_lock, shard, time.monotonic() - started, ok, alert, 'rescored')
+            in_flight.release()
+
+    def refresh_worker(user_id, user_data, shard):
+        started = time.monotonic()
+        ok = False
+        changed = False
+        alert = False
+        try:
+            changed, alert = refresh_user_risk(db, writer, user_id, user_data)
+            ok = True
+        except Exception as inner_e:
+            print(f"❌ Error refrescando usuario {user_id} (Regresión): {inner_e}")
+            traceback.print_exc(limit=1)
+        finally:
+            outcome = 'refreshed' if changed else 'skipped'
+            record_shard_result(stats, stats_lock, shard, time.monotonic() - started, ok, alert, outcome)
+            in_flight.release()
+
+    def submit(executor, fn, *args):
+        in_flight.acquire()
+        return executor.submit(fn, *args)
+
+    def flush(batch, executor):
+        started = time.monotonic()
+        risks, errors, model_version = predict_base_risks([(user_id, user_data['onboardingData']) for user_id, user_data, _ in batch])
+        print(f"🧮 Lote de {len(batch)} perfiles puntuado en {(time.monotonic() - started) * 1000:.0f}ms ({len(errors)} inválidos).")
+        futures = []
+        for user_id, user_data, shard in batch:
+            if user_id in errors:
+                print(f"❌ Perfil inválido para {user_id} (Regresión): {errors[user_id]}")
+                record_shard_result(stats, stats_lock, shard, 0.0, False, False)
+                continue
+            futures.append(submit(executor, worker, user_id, user_data, risks[user_id], model_version, shard))
+        return futures
+
+    def process_page(page, executor):
+        futures = []
+        batch = []
+        for user_doc in page:
+            user_id = user_doc.id
+            shard = user_shard(user_id, shard_count)
+
+            user_data = user_doc.to_dict()
+            if not isinstance(user_data, dict) or not user_data.get('onboardingComplete'):
+                continue
+            if not isinstance(user_data.get('onboardingData'), dict):
+                continue
+
+            if incremental and not needs_full_rescore(user_data, current_version):
+                futures.append(submit(executor, refresh_worker, user_id, user_data, shard))
+                continue
+
+            batch.append((user_id, user_data, shard))
+            if len(batch) >= batch_size:
+                futures.extend(flush(batch, executor))
+                batch = []
+
+        if batch:
+            futures.extend(flush(batch, executor))
+        # La página se da por terminada solo cuando todos sus usuarios se han escrito
+        wait(futures)
+        summary = writer.drain()
+        for item in summary['failedItems'][len(reported_failures):]:
+            print(f"❌ Escritura fallida ({item['kind']}) para {item['key']}: {item['error']}")
+            record_write_error(stats, stats_lock, user_shard(item['key'], shard_count))
+        reported_failures[:] = summary['failedItems']
+
+    cursor = start_after_id
+    id_range = shard_id_range(shard_index, shard_count)
+    reported_failures = []
+    writer = ChunkedBatchWriter(db, label='risk')
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='risk') as executor:
+            for page in iter_onboarded_user_pages(db, page_size, start_after_id, id_range):
+                process_page(page, executor)
+                cursor = page[-1].id
+                if on_page is not None and on_page(cursor, stats) is False:
+                    return stats, cursor, False
+    finally:
+        writer.close()
+
+    return stats, cursor, True
+
+# ===============================================================
+#  HELPERS: CHECKPOINT Y CONTINUACIÓN DEL ANÁLISIS NOCTURNO
+# ===============================================================
+# Cada noche es un run (runId = fecha local). Tras cada página se guarda el
+# cursor y los contadores acumulados en jobs/analyzeRisk (uno por shard).
+# Si la invocación agota RISK_JOB_MAX_SECONDS se pausa y encola una
+# continuación en la cola de continueRiskAnalysis; si muere a mitad, el
+# reintento de la tarea (o del scheduler) reanuda desde el último cursor.
+RISK_JOB_NAME = 'analyzeRisk'
+RISK_JOB_MAX_SECONDS = int(os.environ.get('RISK_JOB_MAX_SECONDS', '480'))
+RISK_CONTINUATION_FUNCTION = 'continueRiskAnalysis'
+RISK_TOTAL_KEYS = ('processed', 'errors', 'alerts', 'skipped', 'refreshed', 'rescored', 'writeErrors')
+
+def risk_job_name(shard_index, shard_count):
+    if shard_index is None:
+        return RISK_JOB_NAME
+    return f"{RISK_JOB_NAME}-{shard_index}of{shard_count}"
+
+def risk_run_id(now=None):
+    now = now or datetime.datetime.now(pytz.timezone('America/Mexico_City'))
+    return now.strftime('%Y-%m-%d')
+
+def sum_stats(stats, totals=None):
+    totals = dict(totals or {})
+    for key in RISK_TOTAL_KEYS:
+        totals[key] = totals.get(key, 0) + sum(shard_stats[key] for shard_stats in stats.values())
+    return totals
+
+def enqueue_risk_continuation(job_name, checkpoint, shard_index, shard_count):
+    from firebase_admin import functions
+
+    task_id = f"{job_name}-{checkpoint['runId']}-{checkpoint['invocations']}"
+    try:
+        functions.task_queue(RISK_CONTINUATION_FUNCTION).enqueue({
+            'runId': checkpoint['runId'],
+            'shardIndex': shard_index,
+            'shardCount': shard_count,
+        }, functions.TaskOptions(task_id=task_id))
+        print(f"⏭️ Continuación encolada ({task_id}) desde el cursor {checkpoint['cursor']}.")
+    except Exception as e:
+        # Si la tarea ya existe (reintento), la continuación ya está en marcha
+        print(f"⚠️ No se pudo encolar la continuación {task_id}: {e}")
+
+def dispatch_risk_shards(run_id, shard_count):
+    """Encola el inicio del run en cada shard (una tarea por shard, idempotente por run)."""
+    from firebase_admin import functions
+
+    queue = functions.task_queue(RISK_CONTINUATION_FUNCTION)
+    dispatched = 0
+    for shard_index in range(shard_count):
+        task_id = f"{risk_job_name(shard_index, shard_count)}-{run_id}-start"
+        try:
+            queue.enqueue({
+                'runId': run_id,
+                'shardIndex': shard_index,
+                'shardCount': shard_count,
+                'start': True,
+            }, functions.TaskOptions(task_id=task_id))
+            dispatched += 1
+        except Exception as e:
+            # Si la tarea ya existe (reintento del scheduler), el shard ya está despachado
+            print(f"⚠️ No se pudo encolar el shard {shard_index}/{shard_count} ({task_id}): {e}")
+    return dispatched
+
+def run_risk_analysis_job(db, shard_index=None, shard_count=1, run_id=None, start=False):
+    """
+    Ejecuta, reanuda o continúa el run nocturno indicado (por defecto, el de
+    hoy). Con start=True el run indicado puede empezar desde cero (tarea de
+    inicio de shard); sin él, un run_id distinto al del checkpoint se descarta.
+    Devuelve (checkpoint, contadores por shard de esta invocación, o None si
+    no había nada que hacer).
+    """
+    job_name = risk_job_name(shard_index, shard_count)
+    checkpoint_ref = job_checkpoint_ref(db, job_name)
+    checkpoint_doc = checkpoint_ref.get()
+    checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else {}
+
+    if run_id is not None and not start and checkpoint.get('runId') != run_id:
+        print(f"ℹ️ Continuación del run {run_id} descartada: el checkpoint es del run {checkpoint.get('runId')}.")
+        return checkpoint, None
+    run_id = run_id or risk_run_id()
+
+    if checkpoint.get('runId') == run_id and checkpoint.get('status') == 'completed':
+        print(f"ℹ️ El análisis nocturno {run_id} ya está completado.")
+        return checkpoint, None
+
+    if checkpoint.get('runId') != run_id:
+        if checkpoint.get('status') in ('running', 'paused'):
+            print(f"⚠️ El run {checkpoint.get('runId')} quedó incompleto en el cursor {checkpoint.get('cursor')}.")
+        incremental = RISK_JOB_INCREMENTAL and not is_full_sweep_day()
+        checkpoint = {
+            'runId': run_id,
+            'mode': 'incremental' if incremental else 'full',
+            'cursor': None,
+            'invocations': 0,
+            'totals': {key: 0 for key in RISK_TOTAL_KEYS},
+            'startedAt': firestore.SERVER_TIMESTAMP,
+        }
+        print(f"🔄 Iniciando análisis de riesgo nocturno {run_id} ({job_name}, modo {checkpoint['mode']})...")
+    else:
+        print(f"🔄 Reanudando análisis nocturno {run_id} desde el usuario {checkpoint.get('cursor')}...")
+
+    checkpoint['status'] = 'running'
+    checkpoint['invocations'] = checkpoint.get('invocations', 0) + 1
+    checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+    checkpoint_ref.set(checkpoint)
+
+    base_totals = checkpoint.get('totals') or {}
+    started = time.monotonic()
+
+    def save_page(cursor, stats):
+        checkpoint['cursor'] = cursor
+        checkpoint['totals'] = sum_stats(stats, base_totals)
+        checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+        if time.monotonic() - started > RISK_JOB_MAX_SECONDS:
+            checkpoint['status'] = 'paused'
+        checkpoint_ref.set(checkpoint)
+        return checkpoint['status'] != 'paused'
+
+    stats, _, finished = run_risk_analysis(
+        db, shard_index, shard_count, RISK_JOB_CONCURRENCY,
+        incremental=checkpoint['mode'] == 'incremental',
+        start_after_id=checkpoint.get('cursor'),
+        on_page=save_page,
+    )
+
+    if finished:
+        checkpoint['totals'] = sum_stats(stats, base_totals)
+        checkpoint['status'] = 'completed'
+        checkpoint['completedAt'] = firestore.SERVER_TIMESTAMP
+        checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+        checkpoint_ref.set(checkpoint)
+    else:
+        print(f"⏸️ Análisis nocturno pausado por tiempo en el cursor {checkpoint['cursor']}.")
+        enqueue_risk_continuation(job_name, checkpoint, shard_index, shard_count)
+
+    return checkpoint, stats
+
+def log_risk_job_summary(checkpoint, stats, elapsed):
+    totals = checkpoint.get('totals') or {}
+    state = "completado" if checkpoint.get('status') == 'completed' else "pausado"
+    print(f"✅ Análisis nocturno {checkpoint.get('runId')} {state} (invocación {checkpoint.get('invocations')}, {elapsed:.1f}s). "
+          f"Usuarios procesados: {totals.get('processed', 0)}. Errores: {totals.get('errors', 0)}. Alertas generadas: {totals.get('alerts', 0)}.")
+    print(f"   Omitidos (sin cambios): {totals.get('skipped', 0)}. "
+          f"Refrescados (solo tiempo): {totals.get('refreshed', 0)}. "
+          f"Re-puntuados: {totals.get('rescored', 0)}. Escrituras fallidas: {totals.get('writeErrors', 0)}.")
+    if stats:
+        print(format_shard_summary(stats))
+
 # ===============================================================
 #  FUNCIÓN 2: ANALIZAR RIESGO (REGRESIÓN) PROGRAMADA
 # ===============================================================
-@scheduler_fn.on_schedule(schedule="0 3 * * *", timezone="America/Mexico_City", memory=512)
+@scheduler_fn.on_schedule(schedule="0 3 * * *", timezone="America/Mexico_City", memory=512, timeout_sec=540)
 def analyze_risk_on_schedule(event) -> None:
     """Analiza riesgo académico nocturno para todos los usuarios."""
     global db_client
@@ -439,75 +1525,116 @@ def analyze_risk_on_schedule(event) -> None:
     
     db = db_client
 
-    processed_users = 0
-    alerts_generated = 0
-    
-    try:
-        print("Iniciando análisis de riesgo nocturno...")
-        
-        users_ref = db.collection('users').where('onboardingComplete', '==', True).stream()
-
-        for user_doc in users_ref:
-            user_id = user_doc.id
-            user_data = user_doc.to_dict()
-
-            if not isinstance(user_data, dict) or not user_data.get('onboardingComplete'):
-                continue
-            
-            profile_es = user_data.get('onboardingData')
-            if not isinstance(profile_es, dict):
-                continue
-
-            try:
-                now = datetime.datetime.now()
-                risk_result = calculate_risk_for_user(db, user_id, user_data, now)
-
-                user_doc_ref = db.collection('users').document(user_id)
-                user_doc_ref.update({
-                    'riskScore': risk_result["riskScore"],
-                    'riskBaseScore': risk_result["baseRisk"],
-                    'riskFactors': risk_result["factors"],
-                    'riskMetrics': risk_result["metrics"],
-                    'riskUpdatedAt': firestore.SERVER_TIMESTAMP
-                })
-
-                print(f"Usuario {user_id} - Riesgo final: {risk_result['riskScore']:.2f}")
-                processed_users += 1
-
-                if risk_result["riskScore"] > 0.6:
-                    recommendations_ref = db.collection(f'users/{user_id}/recommendations')
-                    existing_alert_query = recommendations_ref.where('type', '==', 'risk_alert').where('viewed', '==', False).limit(1)
-                    existing_alerts = list(existing_alert_query.stream())
-
-                    if not existing_alerts:
-                        text = "He notado que podrías estar en riesgo de no cumplir con tus próximos objetivos. ¿Revisamos tu plan de estudio?"
-                        recommendations_ref.add({
-                            'text': text,
-                            'type': 'risk_alert',
-                            'createdAt': firestore.SERVER_TIMESTAMP,
-                            'viewed': False
-                        })
-                        alerts_generated += 1
-                        print(f"⚠️ Alerta de riesgo generada para {user_id}.")
-
-            except Exception as inner_e:
-                print(f"❌ Error procesando usuario {user_id} (Regresión): {inner_e}")
-                traceback.print_exc(limit=1)
-                continue
+    if RISK_JOB_SHARD_COUNT > 1:
+        # Cada shard corre en su propia tarea; el índice viaja en el payload
+        run_id = risk_run_id()
+        dispatched = dispatch_risk_shards(run_id, RISK_JOB_SHARD_COUNT)
+        print(f"🚀 Análisis nocturno {run_id}: {dispatched}/{RISK_JOB_SHARD_COUNT} shard(s) despachados.")
+        return
 
+    try:
+        print(f"Iniciando análisis de riesgo nocturno (concurrencia={RISK_JOB_CONCURRENCY})...")
+        job_started = time.monotonic()
+        checkpoint, stats = run_risk_analysis_job(db)
     except Exception as e:
         print(f"❌ Error FATAL durante el análisis nocturno: {e}")
         traceback.print_exc()
         return
 
-    print(f"✅ Análisis nocturno completado. Usuarios procesados: {processed_users}. Alertas generadas: {alerts_generated}.")
+    if stats is not None:
+        log_risk_job_summary(checkpoint, stats, time.monotonic() - job_started)
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=60),
+    # Un shard nunca tiene dos tareas a la vez (la continuación se encola al
+    # final de la invocación), así que basta con un despacho por shard
+    rate_limits=RateLimits(max_concurrent_dispatches=RISK_JOB_SHARD_COUNT),
+    memory=512,
+    timeout_sec=540,
+)
+def continueRiskAnalysis(req: tasks_fn.CallableRequest) -> None:
+    """
+    Inicia un shard del análisis nocturno (despachado por analyze_risk_on_schedule)
+    o continúa uno pausado (encolado por run_risk_analysis_job).
+    """
+    data = req.data or {}
+    shard_index = data.get('shardIndex')
+    shard_count = max(1, int(data.get('shardCount') or 1))
+    if shard_index is not None:
+        shard_index = int(shard_index)
+
+    job_started = time.monotonic()
+    # Sin try/except: si falla, Cloud Tasks reintenta y se reanuda desde el checkpoint
+    checkpoint, stats = run_risk_analysis_job(get_db_client(), shard_index, shard_count,
+                                              run_id=data.get('runId'), start=bool(data.get('start')))
+    if stats is not None:
+        log_risk_job_summary(checkpoint, stats, time.monotonic() - job_started)
+
+# ===============================================================
+#  HELPERS: FRESCURA DEL RIESGO GUARDADO Y RESPUESTAS CONDICIONALES
+# ===============================================================
+# calculate_risk devuelve el riesgo guardado en el documento del usuario si
+# se calculó hace menos de RISK_CACHE_TTL_SECONDS y el rollup de actividad no
+# ha cambiado desde entonces (0 desactiva la caché).
+RISK_CACHE_TTL_SECONDS = int(os.environ.get('RISK_CACHE_TTL_SECONDS', '1800'))
+
+def utc_now_naive():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def stored_risk_if_fresh(db, user_id, user_data):
+    """Devuelve el resultado guardado si sigue vigente, o None si hay que recalcular."""
+    if RISK_CACHE_TTL_SECONDS <= 0 or not ACTIVITY_ROLLUP_ENABLED:
+        return None
+    if user_data.get('riskScore') is None or user_data.get('riskFactors') is None:
+        return None
+    updated_at = normalize_datetime(user_data.get('riskUpdatedAt'))
+    if updated_at is None or (utc_now_naive() - updated_at).total_seconds() > RISK_CACHE_TTL_SECONDS:
+        return None
+
+    rollup_doc = activity_rollup_ref(db, user_id).get()
+    rollup = rollup_doc.to_dict() if rollup_doc.exists else None
+    changed_at = normalize_datetime((rollup or {}).get('changedAt') or (rollup or {}).get('rebuiltAt'))
+    if changed_at is None or changed_at > updated_at:
+        return None
+
+    return {
+        'riskScore': user_data.get('riskScore'),
+        'baseRisk': user_data.get('riskBaseScore'),
+        'factors': user_data.get('riskFactors'),
+        'metrics': user_data.get('riskMetrics') or {},
+        'modelVersion': user_data.get('riskModelVersion'),
+        'updatedAt': updated_at.isoformat(),
+    }
+
+def risk_etag(response):
+    """ETag del contenido del riesgo (no depende de cuándo ni cómo se obtuvo)."""
+    content = {key: response.get(key) for key in ('riskScore', 'baseRisk', 'factors', 'metrics', 'modelVersion')}
+    digest = hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(req, etag):
+    if_none_match = req.headers.get('If-None-Match', '')
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+def risk_response(req, response, headers):
+    headers = dict(headers, **{'ETag': risk_etag(response), 'Cache-Control': 'private, no-cache'})
+    if etag_matches(req, headers['ETag']):
+        return https_fn.Response("", status=304, headers=headers)
+    return https_fn.Response(json.dumps(response), headers=headers, status=200)
 
 # ===============================================================
 #  FUNCIÓN 2.1: CALCULAR RIESGO BAJO DEMANDA (HTTP)
 # ===============================================================
 @https_fn.on_request(memory=512)
 def calculate_risk(req: https_fn.Request) -> https_fn.Response:
-    """Calcula riesgo académico bajo demanda y devuelve factores explicativos."""
+    """
+    Calcula riesgo académico bajo demanda y devuelve factores explicativos.
+    Sirve el riesgo guardado si sigue fresco (ver stored_risk_if_fresh);
+    ?force=true obliga a recalcular. Responde 304 si coincide If-None-Match.
+    """
     global db_client
 
     headers = get_cors_headers(req.headers.get('Origin', ''))
@@ -537,31 +1664,11 @@ def calculate_risk(req: https_fn.Request) -> https_fn.Response:
             )
 
     db = db_client
-    user_id = None
-
-    try:
-        auth_header = req.headers.get('authorization', '')
-        parts = auth_header.split(None, 1)
-        if len(parts) == 2 and parts[0].lower() == 'bearer':
-            id_token = parts[1].strip()
-        else:
-            id_token = None
-
-        if not id_token:
-            return https_fn.Response(
-                json.dumps({'error': 'Auth token missing or invalid format (Bearer).'}),
-                status=401,
-                headers=headers
-            )
 
-        decoded_token = auth.verify_id_token(id_token)
-        user_id = decoded_token['uid']
-    except Exception as auth_error:
-        return https_fn.Response(
-            json.dumps({'error': f'Invalid or expired token: {str(auth_error)}'}),
-            status=401,
-            headers=headers
-        )
+    decoded_token, auth_response = authenticate_request(req, headers)
+    if auth_response is not None:
+        return auth_response
+    user_id = decoded_token['uid']
 
     try:
         user_doc_ref = db.collection('users').document(user_id)
@@ -574,6 +1681,12 @@ def calculate_risk(req: https_fn.Request) -> https_fn.Response:
             )
 
         user_data = user_doc.to_dict() or {}
+        force = req.args.get('force', '').lower() == 'true'
+        if not force:
+            cached = stored_risk_if_fresh(db, user_id, user_data)
+            if cached is not None:
+                return risk_response(req, {**cached, 'cached': True}, headers)
+
         now = datetime.datetime.now()
         risk_result = calculate_risk_for_user(db, user_id, user_data, now)
 
@@ -582,18 +1695,24 @@ def calculate_risk(req: https_fn.Request) -> https_fn.Response:
             'riskBaseScore': risk_result["baseRisk"],
             'riskFactors': risk_result["factors"],
             'riskMetrics': risk_result["metrics"],
+            'riskModelVersion': risk_result["modelVersion"],
+            'riskProfileHash': profile_hash(user_data.get('onboardingData')),
             'riskUpdatedAt': firestore.SERVER_TIMESTAMP
         })
+        if ALERT_FEED_ENABLED:
+            alert_feed_ref(db, user_id).set({'riskScore': risk_result["riskScore"]}, merge=True)
 
         response = {
             'riskScore': risk_result["riskScore"],
             'baseRisk': risk_result["baseRisk"],
             'factors': risk_result["factors"],
             'metrics': risk_result["metrics"],
-            'updatedAt': now.isoformat()
+            'modelVersion': risk_result["modelVersion"],
+            'updatedAt': now.isoformat(),
+            'cached': False
         }
 
-        return https_fn.Response(json.dumps(response), headers=headers, status=200)
+        return risk_response(req, response, headers)
 
     except Exception as e:
         print(f"❌ Error calculando riesgo bajo demanda (user {user_id}): {e}")
@@ -607,9 +1726,7 @@ def calculate_risk(req: https_fn.Request) -> https_fn.Response:
 # ===============================================================
 #  FUNCIÓN 3: IMPORTAR HORARIO (GEMINI) - CORREGIDA
 # ===============================================================
-import base64
 # (datetime, dateutil y rrule ya se importaron globalmente)
-import google.auth
 
 # Mapeo de días
 DAY_MAP = {
@@ -622,230 +1739,86 @@ DAY_MAP = {
     'domingo': rrule.SU
 }
 
-@https_fn.on_request(memory=512)
-def importSchedule(req: https_fn.Request) -> https_fn.Response:
-    """Importa horario desde archivo (imagen/PDF base64) usando Gemini Vision."""
-    global db_client, vision_model, vertexai_initialized
-
-    headers = get_cors_headers(req.headers.get('Origin', ''))
-
-    if req.method == 'OPTIONS':
-        return https_fn.Response("", headers=headers, status=204)
-
-    headers['Content-Type'] = 'application/json'
+# --- Reimportación incremental ---
+# Cada instancia importada tiene un id determinista derivado de (usuario,
+# materia, día, horario, fecha), así que importar dos veces el mismo horario
+# produce los mismos ids: se comparan con los eventos importados existentes y
+# solo se escriben las altas y se borran las clases que ya no están.
+IMPORT_EVENT_SOURCE = 'scheduleImport'
+IMPORT_EVENT_NOTES = 'Importado automáticamente.'
+
+def schedule_event_id(user_id, subject_norm, weekday, start_t, end_t, ev_date):
+    key = '|'.join([
+        user_id, subject_norm, weekday,
+        f"{start_t.strftime('%H:%M')}-{end_t.strftime('%H:%M')}", ev_date.isoformat(),
+    ])
+    return 'sched_' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def schedule_series_id(user_id, subject_norm, weekday, start_t, end_t):
+    key = '|'.join([user_id, subject_norm, weekday, f"{start_t.strftime('%H:%M')}-{end_t.strftime('%H:%M')}"])
+    return 'series_' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def schedule_series_doc(slot, dtstart, until, tz_name):
+    """Documento de serie (ver schedule_expander.py) para una clase semanal."""
+    return {
+        **slot.payload,
+        'rrule': schedule_expander.weekly_rrule(slot.weekday, until),
+        'dtstart': dtstart.isoformat(),
+        'startTime': slot.start.strftime('%H:%M'),
+        'endTime': slot.end.strftime('%H:%M'),
+        'timezone': tz_name,
+    }
 
-    # --- Logging Detallado ---
-    print("--- importSchedule Request Received ---")
-    print(f"Method: {req.method}")
-    headers_dict = {k.lower(): v for k, v in req.headers.items()}
-    print("Headers (lowercase):", headers_dict)
-    
-    try:
-        if req.is_json: 
-            body = req.get_json()
-            print("JSON Body (keys):", list(body.keys()) if isinstance(body, dict) else "Not a dict")
-        else: 
-            print("Body: Not JSON or empty")
-    except Exception as e: 
-        print(f"Error reading body: {e}")
-    print("--- End Request Details ---")
+def existing_imported_event_ids(db, user_id, since):
+    """
+    {id: seriesId o None} de los eventos importados que empiezan desde `since`. Incluye los de
+    importaciones anteriores a los ids deterministas (reconocibles por la nota),
+    para que la primera reimportación limpie sus duplicados. El rango de fechas
+    va en la consulta (índices compuestos source+start y notes+start en
+    firestore.indexes.json): solo se leen los eventos desde `since`.
+    """
+    events_ref = db.collection(f'users/{user_id}/events')
+    since = as_utc(since)
+    queries = [
+        events_ref.where('source', '==', IMPORT_EVENT_SOURCE).where('start', '>=', since).select(['start', SERIES_INSTANCE_FIELD]),
+        events_ref.where('notes', '==', IMPORT_EVENT_NOTES).where('start', '>=', since).select(['start', SERIES_INSTANCE_FIELD]),
+    ]
+    event_ids = {}
+    for query in queries:
+        for event_doc in query.stream():
+            event_ids[event_doc.id] = event_doc.get(SERIES_INSTANCE_FIELD)
+    return event_ids
 
-    # --- Inicialización Perezosa Firestore ---
-    if db_client is None:
-        try: 
-            print("🔄 Init Firestore (import)...")
-            db_client = firestore.client()
-            print("✅ Firestore OK.")
-        except Exception as db_init_e: 
-            return https_fn.Response(json.dumps({'error': f'DB init: {str(db_init_e)}'}), status=500, headers=headers)
+def write_imported_schedule(db, user_id, schedule_data, end_date, store_as):
+    """
+    Valida las clases extraídas, crea las materias nuevas y escribe la
+    diferencia con la importación anterior. Devuelve (status HTTP, cuerpo).
+    """
+    # --- Generar Eventos y Guardar en Firestore ---
+    created_ev_count = 0
+    updated_ev_count = 0
+    unchanged_ev_count = 0
+    removed_ev_count = 0
+    series_counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    created_subj_count = 0
+    skipped_count = 0
+    processed_count = 0
+    created_subj_cache = {}
+    class_slots = []
+    # id determinista -> datos del evento, para comparar con lo ya importado
+    desired_events = {}
+    desired_series = {}
     
-    db = db_client
-
-    # --- Inicialización Perezosa Gemini/Vertex AI ---
-    if not vertexai_initialized:
-        try:
-            import vertexai
-            from vertexai.generative_models import GenerativeModel, Part, FinishReason
-            import vertexai.preview.generative_models as generative_models
-            
-            print("🔄 Init Vertex AI SDK...")
-            credentials, PROJECT_ID = google.auth.default()
-            LOCATION = 'us-central1'
-            vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
-            
-            MODEL_NAME = "gemini-2.5-pro"
-            vision_model = GenerativeModel(MODEL_NAME)
-            vertexai_initialized = True
-            print(f"✅ Vertex AI SDK OK ({MODEL_NAME}).")
-            
-        except ImportError: 
-            print("❌ vertexai not installed.")
-            return https_fn.Response(json.dumps({'error': 'IA dependency missing.'}), status=500, headers=headers)
-        except Exception as e: 
-            traceback.print_exc()
-            print(f"❌ Vertex AI init error: {e}.")
-            return https_fn.Response(json.dumps({'error': f'IA init error: {str(e)}'}), status=503, headers=headers)
-
-    user_id = None
+    write_summary = {'committed': {}, 'failed': {}, 'errors': []}
     
     try:
-        # --- Autenticación MEJORADA ---
-        auth_header = req.headers.get('authorization', '')
-        print(f"Raw Authorization Header: '{auth_header}'")
-        
-        id_token = None
-        parts = auth_header.split(None, 1)
-        if len(parts) == 2 and parts[0].lower() == 'bearer':
-            id_token = parts[1].strip()
-            print(f"Extracted Token (first 10 chars): '{id_token[:10]}...'")
-        else:
-            print("WARN: 'Bearer ' not found or incorrect format in Authorization header.")
+        print("🗓️ Generando instancias de eventos y comparando con la importación anterior...")
+        writer = ChunkedBatchWriter(db, label='import')
+        subjects_ref = db.collection(f'users/{user_id}/subjects')
 
-        if not id_token:
-            return https_fn.Response(
-                json.dumps({'error': 'Auth token missing or invalid format (Bearer).'}), 
-                status=401, 
-                headers=headers
-            )
-
-        # Verificar el token
-        try:
-            decoded_token = auth.verify_id_token(id_token)
-            user_id = decoded_token['uid']
-            print(f"Auth OK: {user_id}")
-        except Exception as auth_error:
-            print(f"Auth verification error: {auth_error}")
-            return https_fn.Response(
-                json.dumps({'error': 'Invalid or expired token.'}), 
-                status=401, 
-                headers=headers
-            )
-
-        # --- Validación de entrada ---
-        if not req.is_json: 
-            raise ValueError("Request must be JSON.")
-        
-        req_data = req.get_json()
-        file_b64 = req_data.get('fileData')
-        end_date_str = req_data.get('endDate')
-        mime_type = req_data.get('fileType', 'application/octet-stream')
-        
-        if not file_b64 or not end_date_str: 
-            raise ValueError("Missing fileData or endDate.")
-        
-        try: 
-            end_date = date_parser.isoparse(end_date_str).replace(tzinfo=None)
-        except ValueError: 
-            raise ValueError("Invalid endDate format (use ISO 8601).")
-        
-        try: 
-            file_bytes = base64.b64decode(file_b64)
-        except (TypeError, base64.binascii.Error): 
-            raise ValueError("Invalid fileData format (base64).")
-        
-        print(f"Import req validated for {user_id} until {end_date.strftime('%Y-%m-%d')}, type: {mime_type}")
-
-    except Exception as e:
-        err_msg = f'Input/Auth format error: {str(e)}'
-        print(f"❌ {err_msg}")
-        return https_fn.Response(
-            json.dumps({'error': err_msg}), 
-            status=400, 
-            headers=headers
-        )
-
-    # --- Llamada a Gemini ---
-    schedule_data = []
-    try:
-        print("🤖 Calling Gemini...")
-        from vertexai.generative_models import Part, FinishReason
-        import vertexai.preview.generative_models as generative_models
-        
-        image_part = Part.from_data(data=file_bytes, mime_type=mime_type)
-        text_part = Part.from_text("""Analiza imagen/PDF de horario. Extrae clases semanales. Devuelve SOLAMENTE lista JSON: [{'materia': string, 'diaSemana': string(Español minúsculas sin acentos, ej: lunes, miercoles), 'horaInicio': string(HH:MM 24h), 'horaFin': string(HH:MM 24h)}]. Ignora otros textos. No uses null. No inventes. Ej: [{'materia': 'Calculo I', 'diaSemana': 'lunes', 'horaInicio': '09:00', 'horaFin': '10:30'}, ...]""")
-        
-        gen_config = generative_models.GenerationConfig(
-            temperature=0.1, 
-            max_output_tokens=8192
-        )
-        
-        safety_settings = {
-            generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-            generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-            generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-            generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-        }
-        
-        response = vision_model.generate_content(
-            [image_part, text_part], 
-            generation_config=gen_config, 
-            safety_settings=safety_settings, 
-            stream=False
-        )
-
-        # Validar respuesta de Gemini
-        if not response.candidates or response.candidates[0].finish_reason != FinishReason.STOP:
-            finish_reason = response.candidates[0].finish_reason if response.candidates else "No candidates"
-            safety_ratings = response.candidates[0].safety_ratings if response.candidates and response.candidates[0].safety_ratings else "N/A"
-            
-            if finish_reason == FinishReason.SAFETY:
-                raise ValueError(f"La IA bloqueó la respuesta por seguridad. Razón: {safety_ratings}")
-            else:
-                raise ValueError(f"Respuesta inválida de la IA. Razón: {finish_reason}.")
-
-        if not response.candidates[0].content.parts: 
-            raise ValueError("Respuesta válida de IA pero sin contenido.")
-
-        raw_json = response.candidates[0].content.parts[0].text
-        clean_json = raw_json.strip().lstrip('```json').rstrip('```').strip()
-        print(f"Gemini JSON (clean):\n{clean_json}")
-
-        # Parsear JSON
-        try: 
-            schedule_data = json.loads(clean_json)
-        except json.JSONDecodeError as json_err:
-            try:
-                json_start = clean_json.find('[')
-                json_end = clean_json.rfind(']') + 1
-                if json_start != -1 and json_end != -1:
-                    clean_json = clean_json[json_start:json_end]
-                    schedule_data = json.loads(clean_json)
-                    print("ADVERTENCIA: JSON extraído de una respuesta con texto adicional.")
-                else: 
-                    raise ValueError("No se encontró una lista JSON válida.")
-            except (json.JSONDecodeError, ValueError):
-                print(f"❌ Error parseando JSON de Gemini: {json_err}. Raw: {raw_json[:500]}...")
-                raise ValueError("La respuesta de la IA no es un JSON válido o está mal formateada.")
-
-        if not isinstance(schedule_data, list): 
-            raise ValueError("La respuesta de la IA no es una lista JSON como se esperaba.")
-
-        print(f"✅ Gemini extrajo {len(schedule_data)} items del horario.")
-
-    except Exception as e:
-        traceback.print_exc()
-        print(f"❌ Error en llamada/procesamiento de Gemini: {e}")
-        return https_fn.Response(
-            json.dumps({'error': f'Error al analizar el archivo con IA: {str(e)}'}), 
-            status=500, 
-            headers=headers
-        )
-
-    # --- Generar Eventos y Guardar en Firestore ---
-    created_ev_count = 0
-    created_subj_count = 0
-    skipped_count = 0
-    processed_count = 0
-    created_subj_cache = {}
-    
-    try:
-        print("🗓️ Generando instancias de eventos y preparando lote...")
-        batch = db.batch()
-        subjects_ref = db.collection(f'users/{user_id}/subjects')
-
-        # Cargar materias existentes
-        existing_subjs = {doc.to_dict().get('name','').strip().lower(): doc.id for doc in subjects_ref.stream()}
-        print(f"Materias existentes encontradas para {user_id}: {len(existing_subjs)}")
+        # Cargar materias existentes
+        existing_subjs = {doc.to_dict().get('name','').strip().lower(): doc.id for doc in subjects_ref.stream()}
+        print(f"Materias existentes encontradas para {user_id}: {len(existing_subjs)}")
 
         # --- CORRECCIÓN 1.3: Definir la zona horaria local ---
         local_tz = pytz.timezone("America/Mexico_City")
@@ -917,105 +1890,583 @@ def importSchedule(req: https_fn.Request) -> https_fn.Response:
                 color_idx = (len(existing_subjs) + created_subj_count) % len(presetColors)
                 new_color = presetColors[color_idx]
                 
-                batch.set(new_subj_ref, {
+                writer.set(new_subj_ref, {
                     'name': mat_name, 
                     'color': new_color
-                })
+                }, kind='subjects')
                 
                 subj_id = new_subj_ref.id
                 created_subj_cache[mat_norm] = subj_id
                 existing_subjs[mat_norm] = subj_id
                 created_subj_count += 1
 
-            # --- Generar Fechas y Eventos ---
-            try:
-                rule = rrule.rrule(
-                    rrule.WEEKLY, 
-                    byweekday=[rrule_d], 
-                    dtstart=start_of_week, # --- CORRECCIÓN 3.2: Usar inicio de semana ---
-                    until=end_date
-                )
-                
-                ev_item_count = 0
-                for ev_date in rule:
-                    # --- CORRECCIÓN 1.3: Crear datetimes "aware" ---
-                    ev_start_naive = datetime.datetime.combine(ev_date.date(), start_t)
-                    ev_end_naive = datetime.datetime.combine(ev_date.date(), end_t)
-                    
-                    ev_start_aware = local_tz.localize(ev_start_naive)
-                    ev_end_aware = local_tz.localize(ev_end_naive)
-                    # --- Fin CORRECCIÓN 1.3 ---
+            # --- Clase semanal (las fechas se generan todas juntas abajo) ---
+            class_slots.append(schedule_expander.ClassSlot(
+                weekday=rrule_d.weekday,
+                start=start_t,
+                end=end_t,
+                payload={
+                    'title': mat_name,
+                    'subject': subj_id,
+                    'notes': IMPORT_EVENT_NOTES,
+                    'source': IMPORT_EVENT_SOURCE,
+                    # --- CORRECCIÓN 1.1: Guardar 'uid' en lugar de '_id' ---
+                    'user': {'uid': user_id}
+                    # --- Fin CORRECCIÓN 1.1 ---
+                },
+                key=(mat_norm, dia_norm),
+            ))
+
+        # --- Generar Fechas y Eventos ---
+        # --- CORRECCIÓN 3.2: desde el inicio de semana; CORRECCIÓN 1.3: fechas "aware" ---
+        # Las instancias se escriben en ambos modos (son lo que lee el cliente)
+        slot_series_ids = {}
+        if store_as == 'series':
+            # Además un documento por clase, que es lo que cuenta el servidor
+            for slot in class_slots:
+                series_id = schedule_series_id(user_id, *slot.key, slot.start, slot.end)
+                slot_series_ids[slot.key + (slot.start, slot.end)] = series_id
+                desired_series[series_id] = schedule_series_doc(slot, start_of_week, end_date.date(), local_tz.zone)
+            print(f"   -> Generadas {len(desired_series)} series para {len(class_slots)} clases semanales.")
+        for slot, ev_date, ev_data in schedule_expander.expand_weekly(class_slots, start_of_week, end_date, local_tz.zone):
+            ev_id = schedule_event_id(user_id, *slot.key, slot.start, slot.end, ev_date)
+            series_id = slot_series_ids.get(slot.key + (slot.start, slot.end))
+            if series_id is not None:
+                ev_data[SERIES_INSTANCE_FIELD] = series_id
+            desired_events[ev_id] = ev_data
+        print(f"   -> Generadas {len(desired_events)} instancias para {len(class_slots)} clases semanales.")
+
+        # --- Diferencia con los eventos ya importados (desde el inicio de semana) ---
+        since = local_tz.localize(datetime.datetime.combine(start_of_week, datetime.time.min))
+        existing_ev_ids = existing_imported_event_ids(db, user_id, since)
+        events_ref = db.collection(f'users/{user_id}/events')
 
-                    ev_ref = db.collection(f'users/{user_id}/events').document()
-                    
-                    batch.set(ev_ref, {
-                        'title': mat_name,
-                        'start': ev_start_aware, # --- CORRECCIÓN 1.3: Guardar fecha "aware"
-                        'end': ev_end_aware,   # --- CORRECCIÓN 1.3: Guardar fecha "aware"
-                        'subject': subj_id,
-                        'notes': 'Importado automáticamente.',
-                        # --- CORRECCIÓN 1.1: Guardar 'uid' en lugar de '_id' ---
-                        'user': {'uid': user_id} 
-                        # --- Fin CORRECCIÓN 1.1 ---
-                    })
-                    
-                    created_ev_count += 1
-                    ev_item_count += 1
-                    
-                if ev_item_count > 0:
-                    print(f"   -> Generadas {ev_item_count} instancias para '{mat_name}' los {dia_norm.capitalize()}")
-                    
-            except Exception as rrule_err:
-                print(f"⚠️ Error generando fechas para '{mat_name}': {rrule_err}. Omitiendo.")
-                skipped_count += 1
+        for ev_id, ev_data in desired_events.items():
+            if ev_id in existing_ev_ids:
+                series_id = ev_data.get(SERIES_INSTANCE_FIELD)
+                if existing_ev_ids[ev_id] == series_id:
+                    unchanged_ev_count += 1
+                    continue
+                # Cambio de modo: solo se marca o desmarca la instancia (se conservan las ediciones del usuario)
+                writer.set(events_ref.document(ev_id), {SERIES_INSTANCE_FIELD: series_id or firestore.DELETE_FIELD},
+                           kind='updatedEvents', merge=True)
+                updated_ev_count += 1
                 continue
-
-        # Ejecutar batch commit
-        if created_subj_count > 0 or created_ev_count > 0:
-            print(f"💾 Guardando {created_subj_count} materias nuevas y {created_ev_count} eventos nuevos...")
-            batch.commit()
-            print("✅ Batch commit exitoso!")
+            writer.set(events_ref.document(ev_id), ev_data, kind='events', key=ev_id)
+            created_ev_count += 1
+
+        for ev_id in set(existing_ev_ids).difference(desired_events):
+            writer.delete(events_ref.document(ev_id), kind='removedEvents')
+            removed_ev_count += 1
+
+        # --- Lo mismo con las series (al volver al modo events se borran) ---
+        series_ref = class_series_ref(db, user_id)
+        existing_series = {
+            series_id: series
+            for series_id, series in load_class_series(db, user_id, ['source', 'rrule', 'dtstart']).items()
+            if series.get('source') == IMPORT_EVENT_SOURCE
+        }
+        for series_id, series_data in desired_series.items():
+            current = existing_series.get(series_id)
+            if current is not None:
+                # Se conserva la primera semana ya importada; las excepciones no se tocan (merge)
+                series_data['dtstart'] = min(current.get('dtstart') or series_data['dtstart'], series_data['dtstart'])
+                if current.get('rrule') == series_data['rrule'] and current.get('dtstart') == series_data['dtstart']:
+                    series_counts['unchanged'] += 1
+                    continue
+            writer.set(series_ref.document(series_id), series_data, kind='series', merge=True)
+            series_counts['updated' if current is not None else 'created'] += 1
+
+        for series_id in set(existing_series).difference(desired_series):
+            writer.delete(series_ref.document(series_id), kind='removedSeries')
+            series_counts['removed'] += 1
+
+        # Confirmar los chunks restantes y esperar a los que están en vuelo
+        write_summary = writer.close()
+        failed_ev_ids = {item['key'] for item in write_summary['failedItems'] if item['kind'] == 'events'}
+        created_events = {
+            ev_id: ev_data for ev_id, ev_data in desired_events.items()
+            if ev_id not in existing_ev_ids and ev_id not in failed_ev_ids
+        }
+        # Las instancias de una serie no entran al rollup: las cuenta su serie
+        try:
+            upcoming_applied = apply_imported_events_change(db, user_id, created_events, datetime.datetime.now())
+            if upcoming_applied:
+                print(f"📊 Rollup de actividad: {upcoming_applied} eventos próximos añadidos en una escritura.")
+        except Exception as rollup_error:
+            # apply_activity_change ya marcó el rollup para reconstruirse en la próxima lectura
+            print(f"WARN: No se pudo actualizar el rollup de actividad de {user_id}: {rollup_error}")
+        committed_subj = write_summary['committed'].get('subjects', 0)
+        committed_ev = write_summary['committed'].get('events', 0)
+        committed_removed = write_summary['committed'].get('removedEvents', 0)
+        if series_counts['created'] or series_counts['updated'] or series_counts['removed']:
+            print(f"💾 Series: {json.dumps(series_counts)}")
+        if created_subj_count > 0 or created_ev_count > 0 or removed_ev_count > 0:
+            print(f"💾 Guardadas {committed_subj}/{created_subj_count} materias nuevas y {committed_ev}/{created_ev_count} eventos nuevos; "
+                  f"borrados {committed_removed}/{removed_ev_count} eventos que ya no están en el horario.")
         else:
             print("ℹ️ No se generaron materias o eventos nuevos para guardar.")
 
-        print(f"Resumen importación: Items procesados={processed_count}, Omitidos={skipped_count}, Materias nuevas={created_subj_count}, Eventos nuevos={created_ev_count}")
+        if write_summary['failed']:
+            failed_total = sum(write_summary['failed'].values())
+            return 500, {
+                'error': f'Importación parcial: {failed_total} escrituras no se pudieron guardar.',
+                'eventsCreated': committed_ev,
+                'eventsUnchanged': unchanged_ev_count,
+                'eventsRemoved': committed_removed,
+                'subjectsCreated': committed_subj,
+                'eventsFailed': write_summary['failed'].get('events', 0),
+                'removalsFailed': write_summary['failed'].get('removedEvents', 0),
+                'updatesFailed': write_summary['failed'].get('updatedEvents', 0),
+                'seriesFailed': write_summary['failed'].get('series', 0) + write_summary['failed'].get('removedSeries', 0),
+                'subjectsFailed': write_summary['failed'].get('subjects', 0),
+                'skippedEntries': skipped_count
+            }
+
+        print(f"Resumen importación: Items procesados={processed_count}, Omitidos={skipped_count}, Materias nuevas={created_subj_count}, Eventos nuevos={created_ev_count}, Sin cambios={unchanged_ev_count}, Cambiados de modo={updated_ev_count}, Borrados={removed_ev_count}")
 
     except Exception as e:
         print(f"❌ Error FATAL durante generación/guardado de eventos: {e}")
         traceback.print_exc()
-        return https_fn.Response(
-            json.dumps({'error': f'Error procesando horario o guardando eventos: {str(e)}'}), 
-            status=500, 
-            headers=headers
-        )
+        try:
+            write_summary = writer.close()
+        except Exception:
+            pass
+        return 500, {
+            'error': f'Error procesando horario o guardando eventos: {str(e)}',
+            'eventsCreated': write_summary['committed'].get('events', 0),
+            'eventsRemoved': write_summary['committed'].get('removedEvents', 0),
+            'subjectsCreated': write_summary['committed'].get('subjects', 0)
+        }
 
     # --- Respuesta Exitosa ---
-    success_msg = f'Importación completada. {created_ev_count} eventos creados.'
+    success_msg = f'Importación completada. {created_ev_count} eventos creados, {unchanged_ev_count} sin cambios.'
+    if store_as == 'series':
+        success_msg += (f" Series: {series_counts['created']} creadas, "
+                        f"{series_counts['updated']} actualizadas, {series_counts['unchanged']} sin cambios.")
+    if updated_ev_count > 0:
+        success_msg += f' {updated_ev_count} eventos cambiados de modo.'
+    if removed_ev_count > 0:
+        success_msg += f' {removed_ev_count} eventos eliminados (clases que ya no están en el horario).'
+    if series_counts['removed'] > 0:
+        success_msg += f" {series_counts['removed']} series eliminadas."
     if created_subj_count > 0: 
         success_msg += f' {created_subj_count} materias nuevas añadidas.'
     if skipped_count > 0: 
         success_msg += f' {skipped_count} entradas inválidas del horario fueron omitidas.'
     
-    succ_body = json.dumps({
+    return 200, {
         'message': success_msg, 
         'eventsCreated': created_ev_count, 
+        'eventsUnchanged': unchanged_ev_count,
+        'eventsUpdated': updated_ev_count,
+        'eventsRemoved': removed_ev_count,
+        'storedAs': store_as,
+        'seriesCreated': series_counts['created'],
+        'seriesUpdated': series_counts['updated'],
+        'seriesUnchanged': series_counts['unchanged'],
+        'seriesRemoved': series_counts['removed'],
         'subjectsCreated': created_subj_count, 
         'skippedEntries': skipped_count
-    })
+    }
+
+# --- Importación asíncrona (users/{uid}/importJobs/{jobId}) ---
+# Con async=true (o IMPORT_ASYNC=true) la petición solo valida, deja el
+# archivo en GCS y encola runImportJob; responde 202 con el id del trabajo.
+# El trabajo escribe su avance en el documento para que el cliente lo
+# consulte o se suscriba:
+#   status: queued | running | done | failed
+#   stage:  queued | extracting | writing | done
+#   result: el mismo cuerpo que devuelve la importación síncrona
+# El id se deriva del archivo y los parámetros: un reintento del cliente
+# mientras el trabajo está en curso devuelve el existente en lugar de
+# duplicarlo. Una vez terminado (done o failed), o si lleva más de
+# IMPORT_JOB_STALE_SECONDS sin avanzar, subir el mismo archivo lo vuelve a
+# ejecutar con un nuevo número de despacho ('dispatches'); las tareas de
+# despachos anteriores que sigan en la cola se ignoran.
+IMPORT_ASYNC = os.environ.get('IMPORT_ASYNC', 'false').lower() == 'true'
+IMPORT_JOBS_COLLECTION = 'importJobs'
+IMPORT_JOB_FUNCTION = 'runImportJob'
+IMPORT_JOB_MAX_ATTEMPTS = int(os.environ.get('IMPORT_JOB_MAX_ATTEMPTS', '3'))
+IMPORT_JOB_STALE_SECONDS = int(os.environ.get('IMPORT_JOB_STALE_SECONDS', '3600'))
+IMPORT_STAGING_BUCKET = os.environ.get('IMPORT_STAGING_BUCKET', model_registry.GCS_BUCKET_NAME)
+IMPORT_STAGING_PREFIX = 'import-staging'
+
+def import_job_ref(db, user_id, job_id):
+    return db.document(f"users/{user_id}/{IMPORT_JOBS_COLLECTION}/{job_id}")
+
+def import_job_id(user_id, file_sha256, mime_type, end_date, store_as):
+    key = '|'.join([user_id, file_sha256, mime_type, end_date.isoformat(), store_as])
+    return 'import_' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def staging_bucket():
+    return model_registry.get_storage_client().bucket(IMPORT_STAGING_BUCKET)
+
+def stage_import_file(user_id, staging_id, upload):
+    """Sube el archivo a GCS para el trabajo (Cloud Tasks limita el payload a 1 MB)."""
+    path = f"{IMPORT_STAGING_PREFIX}/{user_id}/{staging_id}"
+    # Subida por streaming desde el archivo recibido, sin cargarlo en memoria
+    staging_bucket().blob(path).upload_from_file(upload.open(), size=upload.size, content_type=upload.mime_type)
+    return path
+
+def load_staged_import_file(path):
+    """Descarga el archivo a un temporal anónimo (el llamador lo cierra)."""
+    staged_file = tempfile.TemporaryFile(prefix='import-staging-')
+    try:
+        staging_bucket().blob(path).download_to_file(staged_file)
+    except Exception:
+        staged_file.close()
+        raise
+    staged_file.seek(0)
+    return staged_file
+
+def delete_staged_import_file(path):
+    try:
+        staging_bucket().blob(path).delete()
+    except Exception as e:
+        print(f"⚠️ No se pudo borrar el archivo temporal gs://{IMPORT_STAGING_BUCKET}/{path}: {e}")
+
+def is_import_job_active(job, now):
+    """El trabajo está en cola o en curso y ha avanzado hace menos de IMPORT_JOB_STALE_SECONDS."""
+    if job is None or job.get('status') not in ('queued', 'running'):
+        return False
+    updated_at = as_utc(job.get('updatedAt'))
+    return updated_at is None or (now - updated_at).total_seconds() < IMPORT_JOB_STALE_SECONDS
+
+def start_import_job(db, user_id, upload, end_date, store_as):
+    """
+    Crea el trabajo (o reutiliza el que está en curso) y encola su ejecución.
+    Devuelve (job_id, datos del trabajo, True si se encoló ahora). Si no se
+    puede encolar, el trabajo queda como 'failed' y se propaga el error.
+    """
+    from firebase_admin import functions
+
+    job_id = import_job_id(user_id, upload.sha256, upload.mime_type, end_date, store_as)
+    job_ref = import_job_ref(db, user_id, job_id)
+    job_doc = job_ref.get()
+    job = job_doc.to_dict() if job_doc.exists else None
+    if is_import_job_active(job, as_utc(datetime.datetime.now(datetime.timezone.utc))):
+        return job_id, job, False
+
+    dispatch = int((job or {}).get('dispatches') or 0) + 1
+    staging_path = stage_import_file(user_id, f"{job_id}-{dispatch}", upload)
+    job = {
+        'status': 'queued',
+        'stage': 'queued',
+        'fileType': upload.mime_type,
+        'endDate': end_date.isoformat(),
+        'storeAs': store_as,
+        'stagingPath': staging_path,
+        'attempts': 0,
+        'dispatches': dispatch,
+        'error': None,
+        'result': None,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'updatedAt': firestore.SERVER_TIMESTAMP,
+    }
+    # El documento va antes que la tarea: la tarea puede ejecutarse en cuanto se encola
+    job_ref.set(job)
+    try:
+        functions.task_queue(IMPORT_JOB_FUNCTION).enqueue(
+            {'userId': user_id, 'jobId': job_id, 'dispatch': dispatch},
+            functions.TaskOptions(task_id=f"{job_id}-{dispatch}"),
+        )
+    except Exception as e:
+        update_import_job(job_ref, status='failed', error=f'No se pudo encolar la importación: {str(e)}')
+        delete_staged_import_file(staging_path)
+        raise
+    print(f"📥 Importación {job_id} encolada para {user_id} (despacho {dispatch}).")
+    return job_id, job, True
+
+def update_import_job(job_ref, **fields):
+    job_ref.update({**fields, 'updatedAt': firestore.SERVER_TIMESTAMP})
+
+def run_import_job(db, user_id, job_id, dispatch=None):
+    """Ejecuta el trabajo: extracción con Gemini y escritura; deja el resultado en el documento."""
+    job_ref = import_job_ref(db, user_id, job_id)
+    job_doc = job_ref.get()
+    job = job_doc.to_dict() if job_doc.exists else None
+    if job is None or job.get('status') in ('done', 'failed'):
+        print(f"ℹ️ Importación {job_id} ya terminada o inexistente; se ignora.")
+        return
+    if dispatch is not None and dispatch != job.get('dispatches'):
+        print(f"ℹ️ Tarea del despacho {dispatch} de {job_id} sustituida por el despacho {job.get('dispatches')}; se ignora.")
+        return
+
+    attempt = int(job.get('attempts') or 0) + 1
+    update_import_job(job_ref, status='running', stage='extracting', attempts=attempt)
+    try:
+        with load_staged_import_file(job['stagingPath']) as staged_file:
+            file_bytes, mime_type = schedule_upload.prepare_for_model(staged_file, job['fileType'])
+        schedule_data = schedule_extraction.get_extractor(db).extract(file_bytes, mime_type)
+        update_import_job(job_ref, stage='writing', itemsExtracted=len(schedule_data))
+
+        end_date = date_parser.isoparse(job['endDate'])
+        status, body = write_imported_schedule(db, user_id, schedule_data, end_date, job['storeAs'])
+    except ValueError as e:
+        # Respuesta inválida de la IA: reintentar no la arregla
+        update_import_job(job_ref, status='failed', stage='extracting', error=f'Error al analizar el archivo con IA: {str(e)}')
+        delete_staged_import_file(job['stagingPath'])
+        return
+    except Exception as e:
+        traceback.print_exc()
+        if attempt >= IMPORT_JOB_MAX_ATTEMPTS:
+            update_import_job(job_ref, status='failed', error=str(e))
+            delete_staged_import_file(job['stagingPath'])
+            return
+        update_import_job(job_ref, status='queued', error=str(e))
+        raise  # Cloud Tasks reintenta; los ids deterministas hacen idempotente la escritura
+
+    update_import_job(
+        job_ref,
+        status='done' if status == 200 else 'failed',
+        stage='done',
+        result=body,
+        error=body.get('error'),
+        finishedAt=firestore.SERVER_TIMESTAMP,
+    )
+    delete_staged_import_file(job['stagingPath'])
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=IMPORT_JOB_MAX_ATTEMPTS, min_backoff_seconds=30),
+    memory=512,
+    timeout_sec=540,
+)
+def runImportJob(req: tasks_fn.CallableRequest) -> None:
+    """Ejecuta una importación encolada por importSchedule en modo asíncrono."""
+    data = req.data or {}
+    run_import_job(get_db_client(), data['userId'], data['jobId'], data.get('dispatch'))
+
+@https_fn.on_request(memory=512)
+def importSchedule(req: https_fn.Request) -> https_fn.Response:
+    """Importa horario desde archivo (imagen/PDF: base64 en JSON, multipart o binario) usando Gemini Vision."""
+    global db_client
+
+    headers = get_cors_headers(req.headers.get('Origin', ''))
+
+    if req.method == 'OPTIONS':
+        return https_fn.Response("", headers=headers, status=204)
+
+    headers['Content-Type'] = 'application/json'
+
+    # --- Logging (sin cuerpo ni cabeceras de autenticación) ---
+    print(f"--- importSchedule {req.method}: Content-Type={req.headers.get('Content-Type')}, "
+          f"Content-Length={req.headers.get('Content-Length')} ---")
+
+    # --- Inicialización Perezosa Firestore ---
+    if db_client is None:
+        try: 
+            print("🔄 Init Firestore (import)...")
+            db_client = firestore.client()
+            print("✅ Firestore OK.")
+        except Exception as db_init_e: 
+            return https_fn.Response(json.dumps({'error': f'DB init: {str(db_init_e)}'}), status=500, headers=headers)
     
-    return https_fn.Response(succ_body, status=200, headers=headers)
+    db = db_client
+
+    user_id = None
+    upload = None
+
+    try:
+        # --- Autenticación ---
+        decoded_token, auth_response = authenticate_request(req, headers)
+        if auth_response is not None:
+            return auth_response
+        user_id = decoded_token['uid']
+        print(f"Auth OK: {user_id}")
+
+        # --- Lectura del archivo (JSON base64, multipart o binario) y validación ---
+        upload = schedule_upload.read_upload(req)
+        end_date_str = upload.params.get('endDate')
+        mime_type = upload.mime_type
+        store_as = str(upload.params.get('storeAs') or IMPORT_STORE_AS).lower()
+        run_async = str(upload.params.get('async', IMPORT_ASYNC)).lower() == 'true'
+        if store_as not in ('events', 'series'):
+            raise ValueError("storeAs must be 'events' or 'series'.")
+        
+        if not end_date_str: 
+            raise ValueError("Missing fileData or endDate.")
+        
+        try: 
+            end_date = date_parser.isoparse(end_date_str).replace(tzinfo=None)
+        except ValueError: 
+            raise ValueError("Invalid endDate format (use ISO 8601).")
+        
+        print(f"Import req validated for {user_id} until {end_date.strftime('%Y-%m-%d')}, type: {mime_type}, {upload.size} bytes")
+
+    except Exception as e:
+        if upload is not None:
+            upload.close()
+        err_msg = f'Input/Auth format error: {str(e)}'
+        print(f"❌ {err_msg}")
+        return https_fn.Response(
+            json.dumps({'error': err_msg}), 
+            status=413 if isinstance(e, schedule_upload.UploadTooLarge) else 400, 
+            headers=headers
+        )
+
+    # El temporal del archivo se borra al terminar, pase lo que pase
+    with upload:
+        return import_uploaded_schedule(db, user_id, upload, mime_type, end_date, store_as, run_async, headers)
+
+def import_uploaded_schedule(db, user_id, upload, mime_type, end_date, store_as, run_async, headers):
+    """Encola la importación o la ejecuta en línea; devuelve la respuesta HTTP."""
+    # --- Modo asíncrono: encolar y devolver el id del trabajo ---
+    if run_async:
+        try:
+            job_id, job, enqueued = start_import_job(db, user_id, upload, end_date, store_as)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"❌ Error encolando la importación para {user_id}: {e}")
+            return https_fn.Response(json.dumps({'error': f'No se pudo encolar la importación: {str(e)}'}), status=503, headers=headers)
+        return https_fn.Response(
+            json.dumps({
+                'jobId': job_id,
+                'status': job.get('status'),
+                'statusPath': f'users/{user_id}/{IMPORT_JOBS_COLLECTION}/{job_id}',
+                'enqueued': enqueued,
+                'result': job.get('result'),
+            }),
+            status=202,
+            headers=headers
+        )
+
+    # --- Llamada a Gemini (o caché por contenido; ver schedule_extraction.py) ---
+    try:
+        file_bytes, model_mime_type = schedule_upload.prepare_for_model(upload.open(), mime_type)
+        schedule_data = schedule_extraction.get_extractor(db).extract(file_bytes, model_mime_type)
+    except schedule_extraction.ExtractorUnavailable as e:
+        return https_fn.Response(json.dumps({'error': str(e)}), status=503, headers=headers)
+    except Exception as e:
+        traceback.print_exc()
+        print(f"❌ Error en llamada/procesamiento de Gemini: {e}")
+        return https_fn.Response(
+            json.dumps({'error': f'Error al analizar el archivo con IA: {str(e)}'}), 
+            status=500, 
+            headers=headers
+        )
+
+    # --- Generar Eventos y Guardar en Firestore ---
+    status, body = write_imported_schedule(db, user_id, schedule_data, end_date, store_as)
+    return https_fn.Response(json.dumps(body), status=status, headers=headers)
+
 # ===============================================================
-#  HELPER: NORMALIZAR TEXTO (para búsquedas)
+#  HELPERS: FEED DE ALERTAS PROACTIVAS (users/{uid}/feeds/alerts)
 # ===============================================================
-def normalize(text: str):
+# El job nocturno materializa, por usuario, los eventos de los próximos
+# ALERT_FEED_HORIZON_DAYS días cuyo título contiene una palabra clave:
+#   matches:   {eventId: {title, start, keyword, category, weight}}
+#   riskScore: riesgo con el que se decide la insistencia.
+#   windowEnd: hasta dónde llega la búsqueda de eventos.
+#   rulesVersion: versión de las reglas de alertas con la que se calculó.
+# on_event_written mantiene 'matches' al editar eventos. El horizonte es
+# mayor que la ventana de 7 días para que el feed siga sirviendo aunque falle
+# una noche; si ya no cubre la semana, el endpoint recalcula al vuelo.
+ALERT_FEED_ENABLED = os.environ.get('ALERT_FEED_ENABLED', 'true').lower() == 'true'
+ALERT_FEED_DOC = 'feeds/alerts'
+ALERT_WINDOW_DAYS = 7
+ALERT_FEED_HORIZON_DAYS = int(os.environ.get('ALERT_FEED_HORIZON_DAYS', '9'))
+
+def alert_feed_ref(db, user_id):
+    return db.document(f"users/{user_id}/{ALERT_FEED_DOC}")
+
+def as_utc(value):
+    """Fecha con zona horaria (UTC) o None; las fechas sin zona se asumen UTC."""
+    if hasattr(value, "to_datetime") and not isinstance(value, datetime.datetime):
+        value = value.to_datetime()
+    if not isinstance(value, datetime.datetime):
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+def alert_feed_entry(event, now, rules):
+    """Entrada del feed para un evento, o None si no genera alerta."""
+    start = as_utc((event or {}).get('start'))
+    if start is None or not now <= start <= now + datetime.timedelta(days=ALERT_FEED_HORIZON_DAYS):
+        return None
+    keyword_match = rules.matcher.match(event.get('title', ''))
+    if keyword_match is None:
+        return None
+    return {'title': event.get('title', ''), 'start': start, **keyword_match.to_dict()}
+
+def build_alert_feed(db, user_id, risk_score, now):
+    """Busca los eventos del horizonte del feed que contienen palabras clave."""
+    rules = alert_rules.get_rules(db)
+    window_end = now + datetime.timedelta(days=ALERT_FEED_HORIZON_DAYS)
+    events_ref = db.collection(f'users/{user_id}/events')
+    query = events_ref.where('start', '>=', now).where('start', '<=', window_end).select(['title', 'start', SERIES_INSTANCE_FIELD])
+
+    matches = {}
+    for event_doc in query.stream():
+        event = event_doc.to_dict() or {}
+        if not counts_as_event(event):
+            continue
+        entry = alert_feed_entry(event, as_utc(now), rules)
+        if entry is not None:
+            matches[event_doc.id] = entry
+
+    # Ocurrencias de las series de clases en el mismo horizonte
+    series_by_id = load_class_series(db, user_id, ['title'] + schedule_expander.SERIES_SCHEDULE_FIELDS)
+    for occurrence_id, event in schedule_expander.expand_series(series_by_id, as_utc(now), as_utc(window_end)):
+        entry = alert_feed_entry(event, as_utc(now), rules)
+        if entry is not None:
+            matches[occurrence_id] = entry
+    return {'matches': matches, 'riskScore': risk_score, 'windowEnd': as_utc(window_end), 'rulesVersion': rules.version}
+
+def is_alert_feed_fresh(feed, now, rules):
     """
-    Convierte a minúsculas, quita acentos y caracteres diacríticos.
-    (Como lo solicitaste)
+    El feed sirve si existe, se calculó con las reglas vigentes y su búsqueda
+    cubre toda la semana a partir de now.
     """
-    text = text.lower()
-    text = unicodedata.normalize("NFD", text)
-    return "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
-
+    if not feed or not feed.get('computedAt') or 'riskScore' not in feed:
+        return False
+    if feed.get('rulesVersion') != rules.version:
+        return False
+    window_end = as_utc(feed.get('windowEnd'))
+    return window_end is not None and window_end >= as_utc(now) + datetime.timedelta(days=ALERT_WINDOW_DAYS)
+
+def render_proactive_alerts(feed, user_name, now, rules):
+    """Convierte los eventos del feed en los textos de alerta según el riesgo y el peso."""
+    risk_score = feed.get('riskScore')
+    if risk_score is None:
+        risk_score = 0.3
+    now = as_utc(now)
+    week_ahead = now + datetime.timedelta(days=ALERT_WINDOW_DAYS)
+
+    # Primero las categorías de más peso (exámenes antes que tareas), luego por fecha
+    entries = [entry for entry in (feed.get('matches') or {}).values() if entry]
+    entries.sort(key=lambda entry: (-float(entry.get('weight') or 0), as_utc(entry.get('start')) or week_ahead))
+
+    alerts_to_send = []
+    for entry in entries:
+        start = as_utc(entry.get('start'))
+        if start is None or not now <= start <= week_ahead:
+            continue
+        event_title_original = entry.get('title', '')
+
+        if risk_score > rules.threshold('highInsistence'): # Riesgo Muy Alto
+            insistencia = "alta"
+            texto = f"¡MUCHO OJO, {user_name}! Tienes '{event_title_original}' pronto. ¡Es crucial que empieces a prepararte ya!"
+            alerts_to_send.append({'text': texto, 'insistencia': insistencia,
+                                   'keyword': entry.get('keyword'), 'category': entry.get('category')})
+
+        elif risk_score > rules.threshold('mediumInsistence'): # Riesgo Medio
+            insistencia = "media"
+            texto = f"Hola, {user_name}, solo un recordatorio proactivo: Tienes '{event_title_original}' esta semana. ¿Ya tienes un plan de estudio para esto?"
+            alerts_to_send.append({'text': texto, 'insistencia': insistencia,
+                                   'keyword': entry.get('keyword'), 'category': entry.get('category')})
+
+        # (Riesgo Bajo): no hacemos nada, no queremos molestar al usuario.
+    return alerts_to_send
+
+def queue_alert_feed(db, writer, user_id, risk_score):
+    """Recalcula el feed del usuario y encola su escritura (job nocturno)."""
+    if not ALERT_FEED_ENABLED:
+        return
+    now = datetime.datetime.now(pytz.timezone("America/Mexico_City"))
+    feed = build_alert_feed(db, user_id, risk_score, now)
+    writer.set(alert_feed_ref(db, user_id), {**feed, 'computedAt': firestore.SERVER_TIMESTAMP}, kind='feeds', key=user_id)
 
 # ===============================================================
 #  FUNCIÓN 4: OBTENER ALERTAS PROACTIVAS (Versión Final)
@@ -1024,7 +2475,8 @@ def normalize(text: str):
 def get_proactive_alerts(req: https_fn.Request) -> https_fn.Response:
     """
     Al iniciar sesión, revisa los eventos cercanos y el riesgo del usuario
-    para devolver alertas personalizadas.
+    para devolver alertas personalizadas. Lee el feed materializado y solo
+    recalcula si falta o ya no cubre la semana.
     """
     
     cors_headers = get_cors_headers(req.headers.get('Origin', ''))
@@ -1040,90 +2492,551 @@ def get_proactive_alerts(req: https_fn.Request) -> https_fn.Response:
         db_client = firestore.client()
     db = db_client
     
+    decoded_token, auth_response = authenticate_request(req, cors_headers)
+    if auth_response is not None:
+        return auth_response
+    user_id = decoded_token['uid']
+    user_name = decoded_token.get('name', 'Estudiante')
+
+    # --- 2. Feed materializado (una lectura) o cálculo al vuelo ---
     try:
-        auth_header = req.headers.get('authorization', '')
-        parts = auth_header.split(None, 1)
-        if len(parts) != 2 or parts[0].lower() != 'bearer':
-            raise ValueError("Auth token missing or invalid format (Bearer).")
-        id_token = parts[1].strip()
-        decoded_token = auth.verify_id_token(id_token)
-        user_id = decoded_token['uid']
-        user_name = decoded_token.get('name', 'Estudiante') 
-        
-    except Exception as auth_error:
-        print(f"Auth verification error: {auth_error}")
-        return https_fn.Response(json.dumps({'error': 'Invalid or expired token.'}), status=401, headers=cors_headers)
-
-    # --- 2. Definir Palabras Clave (Normalizadas) ---
-    KEYWORDS_LIST = [
-        # Evaluaciones
-        "examen", "evaluacion", "evaluación", "prueba", "quiz", "test",
-        "parcial", "final", "midterm", "ordinario", "extraordinario",
-        # Tareas / entregables
-        "tarea", "entrega", "entregar", "actividad", "homework", "assignment",
-        "pendiente", "subir", "deadline", "fecha limite", "fecha límite",
-        # Proyectos / trabajos
-        "proyecto", "trabajo", "ensayo", "informe", "reporte", "monografia",
-        "investigacion", "investigación", "documento", "avance", "propuesta",
-        # Presentaciones / exposiciones
-        "presentacion", "presentación", "expo", "exposición", "pitch",
-        # Reuniones con propósito académico
-        "revision", "revisión", "retroalimentacion", "retroalimentación",
-        "feedback",
-        # Cronogramas o recordatorios importantes
-        "fecha importante", "planificacion", "planificación", "agenda",
-    ]
-    KEYWORDS_NORMALIZED = [normalize(k) for k in KEYWORDS_LIST]
-    
-    
-    # --- 3. Lógica de Alertas ---
-    try:
-        # Obtener perfil de riesgo
-        user_doc = db.collection('users').document(user_id).get()
-        if not user_doc.exists:
-            return https_fn.Response(json.dumps({'alerts': []}), status=200, headers=cors_headers)
-            
-        user_data = user_doc.to_dict()
-        risk_score = user_data.get('riskScore', 0.3) 
-        
-        # Obtener eventos de la próxima semana
         now = datetime.datetime.now(pytz.timezone("America/Mexico_City"))
-        one_week_later = now + datetime.timedelta(days=7)
-        
-        events_ref = db.collection(f'users/{user_id}/events')
-        query = events_ref.where('start', '>=', now).where('start', '<=', one_week_later).stream()
-
-        alerts_to_send = []
-        
-        for event in query:
-            event_title_original = event.to_dict().get('title', '')
-            event_title_norm = normalize(event_title_original)
-            
-            # Buscar keywords normalizadas en el título normalizado
-            if any(keyword in event_title_norm for keyword in KEYWORDS_NORMALIZED):
-                
-                # --- ✅ LÓGICA FINAL (MODO PRUEBA DESACTIVADO) ---
-                
-                if risk_score > 0.5: # Riesgo Muy Alto
-                    insistencia = "alta"
-                    texto = f"¡MUCHO OJO, {user_name}! Tienes '{event_title_original}' pronto. ¡Es crucial que empieces a prepararte ya!"
-                    alerts_to_send.append({'text': texto, 'insistencia': insistencia})
-                
-                elif risk_score > 0.3: # Riesgo Medio
-                    insistencia = "media"
-                    texto = f"Hola, {user_name}, solo un recordatorio proactivo: Tienes '{event_title_original}' esta semana. ¿Ya tienes un plan de estudio para esto?"
-                    alerts_to_send.append({'text': texto, 'insistencia': insistencia})
-                
-                else: 
-                    # (Riesgo Bajo)
-                    # No hacemos nada, no queremos molestar al usuario.
-                    continue 
-                # --- FIN DE LA LÓGICA FINAL ---
-                
-        # Devolver respuesta
+        feed = None
+        if ALERT_FEED_ENABLED:
+            feed_doc = alert_feed_ref(db, user_id).get()
+            feed = feed_doc.to_dict() if feed_doc.exists else None
+
+        rules = alert_rules.get_rules(db)
+        if not is_alert_feed_fresh(feed, now, rules):
+            # Fallback: se calcula al vuelo y se materializa para el próximo login
+            user_doc = db.collection('users').document(user_id).get()
+            if not user_doc.exists:
+                return https_fn.Response(json.dumps({'alerts': []}), status=200, headers=cors_headers)
+            risk_score = (user_doc.to_dict() or {}).get('riskScore', 0.3)
+            feed = build_alert_feed(db, user_id, risk_score, now)
+            if ALERT_FEED_ENABLED:
+                alert_feed_ref(db, user_id).set({**feed, 'computedAt': firestore.SERVER_TIMESTAMP})
+
+        alerts_to_send = render_proactive_alerts(feed, user_name, now, rules)
         return https_fn.Response(json.dumps({'alerts': alerts_to_send}), status=200, headers=cors_headers)
 
     except Exception as e:
         print(f"❌ Error generando alertas: {e}")
         traceback.print_exc()
         return https_fn.Response(json.dumps({'error': f'Error interno: {str(e)}'}), status=500, headers=cors_headers)
+
+
+# ===============================================================
+#  FUNCIÓN 5: MANTENER ROLLUP DE ACTIVIDAD (TRIGGERS FIRESTORE)
+# ===============================================================
+# Los triggers se entregan "al menos una vez": un reintento puede duplicar un
+# incremento de contador. Los triggers de Firestore no se reintentan al fallar
+# (firebase-functions no expone retry para ellos): si una escritura del rollup
+# falla (p. ej. por contención), se borra su 'rebuiltAt' para que la próxima
+# lectura lo reconstruya en lugar de perder el cambio. La reconciliación
+# semanal corrige el resto de derivas.
+# Los eventos que crea importSchedule no pasan por el trigger: la importación
+# aplica su cambio al rollup y al feed una sola vez al terminar (ver
+# apply_imported_events_change), en lugar de cientos de escrituras sobre los
+# mismos dos documentos.
+def get_db_client():
+    global db_client
+    if db_client is None:
+        db_client = firestore.client()
+    return db_client
+
+def apply_activity_change(db, user_id, update):
+    """Aplica un cambio al rollup (o lo invalida si la escritura falla)."""
+    try:
+        activity_rollup_ref(db, user_id).set({**update, "changedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    except Exception:
+        invalidate_activity_rollup(db, user_id)
+        raise
+
+def invalidate_activity_rollup(db, user_id):
+    """Sin rebuiltAt, la próxima lectura reconstruye el rollup completo."""
+    try:
+        activity_rollup_ref(db, user_id).set({"rebuiltAt": firestore.DELETE_FIELD}, merge=True)
+    except Exception as invalidate_error:
+        print(f"WARN: No se pudo invalidar el rollup de {user_id}: {invalidate_error}")
+
+def apply_imported_events_change(db, user_id, created_events, now):
+    """Cambio agregado de una importación: los eventos nuevos que caen en el horizonte."""
+    upcoming = {
+        event_id: {"start": event.get("start"), "end": event.get("end")}
+        for event_id, event in created_events.items()
+        if counts_as_event(event) and is_upcoming_event({"start": as_utc(event.get("start")), "end": as_utc(event.get("end"))}, now)
+    }
+    if not upcoming:
+        return 0
+    apply_activity_change(db, user_id, {"upcoming": upcoming})
+    if ALERT_FEED_ENABLED:
+        # El feed se recalcula en la próxima lectura con todos los eventos nuevos
+        alert_feed_ref(db, user_id).set({"computedAt": firestore.DELETE_FIELD}, merge=True)
+    return len(upcoming)
+
+def is_import_created(before, after):
+    return before is None and after is not None and after.get('source') == IMPORT_EVENT_SOURCE
+
+def snapshot_data(snapshot):
+    if snapshot is None or not snapshot.exists:
+        return None
+    return snapshot.to_dict() or {}
+
+@firestore_fn.on_document_written(document="users/{userId}/tasks/{taskId}")
+def on_task_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    user_id = event.params['userId']
+    task_id = event.params['taskId']
+    before = snapshot_data(event.data.before)
+    after = snapshot_data(event.data.after)
+
+    def is_pending(task):
+        return task is not None and not task.get("completed")
+
+    def is_completed(task):
+        return task is not None and bool(task.get("completed"))
+
+    def pending_due(task):
+        return task.get("dueDate") if is_pending(task) else None
+
+    pending_delta = int(is_pending(after)) - int(is_pending(before))
+    completed_delta = int(is_completed(after)) - int(is_completed(before))
+    due_after = pending_due(after)
+    due_changed = pending_due(before) != due_after
+
+    if not pending_delta and not completed_delta and not due_changed:
+        return
+
+    update = {}
+    if pending_delta:
+        update["pendingTasks"] = firestore.Increment(pending_delta)
+    if completed_delta:
+        update["completedTasks"] = firestore.Increment(completed_delta)
+    if due_changed:
+        update["pendingDue"] = {task_id: due_after if due_after is not None else firestore.DELETE_FIELD}
+
+    try:
+        apply_activity_change(get_db_client(), user_id, update)
+    except Exception as e:
+        print(f"❌ Error actualizando rollup (tarea {task_id}) para {user_id}: {e}")
+        raise
+
+@firestore_fn.on_document_written(document="users/{userId}/habits/{habitId}")
+def on_habit_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    user_id = event.params['userId']
+    habit_id = event.params['habitId']
+    before = snapshot_data(event.data.before)
+    after = snapshot_data(event.data.after)
+
+    rate_before = habit_completion_rate(before) if before is not None else None
+    rate_after = habit_completion_rate(after) if after is not None else None
+    if rate_before == rate_after and (before is None) == (after is None):
+        return
+
+    value = rate_after if after is not None else firestore.DELETE_FIELD
+    try:
+        apply_activity_change(get_db_client(), user_id, {"habitRates": {habit_id: value}})
+    except Exception as e:
+        print(f"❌ Error actualizando rollup (hábito {habit_id}) para {user_id}: {e}")
+        raise
+
+@firestore_fn.on_document_written(document="users/{userId}/events/{eventId}")
+def on_event_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    user_id = event.params['userId']
+    event_id = event.params['eventId']
+    before = snapshot_data(event.data.before)
+    after = snapshot_data(event.data.after)
+    now = datetime.datetime.now()
+    if is_import_created(before, after):
+        return
+
+    sync_alert_feed_event(user_id, event_id, before, after)
+
+    was_upcoming = counts_as_event(before) and is_upcoming_event(before, now)
+    is_upcoming = counts_as_event(after) and is_upcoming_event(after, now)
+    if not was_upcoming and not is_upcoming:
+        return
+    if was_upcoming and is_upcoming and \
+            before.get("start") == after.get("start") and before.get("end") == after.get("end"):
+        return
+
+    value = {"start": after.get("start"), "end": after.get("end")} if is_upcoming else firestore.DELETE_FIELD
+    try:
+        apply_activity_change(get_db_client(), user_id, {"upcoming": {event_id: value}})
+    except Exception as e:
+        print(f"❌ Error actualizando rollup (evento {event_id}) para {user_id}: {e}")
+        raise
+
+@firestore_fn.on_document_written(document="users/{userId}/classSeries/{seriesId}")
+def on_class_series_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    user_id = event.params['userId']
+    series_id = event.params['seriesId']
+    before = snapshot_data(event.data.before)
+    after = snapshot_data(event.data.after)
+    if before is not None and after is not None and \
+            series_schedule(before) == series_schedule(after) and before.get("title") == after.get("title"):
+        return
+
+    value = series_schedule(after) if after is not None else firestore.DELETE_FIELD
+    try:
+        db = get_db_client()
+        apply_activity_change(db, user_id, {"series": {series_id: value}})
+        if ALERT_FEED_ENABLED:
+            # Cambian todas las ocurrencias a la vez: el feed se recalcula en la próxima lectura
+            alert_feed_ref(db, user_id).set({"computedAt": firestore.DELETE_FIELD}, merge=True)
+    except Exception as e:
+        print(f"❌ Error actualizando rollup (serie {series_id}) para {user_id}: {e}")
+        raise
+
+def sync_alert_feed_event(user_id, event_id, before, after):
+    """Añade, actualiza o quita el evento del feed de alertas del usuario."""
+    if not ALERT_FEED_ENABLED:
+        return
+    now = as_utc(datetime.datetime.now(datetime.timezone.utc))
+    rules = alert_rules.get_rules(get_db_client())
+    entry_before = alert_feed_entry(before, now, rules) if counts_as_event(before) else None
+    entry_after = alert_feed_entry(after, now, rules) if counts_as_event(after) else None
+    if entry_before == entry_after:
+        return
+
+    value = entry_after if entry_after is not None else firestore.DELETE_FIELD
+    try:
+        alert_feed_ref(get_db_client(), user_id).set({"matches": {event_id: value}}, merge=True)
+    except Exception as e:
+        print(f"❌ Error actualizando feed de alertas (evento {event_id}) para {user_id}: {e}")
+        raise
+
+def is_open_risk_alert(recommendation):
+    return recommendation is not None and recommendation.get('type') == 'risk_alert' and not recommendation.get('viewed')
+
+@firestore.transactional
+def sync_open_risk_alert(transaction, user_ref, recommendation_id, is_open):
+    """Mantiene openRiskAlert/openRiskAlertId del usuario al abrirse o cerrarse una alerta."""
+    user_snapshot = user_ref.get(transaction=transaction)
+    if not user_snapshot.exists:
+        return
+    user_data = user_snapshot.to_dict() or {}
+    if is_open and not user_data.get('openRiskAlert'):
+        transaction.update(user_ref, {'openRiskAlert': True, 'openRiskAlertId': recommendation_id})
+    elif not is_open and user_data.get('openRiskAlertId') in (recommendation_id, None) and user_data.get('openRiskAlert'):
+        transaction.update(user_ref, {'openRiskAlert': False, 'openRiskAlertId': firestore.DELETE_FIELD})
+
+@firestore_fn.on_document_written(document="users/{userId}/recommendations/{recommendationId}")
+def on_recommendation_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    user_id = event.params['userId']
+    recommendation_id = event.params['recommendationId']
+    was_open = is_open_risk_alert(snapshot_data(event.data.before))
+    is_open = is_open_risk_alert(snapshot_data(event.data.after))
+    if was_open == is_open:
+        return
+
+    db = get_db_client()
+    try:
+        sync_open_risk_alert(db.transaction(), db.collection('users').document(user_id), recommendation_id, is_open)
+    except Exception as e:
+        print(f"❌ Error actualizando openRiskAlert (alerta {recommendation_id}) para {user_id}: {e}")
+        raise
+
+# ===============================================================
+#  FUNCIÓN 5.1: RECONCILIAR ROLLUPS DE ACTIVIDAD (PROGRAMADA)
+# ===============================================================
+# Reconstruye el rollup de todos los usuarios por páginas y guarda el cursor
+# en jobs/reconcileActivityRollups tras cada página (runId = fecha local).
+# Si la invocación agota ROLLUP_RECONCILE_MAX_SECONDS se pausa y encola una
+# continuación en continueActivityReconcile, como el análisis nocturno.
+ROLLUP_RECONCILE_JOB_NAME = 'reconcileActivityRollups'
+ROLLUP_RECONCILE_PAGE_SIZE = int(os.environ.get('ROLLUP_RECONCILE_PAGE_SIZE', '200'))
+ROLLUP_RECONCILE_MAX_SECONDS = int(os.environ.get('ROLLUP_RECONCILE_MAX_SECONDS', '480'))
+ROLLUP_RECONCILE_CONTINUATION_FUNCTION = 'continueActivityReconcile'
+
+def enqueue_rollup_reconcile_continuation(checkpoint):
+    from firebase_admin import functions
+
+    task_id = f"{ROLLUP_RECONCILE_JOB_NAME}-{checkpoint['runId']}-{checkpoint['invocations']}"
+    try:
+        functions.task_queue(ROLLUP_RECONCILE_CONTINUATION_FUNCTION).enqueue(
+            {'runId': checkpoint['runId']}, functions.TaskOptions(task_id=task_id)
+        )
+        print(f"⏭️ Continuación encolada ({task_id}) desde el cursor {checkpoint['cursor']}.")
+    except Exception as e:
+        # Si la tarea ya existe (reintento), la continuación ya está en marcha
+        print(f"⚠️ No se pudo encolar la continuación {task_id}: {e}")
+
+def run_rollup_reconcile_job(db, run_id=None):
+    """
+    Ejecuta, reanuda o continúa la reconciliación indicada (por defecto, la de
+    hoy). Devuelve el checkpoint.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    checkpoint_ref = job_checkpoint_ref(db, ROLLUP_RECONCILE_JOB_NAME)
+    checkpoint_doc = checkpoint_ref.get()
+    checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else {}
+
+    if run_id is not None and checkpoint.get('runId') != run_id:
+        print(f"ℹ️ Continuación de la reconciliación {run_id} descartada: el checkpoint es del run {checkpoint.get('runId')}.")
+        return checkpoint
+    run_id = run_id or risk_run_id()
+
+    if checkpoint.get('runId') == run_id and checkpoint.get('status') == 'completed':
+        print(f"ℹ️ La reconciliación {run_id} ya está completada.")
+        return checkpoint
+
+    if checkpoint.get('runId') != run_id:
+        checkpoint = {
+            'runId': run_id,
+            'cursor': None,
+            'invocations': 0,
+            'rebuilt': 0,
+            'failed': 0,
+            'startedAt': firestore.SERVER_TIMESTAMP,
+        }
+        print(f"Iniciando reconciliación de rollups de actividad {run_id}...")
+    else:
+        print(f"🔄 Reanudando reconciliación {run_id} desde el usuario {checkpoint.get('cursor')}...")
+
+    checkpoint['status'] = 'running'
+    checkpoint['invocations'] = checkpoint.get('invocations', 0) + 1
+    checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+    checkpoint_ref.set(checkpoint)
+
+    started = time.monotonic()
+
+    def rebuild(user_id):
+        try:
+            rebuild_activity_rollup(db, user_id, datetime.datetime.now())
+            return True
+        except Exception as e:
+            print(f"❌ Error reconstruyendo rollup de {user_id}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, RISK_JOB_CONCURRENCY), thread_name_prefix='rollup') as executor:
+        for page in iter_onboarded_user_pages(db, ROLLUP_RECONCILE_PAGE_SIZE, checkpoint.get('cursor')):
+            results = list(executor.map(rebuild, [user_doc.id for user_doc in page]))
+            checkpoint['cursor'] = page[-1].id
+            checkpoint['rebuilt'] += sum(results)
+            checkpoint['failed'] += len(results) - sum(results)
+            checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+            if time.monotonic() - started > ROLLUP_RECONCILE_MAX_SECONDS:
+                checkpoint['status'] = 'paused'
+                checkpoint_ref.set(checkpoint)
+                print(f"⏸️ Reconciliación pausada por tiempo en el cursor {checkpoint['cursor']}.")
+                enqueue_rollup_reconcile_continuation(checkpoint)
+                return checkpoint
+            checkpoint_ref.set(checkpoint)
+
+    checkpoint['status'] = 'completed'
+    checkpoint['completedAt'] = firestore.SERVER_TIMESTAMP
+    checkpoint_ref.set(checkpoint)
+    print(f"✅ Reconciliación {run_id} completada en {time.monotonic() - started:.1f}s (invocación {checkpoint['invocations']}). "
+          f"Rollups reconstruidos: {checkpoint['rebuilt']}. Errores: {checkpoint['failed']}.")
+    return checkpoint
+
+@scheduler_fn.on_schedule(schedule="0 2 * * 0", timezone="America/Mexico_City", memory=512, timeout_sec=540)
+def reconcile_activity_rollups(event) -> None:
+    """Reconstruye desde cero el rollup de actividad de todos los usuarios."""
+    try:
+        run_rollup_reconcile_job(get_db_client())
+    except Exception as e:
+        print(f"❌ Error FATAL durante la reconciliación: {e}")
+        traceback.print_exc()
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=60),
+    rate_limits=RateLimits(max_concurrent_dispatches=1),
+    memory=512,
+    timeout_sec=540,
+)
+def continueActivityReconcile(req: tasks_fn.CallableRequest) -> None:
+    """Continúa una reconciliación pausada (encolada por run_rollup_reconcile_job)."""
+    data = req.data or {}
+    # Sin try/except: si falla, Cloud Tasks reintenta y se reanuda desde el checkpoint
+    run_rollup_reconcile_job(get_db_client(), run_id=data.get('runId'))
+
+
+# ===============================================================
+#  FUNCIÓN 6: RE-CLUSTERIZAR PERFILES EXISTENTES (K-MEANS)
+# ===============================================================
+# Reasigna el clúster de todos los usuarios con el modelo K-Means vigente.
+# Avanza por páginas y guarda el cursor en jobs/reclusterProfiles tras cada
+# página: si la invocación se interrumpe o agota RECLUSTER_MAX_SECONDS, la
+# siguiente continúa desde ahí. Solo se escriben los clústeres que cambian.
+# Una escritura de clúster fallida no detiene el cursor: el id se guarda en
+# 'failedIds' y la siguiente ejecución programada lo reintenta.
+RECLUSTER_JOB_NAME = 'reclusterProfiles'
+RECLUSTER_PAGE_SIZE = int(os.environ.get('RECLUSTER_PAGE_SIZE', '500'))
+RECLUSTER_MAX_SECONDS = int(os.environ.get('RECLUSTER_MAX_SECONDS', '480'))
+# Máximo de ids fallidos guardados en el checkpoint (el resto solo se cuenta)
+RECLUSTER_FAILED_IDS_MAX = int(os.environ.get('RECLUSTER_FAILED_IDS_MAX', '500'))
+
+def queue_cluster_updates(db, writer, preprocessor, model, model_version, candidates):
+    """Encola los clústeres que cambian. Devuelve (cambiados, perfiles inválidos)."""
+    items = [user_data['onboardingData'] for _, user_data in candidates]
+    results = [result for chunk in cluster_profile_batch(preprocessor, model, items) for result in chunk]
+
+    changed = 0
+    invalid = 0
+    for (user_id, user_data), result in zip(candidates, results):
+        if 'error' in result:
+            print(f"⚠️ No se pudo re-clusterizar {user_id}: {result['error']}")
+            invalid += 1
+            continue
+        if user_data.get('cluster') != result['cluster']:
+            writer.update(db.collection('users').document(user_id), {
+                'cluster': result['cluster'],
+                'clusterModelVersion': model_version,
+                'clusterUpdatedAt': firestore.SERVER_TIMESTAMP,
+            }, kind='clusters', key=user_id)
+            changed += 1
+    return changed, invalid
+
+def collect_cluster_write_failures(writer, reported):
+    """Ids cuyas escrituras de clúster fallaron desde la última llamada."""
+    summary = writer.drain()
+    new_items = summary['failedItems'][len(reported):]
+    reported.extend(new_items)
+    for item in new_items:
+        print(f"❌ Escritura de clúster fallida para {item['key']}: {item['error']}")
+    return [item['key'] for item in new_items]
+
+def record_failed_ids(checkpoint, failed_ids):
+    known = checkpoint.setdefault('failedIds', [])
+    for user_id in failed_ids:
+        if user_id not in known and len(known) < RECLUSTER_FAILED_IDS_MAX:
+            known.append(user_id)
+
+def retry_failed_clusters(db, checkpoint, preprocessor, model, model_version):
+    """Reintenta los ids cuya escritura falló en la pasada anterior."""
+    failed_ids = list(checkpoint.get('failedIds') or [])
+    users_ref = db.collection('users')
+    candidates = []
+    for user_id in failed_ids:
+        user_doc = users_ref.document(user_id).get()
+        user_data = user_doc.to_dict() if user_doc.exists else None
+        if user_data and isinstance(user_data.get('onboardingData'), dict):
+            candidates.append((user_id, user_data))
+
+    reported = []
+    with ChunkedBatchWriter(db, label='recluster') as writer:
+        changed, _ = queue_cluster_updates(db, writer, preprocessor, model, model_version, candidates)
+        still_failed = collect_cluster_write_failures(writer, reported)
+
+    checkpoint['failedIds'] = []
+    record_failed_ids(checkpoint, still_failed)
+    checkpoint['changed'] = checkpoint.get('changed', 0) + changed - len(still_failed)
+    checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+    print(f"🔁 Reintento de re-clustering: {len(failed_ids)} usuarios, {len(still_failed)} siguen fallando.")
+
+def run_recluster_job(db, force=False):
+    """Ejecuta (o reanuda) el re-clustering. Devuelve el estado del checkpoint."""
+    (preprocessor, model), model_version = load_scoring_models(
+        model_registry.KMEANS_COMPILED, model_registry.KMEANS_ARTIFACTS
+    )
+    checkpoint_ref = job_checkpoint_ref(db, RECLUSTER_JOB_NAME)
+    checkpoint_doc = checkpoint_ref.get()
+    checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else {}
+
+    same_version = checkpoint.get('modelVersion') == model_version
+    if same_version and checkpoint.get('status') == 'completed' and not force:
+        if checkpoint.get('failedIds'):
+            retry_failed_clusters(db, checkpoint, preprocessor, model, model_version)
+            checkpoint_ref.set(checkpoint)
+            return checkpoint
+        print(f"ℹ️ Re-clustering ya completado con el modelo vigente {model_version}.")
+        return checkpoint
+
+    if force or not same_version or checkpoint.get('status') == 'completed':
+        checkpoint = {
+            'status': 'running',
+            'modelVersion': model_version,
+            'cursor': None,
+            'processed': 0,
+            'changed': 0,
+            'failed': 0,
+            'writeErrors': 0,
+            'failedIds': [],
+            'startedAt': firestore.SERVER_TIMESTAMP,
+        }
+        print(f"🔄 Iniciando re-clustering con el modelo {model_version}...")
+    else:
+        print(f"🔄 Reanudando re-clustering desde el usuario {checkpoint.get('cursor')}...")
+
+    started = time.monotonic()
+    reported = []
+    writer = ChunkedBatchWriter(db, label='recluster')
+    try:
+        for page in iter_onboarded_user_pages(db, RECLUSTER_PAGE_SIZE, checkpoint.get('cursor')):
+            candidates = []
+            for user_doc in page:
+                user_data = user_doc.to_dict() or {}
+                if isinstance(user_data.get('onboardingData'), dict):
+                    candidates.append((user_doc.id, user_data))
+
+            changed, invalid = queue_cluster_updates(db, writer, preprocessor, model, model_version, candidates)
+
+            # El cursor avanza cuando las escrituras de la página han terminado;
+            # las que fallaron quedan en failedIds para la siguiente ejecución
+            failed_ids = collect_cluster_write_failures(writer, reported)
+            record_failed_ids(checkpoint, failed_ids)
+
+            checkpoint['cursor'] = page[-1].id
+            checkpoint['processed'] += len(candidates)
+            checkpoint['changed'] += changed - len(failed_ids)
+            checkpoint['failed'] += invalid
+            checkpoint['writeErrors'] = checkpoint.get('writeErrors', 0) + len(failed_ids)
+            checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+            checkpoint_ref.set(checkpoint)
+            print(f"   -> Página de {len(page)} usuarios: {changed - len(failed_ids)} clústeres cambiados, "
+                  f"{len(failed_ids)} escrituras fallidas (cursor {checkpoint['cursor']}).")
+
+            if time.monotonic() - started > RECLUSTER_MAX_SECONDS:
+                checkpoint['status'] = 'paused'
+                checkpoint_ref.set(checkpoint)
+                print(f"⏸️ Re-clustering pausado por tiempo; se reanudará desde {checkpoint['cursor']}.")
+                return checkpoint
+    finally:
+        writer.close()
+
+    checkpoint['status'] = 'completed'
+    checkpoint['completedAt'] = firestore.SERVER_TIMESTAMP
+    checkpoint['updatedAt'] = firestore.SERVER_TIMESTAMP
+    checkpoint_ref.set(checkpoint)
+    print(f"✅ Re-clustering completado. Procesados: {checkpoint['processed']}, cambiados: {checkpoint['changed']}, "
+          f"errores: {checkpoint['failed']}, escrituras fallidas: {checkpoint['writeErrors']}.")
+    return checkpoint
+
+@scheduler_fn.on_schedule(schedule="15 * * * *", timezone="America/Mexico_City", memory=512, timeout_sec=540)
+def recluster_profiles_on_schedule(event) -> None:
+    """Re-clusteriza perfiles cuando hay un modelo nuevo o un run pendiente."""
+    try:
+        run_recluster_job(get_db_client())
+    except Exception as e:
+        print(f"❌ Error FATAL durante el re-clustering: {e}")
+        traceback.print_exc()
+
+@https_fn.on_request(memory=512, timeout_sec=540)
+def recluster_profiles(req: https_fn.Request) -> https_fn.Response:
+    """Dispara el re-clustering manualmente (solo administradores, claim 'admin')."""
+    headers = get_cors_headers(req.headers.get('Origin', ''))
+
+    if req.method == 'OPTIONS':
+        return https_fn.Response("", headers=headers, status=204)
+
+    headers['Content-Type'] = 'application/json'
+
+    decoded_token, auth_response = authenticate_request(req, headers)
+    if auth_response is not None:
+        return auth_response
+
+    if not decoded_token.get('admin'):
+        return https_fn.Response(json.dumps({'error': 'Admin privileges required.'}), status=403, headers=headers)
+
+    try:
+        force = req.args.get('force', '').lower() == 'true'
+        checkpoint = run_recluster_job(get_db_client(), force=force)
+        response = {key: value for key, value in checkpoint.items() if not key.endswith('At')}
+        return https_fn.Response(json.dumps(response), status=200, headers=headers)
+    except Exception as e:
+        print(f"❌ Error en re-clustering manual: {e}")
+        traceback.print_exc()
+        return https_fn.Response(json.dumps({'error': f'Error interno: {str(e)}'}), status=500, headers=headers)
@@ -0,0 +1,408 @@
+# functions/model_registry.py
+
+# --- Registro de modelos: descarga y carga de artefactos desde GCS ---
+# Al arrancar la instancia, un hilo en segundo plano descarga en paralelo los
+# artefactos que necesita la función desplegada (FUNCTION_TARGET) y los carga
+# con joblib. Los handlers esperan solo por el artefacto que usan.
+#
+# La caché local de /tmp está versionada por la 'generation' del blob en GCS
+# (manifest en MODEL_MANIFEST_LOCAL). Cada MODEL_REVALIDATE_SECONDS se
+# revalida con una sola llamada de metadatos; si hay una versión nueva se
+# descarga y se reemplaza en memoria sin bloquear las peticiones.
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+import traceback
+
+import compiled_models
+
+# --- CONFIGURACIÓN DE GCS ---
+GCS_BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME', 'agenda-b616a-models')
+
+# nombre lógico -> (blob en GCS, ruta local temporal)
+ARTIFACTS = {
+    'kmeans_preprocessor': ('preprocessor_kmeans.pkl', '/tmp/preprocessor_kmeans.pkl'),
+    'kmeans_model': ('modelo_kmeans_4clusters.pkl', '/tmp/modelo_kmeans_4clusters.pkl'),
+    'regression_preprocessor': ('preprocessor_regresion.pkl', '/tmp/preprocessor_regresion.pkl'),
+    'regression_model': ('modelo_regresion_aprobacion.pkl', '/tmp/modelo_regresion_aprobacion.pkl'),
+    # Versiones compiladas solo-numpy (ver compiled_models.py)
+    'kmeans_compiled': ('modelo_kmeans_compilado.npz', '/tmp/modelo_kmeans_compilado.npz'),
+    'regression_compiled': ('modelo_regresion_compilado.npz', '/tmp/modelo_regresion_compilado.npz'),
+}
+
+# Cargador por artefacto (joblib con MODEL_MMAP_MODE si no se indica otro)
+ARTIFACT_LOADERS = {
+    'kmeans_compiled': compiled_models.load_compiled,
+    'regression_compiled': compiled_models.load_compiled,
+}
+
+KMEANS_ARTIFACTS = ('kmeans_preprocessor', 'kmeans_model')
+REGRESSION_ARTIFACTS = ('regression_preprocessor', 'regression_model')
+KMEANS_COMPILED = ('kmeans_compiled',)
+REGRESSION_COMPILED = ('regression_compiled',)
+
+# Usa los modelos compilados (sin pandas/sklearn). Desactivado por defecto:
+# activarlo solo después de publicar los .npz con `compiled_models.py export`
+# (que incluye las muestras de paridad que se comprueban al cargar).
+MODEL_COMPILED_SCORING = os.environ.get('MODEL_COMPILED_SCORING', 'false').lower() == 'true'
+
+# Artefactos de sklearn que precarga cada función (por nombre de entrypoint)
+FUNCTION_ARTIFACTS = {
+    'predict_student_profile': KMEANS_ARTIFACTS,
+    'analyze_risk_on_schedule': REGRESSION_ARTIFACTS,
+    'calculate_risk': REGRESSION_ARTIFACTS,
+    'continueRiskAnalysis': REGRESSION_ARTIFACTS,
+    'recluster_profiles': KMEANS_ARTIFACTS,
+    'recluster_profiles_on_schedule': KMEANS_ARTIFACTS,
+}
+# Variante compilada de cada grupo (se precarga en su lugar con MODEL_COMPILED_SCORING)
+COMPILED_VARIANTS = {
+    KMEANS_ARTIFACTS: KMEANS_COMPILED,
+    REGRESSION_ARTIFACTS: REGRESSION_COMPILED,
+}
+
+# Solo se precarga en el runtime desplegado (no al analizar el código en el deploy)
+MODEL_PREFETCH_ON_START = os.environ.get(
+    'MODEL_PREFETCH_ON_START', 'true' if os.environ.get('K_SERVICE') else 'false'
+).lower() == 'true'
+# Carga los arrays numpy de los .pkl (joblib) con memoria mapeada para
+# compartir páginas entre instancias. No aplica a los .npz compilados.
+MODEL_MMAP_MODE = os.environ.get('MODEL_MMAP_MODE', 'r') or None
+MODEL_MANIFEST_LOCAL = '/tmp/model_manifest.json'
+MODEL_REVALIDATE_SECONDS = int(os.environ.get('MODEL_REVALIDATE_SECONDS', '600'))
+
+storage_client = None
+_storage_lock = threading.Lock()
+
+_models = {}
+_versions = {}
+_errors = {}
+_error_at = {}
+_ready = {name: threading.Event() for name in ARTIFACTS}
+_load_locks = {name: threading.Lock() for name in ARTIFACTS}
+_manifest_lock = threading.Lock()
+_swap_lock = threading.Lock()
+_last_checked = {}
+_refreshing = set()
+
+
+# ===============================================================
+#  FUNCIÓN HELPER: DESCARGAR DE GCS (ATÓMICO Y VERIFICADO)
+# ===============================================================
+def get_storage_client():
+    from google.cloud import storage
+    global storage_client
+
+    with _storage_lock:
+        if storage_client is None:
+            try:
+                print("🔄 Inicializando cliente GCS...")
+                storage_client = storage.Client()
+                print("✅ Cliente GCS inicializado.")
+            except Exception as gcs_init_e:
+                print(f"❌ Error FATAL inicializando GCS: {gcs_init_e}")
+                raise
+    return storage_client
+
+def file_md5_b64(path):
+    """MD5 en base64, el mismo formato que blob.md5_hash."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+def download_blob_atomic(blob, destination_file_name):
+    """Descarga a un temporal, verifica tamaño/MD5 y lo renombra al destino."""
+    os.makedirs(os.path.dirname(destination_file_name), exist_ok=True)
+    tmp_path = f"{destination_file_name}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        print(f"⬇️ Descargando {blob.name} (gen {blob.generation}) a {destination_file_name}...")
+        blob.download_to_filename(tmp_path)
+        if blob.size is not None and os.path.getsize(tmp_path) != blob.size:
+            raise IOError(f"Descarga truncada de {blob.name}: {os.path.getsize(tmp_path)} de {blob.size} bytes.")
+        # Los objetos compuestos no tienen MD5; en ese caso basta el tamaño
+        if blob.md5_hash and file_md5_b64(tmp_path) != blob.md5_hash:
+            raise IOError(f"Checksum MD5 inválido para {blob.name}.")
+        os.replace(tmp_path, destination_file_name)
+        print(f"✅ Descarga GCS verificada: {destination_file_name}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# ===============================================================
+#  CACHÉ LOCAL VERSIONADA (MANIFEST)
+# ===============================================================
+def read_manifest():
+    try:
+        with open(MODEL_MANIFEST_LOCAL) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest_entry(name, entry):
+    with _manifest_lock:
+        manifest = read_manifest()
+        manifest[name] = entry
+        tmp_path = f"{MODEL_MANIFEST_LOCAL}.{os.getpid()}.part"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, MODEL_MANIFEST_LOCAL)
+
+def get_remote_blob(name):
+    """Metadatos del blob (una sola llamada, sin descargar el contenido)."""
+    gcs_name, _ = ARTIFACTS[name]
+    blob = get_storage_client().bucket(GCS_BUCKET_NAME).get_blob(gcs_name)
+    if blob is None:
+        raise FileNotFoundError(f"No existe gs://{GCS_BUCKET_NAME}/{gcs_name}")
+    return blob
+
+def ensure_local_artifact(name):
+    """
+    Garantiza que /tmp tenga la última versión del artefacto. Devuelve
+    (ruta_local, versión). Si GCS no responde se reutiliza la copia local.
+    """
+    _, local_path = ARTIFACTS[name]
+    cached = read_manifest().get(name)
+
+    try:
+        blob = get_remote_blob(name)
+    except Exception as meta_error:
+        if cached and os.path.exists(local_path) and os.path.getsize(local_path) == cached.get('size'):
+            print(f"WARN: Sin metadatos de GCS para '{name}' ({meta_error}); usando copia local gen {cached['generation']}.")
+            return local_path, cached['generation']
+        raise
+
+    version = str(blob.generation)
+    if cached and cached.get('generation') == version and os.path.exists(local_path) \
+            and os.path.getsize(local_path) == blob.size:
+        return local_path, version
+
+    download_blob_atomic(blob, local_path)
+    write_manifest_entry(name, {'generation': version, 'md5': blob.md5_hash, 'size': blob.size})
+    return local_path, version
+
+
+# ===============================================================
+#  CARGA DE ARTEFACTOS
+# ===============================================================
+def log_cold_start_metric(name, download_ms, load_ms):
+    # Línea JSON: Cloud Logging la indexa como jsonPayload para métricas basadas en logs
+    print(json.dumps({
+        'severity': 'INFO',
+        'message': f'model_cold_start {name}',
+        'metric': 'model_cold_start',
+        'artifact': name,
+        'downloadMs': round(download_ms, 1),
+        'loadMs': round(load_ms, 1),
+    }))
+
+def load_file(name, local_path):
+    loader = ARTIFACT_LOADERS.get(name)
+    if loader is not None:
+        return loader(local_path)
+    import joblib
+    return joblib.load(local_path, mmap_mode=MODEL_MMAP_MODE)
+
+def load_artifact(name):
+    """Descarga (si hace falta) y carga un artefacto. Es idempotente."""
+    with _load_locks[name]:
+        if _ready[name].is_set() and name in _models:
+            return _models[name]
+
+        try:
+            started = time.monotonic()
+            local_path, version = ensure_local_artifact(name)
+            downloaded = time.monotonic()
+
+            print(f"🔄 Cargando artefacto '{name}' (gen {version}) desde {local_path}...")
+            model = load_file(name, local_path)
+            loaded = time.monotonic()
+            print(f"✅ Artefacto '{name}' cargado.")
+
+            with _swap_lock:
+                _models[name] = model
+                _versions[name] = version
+            _last_checked[name] = time.monotonic()
+            _errors.pop(name, None)
+            log_cold_start_metric(name, (downloaded - started) * 1000, (loaded - downloaded) * 1000)
+        except Exception as e:
+            print(f"❌ Error cargando artefacto '{name}': {e}")
+            _errors[name] = e
+            _error_at[name] = time.monotonic()
+            raise
+        finally:
+            # Se marca como resuelto también en error para no bloquear a quien espera
+            _ready[name].set()
+
+        return _models[name]
+
+def prefetch(names):
+    """Descarga y carga en paralelo los artefactos indicados."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    names = [name for name in names if name in ARTIFACTS]
+    if not names:
+        return
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix='prefetch') as executor:
+        for name, future in [(name, executor.submit(load_artifact, name)) for name in names]:
+            try:
+                future.result()
+            except Exception:
+                traceback.print_exc(limit=1)
+    print(f"✅ Precarga de modelos terminada en {(time.monotonic() - started) * 1000:.0f}ms: {', '.join(names)}")
+
+def prefetch_scoring(names):
+    """
+    Precarga la variante compilada del grupo si está activada; si no se puede
+    cargar (no publicada, paridad fallida...), precarga los .pkl de sklearn
+    para que la primera petición no tenga que cargarlos.
+    """
+    compiled = COMPILED_VARIANTS.get(tuple(names)) if MODEL_COMPILED_SCORING else None
+    if compiled:
+        prefetch(compiled)
+        if all(is_ready(name) for name in compiled):
+            return
+        print(f"WARN: Modelos compilados {', '.join(compiled)} no disponibles; precargando sklearn.")
+    prefetch(names)
+
+def start_prefetch(function_target=None):
+    """Lanza la precarga en un hilo daemon con los artefactos de la función."""
+    names = FUNCTION_ARTIFACTS.get(function_target or os.environ.get('FUNCTION_TARGET', ''), ())
+    if not names:
+        return None
+    thread = threading.Thread(target=prefetch_scoring, args=(names,), name='model-prefetch', daemon=True)
+    thread.start()
+    return thread
+
+
+# ===============================================================
+#  API PARA LOS HANDLERS
+# ===============================================================
+def is_ready(name):
+    return _ready[name].is_set() and name in _models
+
+def readiness():
+    """Estado por artefacto: 'ready', 'error' o 'pending'."""
+    status = {}
+    for name in ARTIFACTS:
+        if is_ready(name):
+            status[name] = 'ready'
+        elif name in _errors:
+            status[name] = 'error'
+        else:
+            status[name] = 'pending'
+    return status
+
+def refresh_artifacts(names):
+    """
+    Revalida un grupo de artefactos contra GCS y, si alguno cambió de
+    versión, carga los nuevos y los reemplaza juntos (preprocesador y modelo
+    deben corresponder a la misma publicación).
+    """
+    try:
+        updates = {}
+        for name in names:
+            local_path, version = ensure_local_artifact(name)
+            if version != _versions.get(name):
+                updates[name] = (load_file(name, local_path), version)
+
+        now = time.monotonic()
+        with _swap_lock:
+            for name, (model, version) in updates.items():
+                print(f"🔁 Modelo '{name}' actualizado: gen {_versions.get(name)} -> {version}")
+                _models[name] = model
+                _versions[name] = version
+            for name in names:
+                _last_checked[name] = now
+    except Exception as e:
+        print(f"WARN: No se pudo revalidar {', '.join(names)}: {e}")
+        for name in names:
+            _last_checked[name] = time.monotonic()
+    finally:
+        with _swap_lock:
+            _refreshing.difference_update(names)
+
+def refresh_if_stale(names):
+    """Lanza la revalidación en segundo plano si el grupo está vencido."""
+    if MODEL_REVALIDATE_SECONDS <= 0:
+        return
+    now = time.monotonic()
+    with _swap_lock:
+        stale = [name for name in names
+                 if name in _models and name not in _refreshing
+                 and now - _last_checked.get(name, now) >= MODEL_REVALIDATE_SECONDS]
+        if not stale:
+            return
+        _refreshing.update(names)
+    threading.Thread(target=refresh_artifacts, args=(tuple(names),), name='model-refresh', daemon=True).start()
+
+def get_model(name):
+    """
+    Devuelve el artefacto cargado. Si la precarga lo está cargando, espera solo
+    por él (no por el resto); si no se inició o falló, lo carga en este hilo.
+    """
+    if is_ready(name):
+        return _models[name]
+    return load_artifact(name)
+
+def get_models_with_version(names):
+    """
+    Devuelve (artefactos, versiones) de un grupo, leídos juntos para que la
+    versión reportada sea la que realmente atiende la petición.
+    """
+    for name in names:
+        get_model(name)
+    refresh_if_stale(names)
+    with _swap_lock:
+        return tuple(_models[name] for name in names), {name: _versions.get(name) for name in names}
+
+def get_models(names):
+    return get_models_with_version(names)[0]
+
+def retry_failed_artifacts(names):
+    try:
+        for name in names:
+            try:
+                load_artifact(name)
+            except Exception:
+                pass
+    finally:
+        with _swap_lock:
+            _refreshing.difference_update(names)
+
+def retry_failed_in_background(names):
+    """Reintenta en segundo plano los artefactos que fallaron hace más de MODEL_REVALIDATE_SECONDS."""
+    now = time.monotonic()
+    with _swap_lock:
+        due = [name for name in names
+               if name in _errors and not is_ready(name) and name not in _refreshing
+               and now - _error_at.get(name, 0) >= MODEL_REVALIDATE_SECONDS]
+        if not due:
+            return
+        _refreshing.update(due)
+    threading.Thread(target=retry_failed_artifacts, args=(tuple(due),), name='model-retry', daemon=True).start()
+
+def get_optional_models_with_version(names):
+    """
+    Como get_models_with_version, pero devuelve None si algún artefacto no
+    está disponible (p. ej. el modelo compilado no se ha publicado). Tras un
+    fallo la petición no vuelve a consultar GCS: se devuelve None al momento y
+    el reintento se hace en segundo plano cada MODEL_REVALIDATE_SECONDS.
+    """
+    if any(name in _errors and not is_ready(name) for name in names):
+        retry_failed_in_background(names)
+        return None
+    try:
+        return get_models_with_version(names)
+    except Exception:
+        return None
+
+
+if MODEL_PREFETCH_ON_START:
+    start_prefetch()
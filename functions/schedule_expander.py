@@ -0,0 +1,278 @@
+# functions/schedule_expander.py
+
+# --- Expansión vectorizada de clases semanales ---
+# importSchedule convertía cada clase en un rrule semanal y, por cada
+# ocurrencia, hacía dos datetime.combine y dos pytz.localize. Aquí se calculan
+# todas las ocurrencias de todas las clases a la vez con aritmética
+# datetime64 de numpy, y el desfase UTC de cada hora local se busca en la
+# tabla de transiciones de la zona (precalculada una vez por instancia).
+#
+# El resultado es idéntico al de rrule + localize(is_dst=False): mismas
+# fechas, mismo orden y el mismo tzinfo de pytz. Las horas que caen en una
+# transición (inexistentes al adelantar el reloj o ambiguas al atrasarlo) se
+# delegan a pytz para respetar exactamente sus reglas.
+#
+# Comparar con la ruta rrule (paridad y tiempos):
+#   python schedule_expander.py bench [clases] [semanas] [inicio AAAA-MM-DD]
+import sys
+import time
+import random
+import datetime
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+import pytz
+
+DEFAULT_TIMEZONE = "America/Mexico_City"
+
+# weekday: 0 = lunes ... 6 = domingo (como date.weekday() y rrule.MO.weekday)
+# payload: campos del evento que no dependen de la fecha (title, subject, ...)
+# key: identificador libre del llamador; se devuelve con cada ocurrencia
+ClassSlot = namedtuple('ClassSlot', ['weekday', 'start', 'end', 'payload', 'key'], defaults=(None,))
+
+_SECOND = np.timedelta64(1, 's')
+
+
+class TransitionTable:
+    """
+    Transiciones de una zona pytz en hora local: para cada tramo entre
+    transiciones, el desfase UTC y el tzinfo que devolvería localize.
+    """
+
+    def __init__(self, tz):
+        self.tz = tz
+        transitions = getattr(tz, '_utc_transition_times', None)
+        if not transitions:
+            # Zona sin transiciones (UTC o desfase fijo)
+            self.tzinfos = [tz]
+            offset = int(tz.utcoffset(datetime.datetime(2000, 1, 1)).total_seconds())
+            self.wall_min = np.array([np.datetime64('0001-01-01T00:00:00')])
+            self.wall_max = self.wall_min
+            self.offsets = np.array([offset], dtype=np.int64)
+            return
+
+        self.tzinfos = [tz._tzinfos[info] for info in tz._transition_info]
+        offsets = np.array([int(info[0].total_seconds()) for info in tz._transition_info], dtype=np.int64)
+        utc_times = np.array(transitions, dtype='datetime64[s]')
+        previous = np.concatenate([offsets[:1], offsets[:-1]])
+        # Hora local en la que empieza / termina el hueco o solape de cada transición
+        self.wall_min = utc_times + np.minimum(previous, offsets) * _SECOND
+        self.wall_max = utc_times + np.maximum(previous, offsets) * _SECOND
+        self.offsets = offsets
+
+    def lookup(self, wall_times):
+        """
+        Para horas locales (datetime64[s]) devuelve (tramo, en_transición).
+        Fuera de transición el tramo es único y su tzinfo es el de localize.
+        """
+        segment = np.searchsorted(self.wall_min, wall_times, side='right') - 1
+        segment = np.maximum(segment, 0)
+        in_transition = wall_times < self.wall_max[segment]
+        return segment, in_transition
+
+
+@lru_cache(maxsize=8)
+def transition_table(tz_name=DEFAULT_TIMEZONE):
+    return TransitionTable(pytz.timezone(tz_name))
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+def _localize(table, wall_times):
+    segments, in_transition = table.lookup(wall_times)
+    tzinfos = table.tzinfos
+    localize = table.tz.localize
+    for naive, segment, special in zip(wall_times.astype(object).tolist(), segments.tolist(), in_transition.tolist()):
+        yield localize(naive) if special else naive.replace(tzinfo=tzinfos[segment])
+
+def expand_weekly(slots, start_date, until, tz_name=DEFAULT_TIMEZONE):
+    """
+    Genera (slot, fecha, evento) para cada ocurrencia semanal de cada clase
+    entre start_date y until (inclusive, como rrule), en el orden de la ruta
+    rrule: clase por clase y cada una por fecha ascendente. El evento es el
+    payload de la clase con 'start' y 'end' ya localizados.
+    """
+    if not slots:
+        return
+    if isinstance(until, datetime.datetime):
+        until = until.date()
+    start_day = np.datetime64(start_date, 'D')
+    until_day = np.datetime64(until, 'D')
+
+    weekdays = np.array([slot.weekday for slot in slots], dtype=np.int64)
+    first_days = start_day + ((weekdays - start_date.weekday()) % 7).astype('timedelta64[D]')
+    counts = np.where(first_days <= until_day, (until_day - first_days).astype(np.int64) // 7 + 1, 0)
+    total = int(counts.sum())
+    if total == 0:
+        return
+
+    slot_index = np.repeat(np.arange(len(slots)), counts)
+    week = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    days = first_days[slot_index] + (week * 7).astype('timedelta64[D]')
+
+    start_minutes = np.array([_minutes(slot.start) for slot in slots], dtype=np.int64)[slot_index]
+    end_minutes = np.array([_minutes(slot.end) for slot in slots], dtype=np.int64)[slot_index]
+    day_starts = days.astype('datetime64[s]')
+    table = transition_table(tz_name)
+    starts = _localize(table, day_starts + start_minutes * 60 * _SECOND)
+    ends = _localize(table, day_starts + end_minutes * 60 * _SECOND)
+
+    for index, ev_date, start, end in zip(slot_index.tolist(), days.astype(object).tolist(), starts, ends):
+        slot = slots[index]
+        event = dict(slot.payload)
+        event['start'] = start
+        event['end'] = end
+        yield slot, ev_date, event
+
+
+# ===============================================================
+#  SERIES RECURRENTES (un documento por clase semanal)
+# ===============================================================
+# Una serie guarda la regla en lugar de las instancias:
+#   rrule:      "FREQ=WEEKLY;BYDAY=MO;UNTIL=20250613" (RFC 5545, solo semanal)
+#   dtstart:    "2025-01-06" (fecha local de la primera semana)
+#   startTime / endTime: "09:00" / "10:30" (hora local)
+#   timezone:   "America/Mexico_City"
+#   exceptions: ["2025-03-17", ...] fechas locales sin clase
+RRULE_WEEKDAYS = {'MO': 0, 'TU': 1, 'WE': 2, 'TH': 3, 'FR': 4, 'SA': 5, 'SU': 6}
+SERIES_SCHEDULE_FIELDS = ['rrule', 'dtstart', 'startTime', 'endTime', 'timezone', 'exceptions']
+
+def weekly_rrule(weekday, until):
+    byday = next(code for code, index in RRULE_WEEKDAYS.items() if index == weekday)
+    return f"FREQ=WEEKLY;BYDAY={byday};UNTIL={until.strftime('%Y%m%d')}"
+
+def parse_weekly_rrule(rule):
+    """Devuelve (weekday, until) de una regla semanal de un solo día."""
+    parts = dict(part.split('=', 1) for part in (rule or '').upper().split(';') if '=' in part)
+    if parts.get('FREQ') != 'WEEKLY' or parts.get('BYDAY') not in RRULE_WEEKDAYS \
+            or parts.get('INTERVAL', '1') != '1' or 'COUNT' in parts:
+        raise ValueError(f"RRULE no soportada: {rule!r}")
+    until = datetime.datetime.strptime(parts['UNTIL'][:8], '%Y%m%d').date() if 'UNTIL' in parts else None
+    return RRULE_WEEKDAYS[parts['BYDAY']], until
+
+def series_slot(series_id, series):
+    """ClassSlot de una serie; key = (id, dtstart, until, excepciones)."""
+    weekday, until = parse_weekly_rrule(series.get('rrule'))
+    start = datetime.datetime.strptime(series['startTime'], '%H:%M').time()
+    end = datetime.datetime.strptime(series['endTime'], '%H:%M').time()
+    dtstart = datetime.date.fromisoformat(series['dtstart'])
+    exceptions = frozenset(series.get('exceptions') or [])
+    payload = {field: value for field, value in series.items() if field not in SERIES_SCHEDULE_FIELDS}
+    return ClassSlot(weekday, start, end, payload, key=(series_id, dtstart, until, exceptions))
+
+def occurrence_id(series_id, ev_date):
+    return f"{series_id}_{ev_date.strftime('%Y%m%d')}"
+
+def expand_series(series_by_id, window_start, window_end):
+    """
+    Genera de forma perezosa (id_ocurrencia, evento) de las series cuyo inicio
+    cae en [window_start, window_end] (datetimes con zona). Solo se expande la
+    ventana: las series sin fin no cuestan más que las acotadas.
+    """
+    by_zone = {}
+    for series_id, series in series_by_id.items():
+        try:
+            slot = series_slot(series_id, series)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"WARN: Serie {series_id} inválida, se omite: {e}")
+            continue
+        by_zone.setdefault(series.get('timezone') or DEFAULT_TIMEZONE, []).append(slot)
+
+    for tz_name, slots in by_zone.items():
+        tz = pytz.timezone(tz_name)
+        # Un día de margen a cada lado: la ventana es UTC y las fechas son locales
+        first_day = window_start.astimezone(tz).date() - datetime.timedelta(days=1)
+        last_day = window_end.astimezone(tz).date() + datetime.timedelta(days=1)
+        for slot, ev_date, event in expand_weekly(slots, first_day, last_day, tz_name):
+            series_id, dtstart, until, exceptions = slot.key
+            if ev_date < dtstart or (until is not None and ev_date > until) or ev_date.isoformat() in exceptions:
+                continue
+            if window_start <= event['start'] <= window_end:
+                yield occurrence_id(series_id, ev_date), event
+
+
+# ===============================================================
+#  MICROBENCHMARK
+# ===============================================================
+def expand_with_rrule(slots, start_date, until, tz_name=DEFAULT_TIMEZONE):
+    """La ruta original de importSchedule (referencia para paridad y tiempos)."""
+    from dateutil import rrule
+
+    local_tz = pytz.timezone(tz_name)
+    for slot in slots:
+        rule = rrule.rrule(rrule.WEEKLY, byweekday=[slot.weekday], dtstart=start_date, until=until)
+        for ev_date in rule:
+            event = dict(slot.payload)
+            event['start'] = local_tz.localize(datetime.datetime.combine(ev_date.date(), slot.start))
+            event['end'] = local_tz.localize(datetime.datetime.combine(ev_date.date(), slot.end))
+            yield slot, ev_date.date(), event
+
+def synthetic_slots(count, seed=7, hours=range(7, 21)):
+    rng = random.Random(seed)
+    slots = []
+    for index in range(count):
+        hour = rng.choice(hours)
+        start = datetime.time(hour, rng.choice([0, 30]))
+        end = (datetime.datetime.combine(datetime.date.min, start) + datetime.timedelta(minutes=rng.choice([60, 90, 120]))).time()
+        slots.append(ClassSlot(rng.randrange(7), start, end, {'title': f'Materia {index}', 'subject': f'subj{index}'}))
+    return slots
+
+def transition_slots():
+    # Clases a medianoche y a las 00:30-03:00: cubren el hueco y el solape del cambio de horario
+    slots = []
+    for weekday in range(7):
+        for hour, minute in [(0, 0), (0, 30), (1, 0), (1, 30), (2, 0), (2, 30)]:
+            start = datetime.time(hour, minute)
+            end = datetime.time(hour + 1, minute)
+            slots.append(ClassSlot(weekday, start, end, {'title': f'{weekday}-{start}'}))
+    return slots
+
+def _key(item):
+    slot, ev_date, event = item
+    return slot, ev_date, event['start'], event['start'].tzinfo, event['end'], event['end'].tzinfo
+
+def parity(slots, start_date, until, tz_name=DEFAULT_TIMEZONE):
+    expected = [_key(item) for item in expand_with_rrule(slots, start_date, until, tz_name)]
+    got = [_key(item) for item in expand_weekly(slots, start_date, until, tz_name)]
+    return expected == got, len(expected)
+
+def benchmark(classes=50, weeks=52, start_date=None, runs=5):
+    start_date = start_date or datetime.date.today()
+    start_date -= datetime.timedelta(days=start_date.weekday())
+    until = datetime.datetime.combine(start_date + datetime.timedelta(weeks=weeks), datetime.time.min)
+    slots = synthetic_slots(classes)
+    transition_table()  # la tabla se construye una vez por instancia
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        events = sum(1 for _ in expand_with_rrule(slots, start_date, until))
+    rrule_ms = (time.perf_counter() - started) * 1000 / runs
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        sum(1 for _ in expand_weekly(slots, start_date, until))
+    numpy_ms = (time.perf_counter() - started) * 1000 / runs
+
+    same, _ = parity(slots, start_date, until)
+    print(f"⏱️ {classes} clases x {weeks} semanas ({events} eventos): rrule={rrule_ms:.1f}ms, "
+          f"numpy={numpy_ms:.1f}ms (x{rrule_ms / numpy_ms:.1f}), mismos eventos: {same}")
+
+    # Paridad en años con horario de verano (México lo abolió en 2022)
+    dst_start = datetime.date(2015, 12, 28)
+    same_dst, count_dst = parity(transition_slots(), dst_start, datetime.datetime(2023, 1, 1))
+    print(f"🕑 Paridad en cambios de horario 2016-2022 ({count_dst} eventos a 00:00-03:30): {same_dst}")
+
+def main(argv):
+    if not argv or argv[0] != 'bench':
+        print("Uso: python schedule_expander.py bench [clases] [semanas] [inicio AAAA-MM-DD]")
+        return 2
+    classes = int(argv[1]) if len(argv) > 1 else 50
+    weeks = int(argv[2]) if len(argv) > 2 else 52
+    start_date = datetime.date.fromisoformat(argv[3]) if len(argv) > 3 else None
+    benchmark(classes, weeks, start_date)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,286 @@
+# functions/schedule_extraction.py
+
+# --- Extracción del horario (Gemini) detrás de una interfaz ---
+# importSchedule solo conoce ScheduleExtractor.extract(file_bytes, mime_type),
+# que devuelve la lista [{materia, diaSemana, horaInicio, horaFin}]:
+#   GeminiScheduleExtractor: la llamada real a Gemini 2.5 Pro (Vertex AI).
+#   FakeScheduleExtractor:   respuesta fija, para pruebas y el emulador
+#                            (SCHEDULE_EXTRACTOR_FAKE_FILE=horario.json).
+#   CachedScheduleExtractor: caché en Firestore por contenido.
+#
+# La caché se indexa con el SHA-256 del archivo, su tipo y la versión del
+# extractor (modelo + hash del prompt): cambiar el prompt o el modelo invalida
+# todas las entradas. Cada entrada caduca a los EXTRACTION_CACHE_TTL_DAYS
+# días ('expiresAt'; conviene activar la política TTL de Firestore sobre ese
+# campo para purgarlas) y solo se guardan resultados de hasta
+# EXTRACTION_CACHE_MAX_BYTES. Los contadores de la caché se publican como
+# línea JSON como mucho cada EXTRACTION_STATS_LOG_SECONDS segundos.
+import os
+import abc
+import json
+import time
+import hashlib
+import datetime
+import threading
+
+import google.auth
+from firebase_admin import firestore
+
+# --- CONFIGURACIÓN ---
+VISION_MODEL_NAME = os.environ.get('VISION_MODEL_NAME', 'gemini-2.5-pro')
+VERTEX_LOCATION = 'us-central1'
+EXTRACTION_CACHE_ENABLED = os.environ.get('EXTRACTION_CACHE_ENABLED', 'true').lower() == 'true'
+EXTRACTION_CACHE_COLLECTION = os.environ.get('EXTRACTION_CACHE_COLLECTION', 'scheduleExtractionCache')
+EXTRACTION_CACHE_TTL_DAYS = int(os.environ.get('EXTRACTION_CACHE_TTL_DAYS', '30'))
+# Muy por debajo del límite de 1 MiB por documento
+EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_BYTES', '262144'))
+SCHEDULE_EXTRACTOR_FAKE_FILE = os.environ.get('SCHEDULE_EXTRACTOR_FAKE_FILE', '')
+EXTRACTION_STATS_LOG_SECONDS = float(os.environ.get('EXTRACTION_STATS_LOG_SECONDS', '300'))
+
+SCHEDULE_PROMPT = """Analiza imagen/PDF de horario. Extrae clases semanales. Devuelve SOLAMENTE lista JSON: [{'materia': string, 'diaSemana': string(Español minúsculas sin acentos, ej: lunes, miercoles), 'horaInicio': string(HH:MM 24h), 'horaFin': string(HH:MM 24h)}]. Ignora otros textos. No uses null. No inventes. Ej: [{'materia': 'Calculo I', 'diaSemana': 'lunes', 'horaInicio': '09:00', 'horaFin': '10:30'}, ...]"""
+
+
+class ExtractorUnavailable(Exception):
+    """El modelo no se pudo inicializar (dependencia ausente o Vertex AI caído)."""
+
+
+class ScheduleExtractor(abc.ABC):
+    """Interfaz: extrae las clases semanales de un archivo de horario."""
+
+    # Identifica prompt y modelo: forma parte de la clave de la caché
+    version = 'base'
+
+    @abc.abstractmethod
+    def extract(self, file_bytes, mime_type):
+        """Devuelve la lista [{materia, diaSemana, horaInicio, horaFin}]."""
+
+
+class GeminiScheduleExtractor(ScheduleExtractor):
+
+    def __init__(self, model_name=VISION_MODEL_NAME):
+        self.model_name = model_name
+        prompt_hash = hashlib.sha256(SCHEDULE_PROMPT.encode('utf-8')).hexdigest()[:12]
+        self.version = f'{model_name}:{prompt_hash}'
+        self._model = None
+        self._lock = threading.Lock()
+
+    def model(self):
+        """Inicializa Vertex AI y el modelo de visión una vez por instancia."""
+        with self._lock:
+            if self._model is not None:
+                return self._model
+            try:
+                import vertexai
+                from vertexai.generative_models import GenerativeModel
+
+                print("🔄 Init Vertex AI SDK...")
+                credentials, PROJECT_ID = google.auth.default()
+                vertexai.init(project=PROJECT_ID, location=VERTEX_LOCATION, credentials=credentials)
+                self._model = GenerativeModel(self.model_name)
+                print(f"✅ Vertex AI SDK OK ({self.model_name}).")
+            except ImportError as e:
+                print("❌ vertexai not installed.")
+                raise ExtractorUnavailable('IA dependency missing.') from e
+            except Exception as e:
+                print(f"❌ Vertex AI init error: {e}.")
+                raise ExtractorUnavailable(f'IA init error: {str(e)}') from e
+            return self._model
+
+    def extract(self, file_bytes, mime_type):
+        print("🤖 Calling Gemini...")
+        from vertexai.generative_models import Part, FinishReason
+        import vertexai.preview.generative_models as generative_models
+
+        image_part = Part.from_data(data=file_bytes, mime_type=mime_type)
+        text_part = Part.from_text(SCHEDULE_PROMPT)
+
+        gen_config = generative_models.GenerationConfig(
+            temperature=0.1, 
+            max_output_tokens=8192
+        )
+
+        safety_settings = {
+            generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+            generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+            generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+            generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+        }
+
+        response = self.model().generate_content(
+            [image_part, text_part], 
+            generation_config=gen_config, 
+            safety_settings=safety_settings, 
+            stream=False
+        )
+
+        # Validar respuesta de Gemini
+        if not response.candidates or response.candidates[0].finish_reason != FinishReason.STOP:
+            finish_reason = response.candidates[0].finish_reason if response.candidates else "No candidates"
+            safety_ratings = response.candidates[0].safety_ratings if response.candidates and response.candidates[0].safety_ratings else "N/A"
+
+            if finish_reason == FinishReason.SAFETY:
+                raise ValueError(f"La IA bloqueó la respuesta por seguridad. Razón: {safety_ratings}")
+            else:
+                raise ValueError(f"Respuesta inválida de la IA. Razón: {finish_reason}.")
+
+        if not response.candidates[0].content.parts: 
+            raise ValueError("Respuesta válida de IA pero sin contenido.")
+
+        raw_json = response.candidates[0].content.parts[0].text
+        clean_json = raw_json.strip().lstrip('```json').rstrip('```').strip()
+        print(f"Gemini JSON (clean):\n{clean_json}")
+
+        # Parsear JSON
+        try: 
+            schedule_data = json.loads(clean_json)
+        except json.JSONDecodeError as json_err:
+            try:
+                json_start = clean_json.find('[')
+                json_end = clean_json.rfind(']') + 1
+                if json_start != -1 and json_end != -1:
+                    clean_json = clean_json[json_start:json_end]
+                    schedule_data = json.loads(clean_json)
+                    print("ADVERTENCIA: JSON extraído de una respuesta con texto adicional.")
+                else: 
+                    raise ValueError("No se encontró una lista JSON válida.")
+            except (json.JSONDecodeError, ValueError):
+                print(f"❌ Error parseando JSON de Gemini: {json_err}. Raw: {raw_json[:500]}...")
+                raise ValueError("La respuesta de la IA no es un JSON válido o está mal formateada.")
+
+        if not isinstance(schedule_data, list): 
+            raise ValueError("La respuesta de la IA no es una lista JSON como se esperaba.")
+
+        print(f"✅ Gemini extrajo {len(schedule_data)} items del horario.")
+        return schedule_data
+
+
+class FakeScheduleExtractor(ScheduleExtractor):
+    """Devuelve siempre la misma lista (sin llamar al modelo)."""
+
+    version = 'fake'
+
+    def __init__(self, schedule_data):
+        self.schedule_data = schedule_data
+        self.calls = 0
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as fake_file:
+            return cls(json.load(fake_file))
+
+    def extract(self, file_bytes, mime_type):
+        self.calls += 1
+        return json.loads(json.dumps(self.schedule_data))
+
+
+class CachedScheduleExtractor(ScheduleExtractor):
+    """Caché por contenido delante de otro extractor (Firestore)."""
+
+    def __init__(self, inner, db):
+        self.inner = inner
+        self.db = db
+        self.version = inner.version
+
+    def cache_key(self, file_bytes, mime_type):
+        digest = hashlib.sha256()
+        digest.update(self.version.encode('utf-8') + b'\0')
+        digest.update((mime_type or '').encode('utf-8') + b'\0')
+        digest.update(file_bytes)
+        return digest.hexdigest()
+
+    def extract(self, file_bytes, mime_type):
+        key = self.cache_key(file_bytes, mime_type)
+        cache_ref = self.db.collection(EXTRACTION_CACHE_COLLECTION).document(key)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        try:
+            cache_doc = cache_ref.get()
+            entry = cache_doc.to_dict() if cache_doc.exists else None
+        except Exception as e:
+            print(f"WARN: No se pudo leer la caché de extracción: {e}")
+            entry = None
+        if entry and entry.get('version') == self.version and _not_expired(entry.get('expiresAt'), now):
+            _count('hits')
+            print(f"♻️ Horario en caché ({key[:12]}…): se omite la llamada al modelo.")
+            return entry['scheduleData']
+
+        _count('misses')
+        schedule_data = self.inner.extract(file_bytes, mime_type)
+
+        size = len(json.dumps(schedule_data, ensure_ascii=False).encode('utf-8'))
+        if size > EXTRACTION_CACHE_MAX_BYTES:
+            _count('skipped')
+            print(f"ℹ️ Resultado de {size} bytes: no se guarda en la caché de extracción.")
+            return schedule_data
+        try:
+            cache_ref.set({
+                'scheduleData': schedule_data,
+                'version': self.version,
+                'mimeType': mime_type,
+                'fileSize': len(file_bytes),
+                'size': size,
+                'createdAt': firestore.SERVER_TIMESTAMP,
+                'expiresAt': now + datetime.timedelta(days=EXTRACTION_CACHE_TTL_DAYS),
+            })
+        except Exception as e:
+            print(f"WARN: No se pudo guardar en la caché de extracción: {e}")
+        return schedule_data
+
+
+def _not_expired(expires_at, now):
+    if hasattr(expires_at, 'to_datetime') and not isinstance(expires_at, datetime.datetime):
+        expires_at = expires_at.to_datetime()
+    if not isinstance(expires_at, datetime.datetime):
+        return False
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    return expires_at > now
+
+
+# ===============================================================
+#  MÉTRICAS Y EXTRACTOR POR DEFECTO
+# ===============================================================
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'skipped': 0}
+_stats_logged_at = None
+_extractor = None
+
+def _count(name):
+    global _stats_logged_at
+    now = time.monotonic()
+    with _stats_lock:
+        _stats[name] += 1
+        # La primera consulta de la instancia y después como mucho una vez por intervalo
+        due = _stats_logged_at is None or now - _stats_logged_at >= EXTRACTION_STATS_LOG_SECONDS
+        if due:
+            _stats_logged_at = now
+    if due:
+        log_cache_stats()
+
+def stats():
+    with _stats_lock:
+        snapshot = dict(_stats)
+    lookups = snapshot['hits'] + snapshot['misses']
+    snapshot['hitRate'] = round(snapshot['hits'] / lookups, 4) if lookups else 0.0
+    return snapshot
+
+def log_cache_stats():
+    # Línea JSON: Cloud Logging la indexa como jsonPayload para métricas basadas en logs
+    print(json.dumps(dict(stats(), severity='INFO', message='schedule_extraction_cache',
+                          metric='schedule_extraction_cache')))
+
+def set_extractor(extractor):
+    """Sustituye el extractor de la instancia (pruebas: FakeScheduleExtractor)."""
+    global _extractor
+    _extractor = extractor
+
+def get_extractor(db):
+    """Extractor de la instancia: Gemini (o el fake configurado) con la caché delante."""
+    global _extractor
+    if _extractor is None:
+        if SCHEDULE_EXTRACTOR_FAKE_FILE:
+            inner = FakeScheduleExtractor.from_file(SCHEDULE_EXTRACTOR_FAKE_FILE)
+        else:
+            inner = GeminiScheduleExtractor()
+        _extractor = CachedScheduleExtractor(inner, db) if EXTRACTION_CACHE_ENABLED else inner
+    return _extractor
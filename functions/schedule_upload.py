@@ -0,0 +1,219 @@
+# functions/schedule_upload.py
+
+# --- Lectura del archivo de horario subido a importSchedule ---
+# Formatos aceptados:
+#   multipart/form-data: campo 'file' + campos endDate, storeAs, async, fileType.
+#   Binario crudo (application/pdf, image/*, application/octet-stream): el
+#     cuerpo es el archivo; los parámetros van en la query (?endDate=...).
+#   JSON (formato original): {'fileData': base64, 'endDate', 'fileType', ...}.
+# El Content-Length se compara con el máximo de cada formato antes de leer el
+# cuerpo. En multipart se usa directamente el archivo que werkzeug ya volcó a
+# disco al parsear el formulario; el binario crudo se copia por bloques a un
+# temporal. En ambos se calcula el SHA-256 por bloques, sin pasar por base64
+# ni cargar el archivo completo en memoria.
+#
+# Antes de enviarlas al modelo, las imágenes grandes se reducen a
+# UPLOAD_IMAGE_MAX_SIDE px y se recomprimen como JPEG (requiere Pillow; si no
+# está instalado se envían tal cual). Los PDF se envían sin cambios.
+import os
+import io
+import base64
+import hashlib
+import tempfile
+
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 256 * 1024
+# Margen para los separadores y campos del formulario o del JSON
+UPLOAD_BODY_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_IMAGE_MAX_SIDE = int(os.environ.get('UPLOAD_IMAGE_MAX_SIDE', '2048'))
+UPLOAD_IMAGE_JPEG_QUALITY = int(os.environ.get('UPLOAD_IMAGE_JPEG_QUALITY', '85'))
+UPLOAD_FILE_FIELD = 'file'
+UPLOAD_PARAMS = ('endDate', 'fileType', 'storeAs', 'async')
+
+RAW_CONTENT_TYPES = ('application/pdf', 'application/octet-stream')
+# Formatos que Pillow puede reducir y recomprimir sin perder información útil
+RECOMPRESSIBLE_TYPES = ('image/png', 'image/jpeg', 'image/jpg', 'image/webp', 'image/bmp', 'image/tiff')
+
+
+class UploadError(ValueError):
+    """Cuerpo mal formado o sin archivo (400)."""
+
+
+class UploadTooLarge(UploadError):
+    """El archivo supera UPLOAD_MAX_BYTES (413)."""
+
+
+class ScheduleUpload:
+    """Archivo recibido (objeto de archivo con seek: temporal o en memoria) y parámetros de la petición."""
+
+    def __init__(self, params, mime_type, file, size, sha256):
+        self.params = params
+        self.mime_type = mime_type
+        self.file = file
+        self.size = size
+        self.sha256 = sha256
+
+    def open(self):
+        """El archivo rebobinado al inicio, para leerlo por bloques."""
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def base_content_type(req):
+    return (req.headers.get('Content-Type') or '').split(';', 1)[0].strip().lower()
+
+def is_raw_content_type(content_type):
+    return content_type in RAW_CONTENT_TYPES or content_type.startswith('image/')
+
+def max_body_bytes(content_type):
+    """Tamaño máximo del cuerpo para un archivo de UPLOAD_MAX_BYTES en cada formato."""
+    if is_raw_content_type(content_type):
+        return UPLOAD_MAX_BYTES
+    if content_type == 'multipart/form-data':
+        return UPLOAD_MAX_BYTES + UPLOAD_BODY_OVERHEAD_BYTES
+    # base64 ocupa 4 bytes por cada 3
+    return -(-UPLOAD_MAX_BYTES // 3) * 4 + UPLOAD_BODY_OVERHEAD_BYTES
+
+def check_content_length(req, content_type):
+    """Rechaza el cuerpo por su Content-Length, antes de leerlo o parsearlo."""
+    limit = max_body_bytes(content_type)
+    if req.content_length is not None and req.content_length > limit:
+        raise UploadTooLarge(f"Request body of {req.content_length} bytes exceeds {limit} bytes.")
+
+def hash_file(upload_file):
+    """Recorre por bloques un archivo con seek y lo rebobina. Devuelve (tamaño, sha256)."""
+    digest = hashlib.sha256()
+    size = 0
+    upload_file.seek(0)
+    while True:
+        chunk = upload_file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > UPLOAD_MAX_BYTES:
+            raise UploadTooLarge(f"File exceeds {UPLOAD_MAX_BYTES} bytes.")
+        digest.update(chunk)
+    upload_file.seek(0)
+    if size == 0:
+        raise UploadError("Empty file.")
+    return size, digest.hexdigest()
+
+def spool_to_tempfile(stream):
+    """Copia el stream por bloques a un temporal anónimo. Devuelve (archivo, tamaño, sha256)."""
+    digest = hashlib.sha256()
+    size = 0
+    upload_file = tempfile.TemporaryFile(prefix='schedule-upload-')
+    try:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                raise UploadTooLarge(f"File exceeds {UPLOAD_MAX_BYTES} bytes.")
+            digest.update(chunk)
+            upload_file.write(chunk)
+        if size == 0:
+            raise UploadError("Empty file.")
+    except Exception:
+        upload_file.close()
+        raise
+    upload_file.seek(0)
+    return upload_file, size, digest.hexdigest()
+
+def read_upload(req):
+    """Lee el archivo y los parámetros de la petición (una sola lectura del cuerpo)."""
+    content_type = base_content_type(req)
+    check_content_length(req, content_type)
+
+    if content_type == 'multipart/form-data':
+        # werkzeug ya vuelca a disco los archivos grandes al parsear el formulario:
+        # se usa ese mismo archivo, sin otra copia
+        file_storage = req.files.get(UPLOAD_FILE_FIELD)
+        if file_storage is None:
+            raise UploadError(f"Missing '{UPLOAD_FILE_FIELD}' field in multipart body.")
+        params = {name: req.form.get(name) for name in UPLOAD_PARAMS if req.form.get(name) is not None}
+        mime_type = params.get('fileType') or file_storage.mimetype or 'application/octet-stream'
+        try:
+            size, sha256 = hash_file(file_storage.stream)
+        except Exception:
+            file_storage.close()
+            raise
+        return ScheduleUpload(params, mime_type, file_storage.stream, size, sha256)
+
+    if is_raw_content_type(content_type):
+        params = {name: req.args.get(name) for name in UPLOAD_PARAMS if req.args.get(name) is not None}
+        mime_type = params.get('fileType') or content_type
+        upload_file, size, sha256 = spool_to_tempfile(req.stream)
+        return ScheduleUpload(params, mime_type, upload_file, size, sha256)
+
+    if not req.is_json:
+        raise UploadError("Request must be JSON, multipart/form-data or a raw file body.")
+    req_data = req.get_json(silent=True)
+    if not isinstance(req_data, dict):
+        raise UploadError("Invalid JSON body.")
+    file_b64 = req_data.get('fileData')
+    if not file_b64:
+        raise UploadError("Missing fileData or endDate.")
+    try:
+        data = base64.b64decode(file_b64)
+    except (TypeError, base64.binascii.Error):
+        raise UploadError("Invalid fileData format (base64).")
+    if len(data) > UPLOAD_MAX_BYTES:
+        raise UploadTooLarge(f"File exceeds {UPLOAD_MAX_BYTES} bytes.")
+    params = {name: req_data.get(name) for name in UPLOAD_PARAMS if req_data.get(name) is not None}
+    mime_type = params.get('fileType') or 'application/octet-stream'
+    return ScheduleUpload(params, mime_type, io.BytesIO(data), len(data), hashlib.sha256(data).hexdigest())
+
+
+# ===============================================================
+#  PREPARACIÓN PARA EL MODELO
+# ===============================================================
+def prepare_for_model(upload_file, mime_type):
+    """
+    Lee el archivo (objeto con seek) para enviarlo al modelo, reduciendo y
+    recomprimiendo las imágenes grandes. Devuelve (bytes, mime_type); si no
+    hay ganancia o no se puede procesar, devuelve el archivo original. Pillow
+    decodifica desde el propio archivo: el original solo se lee entero si se
+    envía tal cual.
+    """
+    def original():
+        upload_file.seek(0)
+        return upload_file.read(), mime_type
+
+    if (mime_type or '').lower() not in RECOMPRESSIBLE_TYPES:
+        return original()
+    try:
+        from PIL import Image
+    except ImportError:
+        return original()
+
+    try:
+        original_size = upload_file.seek(0, io.SEEK_END)
+        upload_file.seek(0)
+        with Image.open(upload_file) as image:
+            image.draft('RGB', (UPLOAD_IMAGE_MAX_SIDE, UPLOAD_IMAGE_MAX_SIDE))  # decodificación reducida de JPEG
+            image = image.convert('RGB')
+            image.thumbnail((UPLOAD_IMAGE_MAX_SIDE, UPLOAD_IMAGE_MAX_SIDE))
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=UPLOAD_IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"WARN: No se pudo recomprimir la imagen ({mime_type}): {e}. Se envía original.")
+        return original()
+
+    compressed = output.getvalue()
+    if len(compressed) >= original_size:
+        return original()
+    print(f"🗜️ Imagen recomprimida: {original_size} -> {len(compressed)} bytes.")
+    return compressed, 'image/jpeg'
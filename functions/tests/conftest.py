@@ -0,0 +1,32 @@
+# functions/tests/conftest.py
+
+# --- Configuración común de las pruebas de las Cloud Functions ---
+# Ejecutar desde functions/:  python -m pytest -q tests
+# main.py se importa tal cual (firebase_admin se inicializa sin credenciales);
+# Firestore se sustituye por el cliente en memoria de fake_firestore.py.
+import os
+import sys
+
+os.environ.setdefault('GCLOUD_PROJECT', 'demo-agenda-tests')
+os.environ.setdefault('WRITE_RETRY_BASE_DELAY', '0')
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if FUNCTIONS_DIR not in sys.path:
+    sys.path.insert(0, FUNCTIONS_DIR)
+
+import pytest
+
+from fake_firestore import FakeFirestore
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
+
+
+@pytest.fixture
+def main_module(db, monkeypatch):
+    """main.py con el cliente de Firestore en memoria."""
+    import main
+    monkeypatch.setattr(main, 'db_client', db)
+    return main
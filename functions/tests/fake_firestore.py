@@ -0,0 +1,376 @@
+# functions/tests/fake_firestore.py
+
+# --- Firestore en memoria para las pruebas de functions/ ---
+# Implementa el subconjunto del cliente de firebase_admin que usa main.py:
+# documentos y subcolecciones, set/update/delete (con merge, claves con
+# puntos y los sentinels SERVER_TIMESTAMP / DELETE_FIELD / Increment),
+# consultas where/order_by/limit/start_after/select/count, lotes y
+# transacciones. Las fechas se guardan en UTC con zona horaria, como las
+# devuelve Firestore. Cuenta consultas y documentos leídos para poder
+# comprobar cuánto lee cada camino.
+import copy
+import datetime
+import itertools
+
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+
+_ids = itertools.count()
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def _store_value(value):
+    """Normaliza un valor como lo guardaría Firestore."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc)
+    if isinstance(value, dict):
+        return {key: _store_value(item) for key, item in value.items()
+                if item is not transforms.DELETE_FIELD}
+    if isinstance(value, (list, tuple)):
+        return [_store_value(item) for item in value]
+    if value is transforms.SERVER_TIMESTAMP:
+        return _now()
+    if isinstance(value, transforms.Increment):
+        return value.value
+    return value
+
+def _apply(target, key, value):
+    """Aplica un valor (o sentinel) sobre target[key]."""
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif isinstance(value, transforms.Increment):
+        target[key] = (target.get(key) or 0) + value.value
+    else:
+        target[key] = _store_value(value)
+
+def _merge(target, data):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif isinstance(value, dict):
+            target[key] = {}
+            _merge(target[key], value)
+        else:
+            _apply(target, key, value)
+
+def _update(target, data):
+    for path, value in data.items():
+        parts = path.split('.')
+        node = target
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        _apply(node, parts[-1], value)
+
+def _get_field(data, path):
+    node = data
+    for part in path.split('.'):
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+def _comparable(value):
+    """Clave de orden por tipo, como Firestore: valores de tipos distintos nunca se cruzan."""
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime.datetime):
+        return (3, _store_value(value))
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, FakeDocumentReference):
+        return (5, value.path)
+    return (9, repr(value))
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, fields=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        if data is not None and fields is not None:
+            data = {key: value for key, value in data.items() if key in fields}
+        self._data = copy.deepcopy(data)
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return _get_field(self._data or {}, field)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollection(self._db, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name):
+        return FakeCollection(self._db, f'{self.path}/{name}')
+
+    def get(self, field_paths=None, transaction=None):
+        self._db.document_reads += 1
+        return FakeSnapshot(self, self._db.docs.get(self.path), field_paths)
+
+    def set(self, data, merge=False):
+        self._db.write([('set', self, data, merge)])
+
+    def update(self, data):
+        self._db.write([('update', self, data, False)])
+
+    def create(self, data):
+        self._db.write([('create', self, data, False)])
+
+    def delete(self):
+        self._db.write([('delete', self, None, False)])
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class FakeAggregation:
+    def __init__(self, query):
+        self._query = query
+
+    def get(self):
+        value = len(self._query._matches())
+        self._query._db.queries += 1
+        return [[type('AggregationResult', (), {'value': value, 'alias': 'count'})()]]
+
+
+class FakeCollection:
+    def __init__(self, db, path, filters=(), order=(), limit=None, after=None, fields=None):
+        self._db = db
+        self._path = path
+        self._filters = filters
+        self._order = order
+        self._limit = limit
+        self._after = after
+        self._fields = fields
+        self.id = path.rsplit('/', 1)[-1]
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, order=self._order, limit=self._limit,
+                     after=self._after, fields=self._fields)
+        state.update(changes)
+        return FakeCollection(self._db, self._path, **state)
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._db, f'{self._path}/{document_id or f"auto{next(_ids):08d}"}')
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return _now(), ref
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(order=self._order + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, values):
+        return self._copy(after=values)
+
+    def select(self, fields):
+        return self._copy(fields=tuple(fields))
+
+    def count(self, alias=None):
+        return FakeAggregation(self)
+
+    def _value(self, ref, data, field):
+        return ref if field == '__name__' else _get_field(data, field)
+
+    def _matches(self):
+        results = []
+        prefix = self._path + '/'
+        for path, data in self._db.docs.items():
+            if not path.startswith(prefix) or '/' in path[len(prefix):]:
+                continue
+            ref = FakeDocumentReference(self._db, path)
+            if all(self._match(self._value(ref, data, field), op, value) for field, op, value in self._filters):
+                results.append((ref, data))
+
+        def sort_key(item):
+            ref, data = item
+            return [_comparable(self._value(ref, data, field)) for field, _ in self._order] + [_comparable(ref)]
+        results.sort(key=sort_key)
+        for field, direction in reversed(self._order):
+            if direction in ('DESCENDING', 'desc'):
+                results.sort(key=lambda item: _comparable(self._value(item[0], item[1], field)), reverse=True)
+
+        if self._after is not None:
+            cursor = self._after.get('__name__') if isinstance(self._after, dict) else self._after.reference
+            results = [(ref, data) for ref, data in results if _comparable(ref) > _comparable(cursor)]
+        if self._limit is not None:
+            results = results[:self._limit]
+        return results
+
+    @staticmethod
+    def _match(actual, op, expected):
+        if op == '==':
+            return _comparable(actual) == _comparable(expected) if actual is not None else expected is None
+        if op == 'in':
+            return any(_comparable(actual) == _comparable(item) for item in expected)
+        if op == 'array_contains':
+            return isinstance(actual, list) and expected in actual
+        if actual is None:
+            return False
+        left, right = _comparable(actual), _comparable(expected)
+        if left[0] != right[0]:
+            return False
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right, '!=': left != right}[op]
+
+    def stream(self, transaction=None):
+        matches = self._matches()
+        self._db.queries += 1
+        self._db.document_reads += len(matches)
+        return iter([FakeSnapshot(ref, data, self._fields) for ref, data in matches])
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append(('set', ref, data, merge))
+
+    def update(self, ref, data):
+        self._writes.append(('update', ref, data, False))
+
+    def create(self, ref, data):
+        self._writes.append(('create', ref, data, False))
+
+    def delete(self, ref):
+        self._writes.append(('delete', ref, None, False))
+
+    def commit(self):
+        self._db.write(self._writes)
+        return [self._writes]
+
+    def __len__(self):
+        return len(self._writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Transacción compatible con firestore.transactional (sin conflictos)."""
+    _read_only = False
+    _max_attempts = 5
+    _id = None
+
+    def _clean_up(self):
+        self._writes = []
+
+    def _begin(self, retry_id=None):
+        self._id = b'fake-transaction'
+
+    def _commit(self):
+        return self.commit()
+
+    def _rollback(self):
+        self._writes = []
+
+
+class FakeFirestore:
+    """
+    Cliente en memoria. commit_hook(writes), si se define, se llama antes de
+    aplicar cada escritura o lote y puede lanzar una excepción para simular
+    fallos del servidor (el lote no se aplica).
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.queries = 0
+        self.document_reads = 0
+        self.commits = 0
+        self.commit_hook = None
+
+    def collection(self, path):
+        return FakeCollection(self, path)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def write(self, writes):
+        """Aplica las escrituras de forma atómica: o todas o ninguna."""
+        if self.commit_hook is not None:
+            self.commit_hook(writes)
+        staged = copy.deepcopy(self.docs)
+        for op, ref, data, merge in writes:
+            current = staged.get(ref.path)
+            if op == 'delete':
+                staged.pop(ref.path, None)
+            elif op == 'create':
+                if current is not None:
+                    raise exceptions.AlreadyExists(f'Document already exists: {ref.path}')
+                staged[ref.path] = _store_value(data)
+            elif op == 'update':
+                if current is None:
+                    raise exceptions.NotFound(f'No document to update: {ref.path}')
+                _update(current, data)
+            elif merge:
+                current = staged.setdefault(ref.path, {})
+                _merge(current, data)
+            else:
+                staged[ref.path] = _store_value(data)
+        self.docs = staged
+        self.commits += 1
+
+    def data(self, path):
+        """Contenido actual de un documento (o None), para las aserciones."""
+        return copy.deepcopy(self.docs.get(path))
+
+
+class _EventSnapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = copy.deepcopy(data)
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class WrittenEvent:
+    """Evento on_document_written con before/after como los recibe el trigger."""
+
+    def __init__(self, params, before, after):
+        self.params = params
+        self.data = type('Change', (), {'before': _EventSnapshot(before), 'after': _EventSnapshot(after)})()
+
+
+def write_and_trigger(db, trigger, path, data, **params):
+    """Escribe (o borra, con data=None) el documento y entrega el cambio al trigger."""
+    before = db.data(path)
+    ref = db.document(path)
+    if data is None:
+        ref.delete()
+    else:
+        ref.set(data)
+    trigger.__wrapped__(WrittenEvent(params, before, db.data(path)))
@@ -0,0 +1,109 @@
+# functions/tests/test_activity_rollup.py
+import datetime
+import random
+
+import pytest
+from google.api_core import exceptions
+
+from fake_firestore import write_and_trigger
+
+USER_ID = 'user_rollup'
+
+
+def random_task(rng, now):
+    due = now + datetime.timedelta(days=rng.randint(-10, 10)) if rng.random() < 0.7 else None
+    return {'title': 'Tarea', 'completed': rng.random() < 0.4, 'dueDate': due}
+
+def random_habit(rng):
+    return {'completedDays': [rng.random() < 0.5 for _ in range(7)]}
+
+def random_event(rng, now):
+    start = now + datetime.timedelta(hours=rng.randint(1, 30 * 24))
+    return {'title': 'Clase', 'start': start, 'end': start + datetime.timedelta(minutes=rng.choice([60, 90]))}
+
+def comparable_rollup(main, rollup):
+    return {
+        'pendingTasks': rollup['pendingTasks'],
+        'completedTasks': rollup['completedTasks'],
+        'pendingDue': {key: main.normalize_datetime(value) for key, value in rollup['pendingDue'].items()},
+        'habitRates': rollup['habitRates'],
+        'upcoming': {key: (main.normalize_datetime(value['start']), main.normalize_datetime(value['end']))
+                     for key, value in rollup['upcoming'].items()},
+    }
+
+
+def test_triggers_keep_rollup_equal_to_rebuild(main_module, db):
+    main = main_module
+    rng = random.Random(4)
+    now = datetime.datetime.now()
+    for index in range(10):
+        db.document(f'users/{USER_ID}/tasks/t{index}').set(random_task(rng, now))
+        db.document(f'users/{USER_ID}/events/e{index}').set(random_event(rng, now))
+    db.document(f'users/{USER_ID}/habits/h0').set(random_habit(rng))
+    main.rebuild_activity_rollup(db, USER_ID, now)
+
+    for _ in range(300):
+        kind = rng.choice(['tasks', 'habits', 'events'])
+        doc_id = f'{kind[0]}{rng.randint(0, 14)}'
+        path = f'users/{USER_ID}/{kind}/{doc_id}'
+        if rng.random() < 0.2:
+            data = None
+        elif kind == 'tasks':
+            data = random_task(rng, now)
+        elif kind == 'habits':
+            data = random_habit(rng)
+        else:
+            data = random_event(rng, now)
+        trigger = {'tasks': main.on_task_written, 'habits': main.on_habit_written, 'events': main.on_event_written}[kind]
+        id_param = {'tasks': 'taskId', 'habits': 'habitId', 'events': 'eventId'}[kind]
+        write_and_trigger(db, trigger, path, data, userId=USER_ID, **{id_param: doc_id})
+
+    maintained = db.data(f'users/{USER_ID}/stats/activity')
+    rebuilt = main.build_activity_rollup(db, USER_ID, now)
+    assert comparable_rollup(main, maintained) == comparable_rollup(main, rebuilt)
+    assert main.metrics_from_rollup(maintained, now) == main.metrics_from_rollup(rebuilt, now)
+
+
+def test_imported_events_skip_trigger_and_apply_once(main_module, db):
+    main = main_module
+    now = datetime.datetime.now()
+    main.rebuild_activity_rollup(db, USER_ID, now)
+    commits_before = db.commits
+
+    created = {}
+    for index in range(5):
+        start = now + datetime.timedelta(days=index * 4, hours=1)
+        event = {'title': 'Clase importada', 'start': start, 'end': start + datetime.timedelta(hours=1),
+                 'source': main.IMPORT_EVENT_SOURCE}
+        write_and_trigger(db, main.on_event_written, f'users/{USER_ID}/events/sched_{index}', event,
+                          userId=USER_ID, eventId=f'sched_{index}')
+        created[f'sched_{index}'] = event
+    # Solo las escrituras de los eventos: el trigger no toca el rollup
+    assert db.commits - commits_before == 5
+
+    applied = main.apply_imported_events_change(db, USER_ID, created, now)
+
+    maintained = db.data(f'users/{USER_ID}/stats/activity')
+    rebuilt = main.build_activity_rollup(db, USER_ID, now)
+    assert applied == len(rebuilt['upcoming'])
+    assert comparable_rollup(main, maintained) == comparable_rollup(main, rebuilt)
+
+
+def test_failed_rollup_write_invalidates_rollup(main_module, db):
+    main = main_module
+    now = datetime.datetime.now()
+    main.rebuild_activity_rollup(db, USER_ID, now)
+    rollup_path = f'users/{USER_ID}/stats/activity'
+
+    def fail_rollup_changes(writes):
+        if any(ref.path == rollup_path and 'changedAt' in data for _, ref, data, _ in writes):
+            raise exceptions.Aborted('contention')
+    db.commit_hook = fail_rollup_changes
+
+    with pytest.raises(exceptions.Aborted):
+        write_and_trigger(db, main.on_task_written, f'users/{USER_ID}/tasks/t1', {'completed': False},
+                          userId=USER_ID, taskId='t1')
+
+    assert 'rebuiltAt' not in db.data(rollup_path)
+    # La siguiente lectura reconstruye el rollup con la tarea nueva
+    assert main.load_user_activity_metrics(db, USER_ID, now)['pendingTasks'] == 1
@@ -0,0 +1,88 @@
+# functions/tests/test_auth_cache.py
+import time
+
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+import auth_cache
+
+
+@pytest.fixture
+def verifier(monkeypatch):
+    """Sustituye auth.verify_id_token y limpia la caché entre pruebas."""
+    calls = []
+
+    def verify_id_token(id_token):
+        calls.append(id_token)
+        if id_token.startswith('malo'):
+            raise ValueError('firma inválida')
+        return {'uid': id_token, 'exp': time.time() + 3600}
+
+    monkeypatch.setattr(auth_cache.auth, 'verify_id_token', verify_id_token)
+    monkeypatch.setattr(auth_cache, '_cache', auth_cache.OrderedDict())
+    monkeypatch.setattr(auth_cache, '_stats', {'hits': 0, 'misses': 0, 'failures': 0, 'evictions': 0})
+    monkeypatch.setattr(auth_cache, 'AUTH_STATS_LOG_EVERY', 0)
+    return calls
+
+
+def test_repeated_token_is_served_from_cache(verifier):
+    assert auth_cache.verify_token('token-a')['uid'] == 'token-a'
+    assert auth_cache.verify_token('token-a')['uid'] == 'token-a'
+
+    assert verifier == ['token-a']
+    assert auth_cache.stats()['hits'] == 1 and auth_cache.stats()['misses'] == 1
+
+
+def test_token_is_not_stored_in_clear(verifier):
+    auth_cache.verify_token('token-secreto')
+    assert 'token-secreto' not in auth_cache._cache
+    assert auth_cache.token_key('token-secreto') in auth_cache._cache
+
+
+def test_token_close_to_expiry_is_verified_again(verifier, monkeypatch):
+    monkeypatch.setattr(auth_cache.auth, 'verify_id_token',
+                        lambda id_token: verifier.append(id_token) or {'uid': 'u', 'exp': time.time() + 10})
+    auth_cache.verify_token('token-corto')
+    auth_cache.verify_token('token-corto')
+
+    # exp dentro del margen: nunca se sirve desde la caché
+    assert verifier == ['token-corto', 'token-corto']
+
+
+def test_cache_is_bounded_lru(verifier, monkeypatch):
+    monkeypatch.setattr(auth_cache, 'AUTH_CACHE_MAX_ENTRIES', 2)
+    auth_cache.verify_token('t1')
+    auth_cache.verify_token('t2')
+    auth_cache.verify_token('t1')
+    auth_cache.verify_token('t3')
+
+    assert auth_cache.stats()['evictions'] == 1
+    assert auth_cache.token_key('t2') not in auth_cache._cache
+    auth_cache.verify_token('t1')
+    assert verifier == ['t1', 't2', 't3']
+
+
+def test_invalid_token_raises_auth_error_and_is_not_cached(verifier):
+    for _ in range(2):
+        with pytest.raises(auth_cache.AuthError):
+            auth_cache.verify_token('malo-1')
+
+    assert verifier == ['malo-1', 'malo-1']
+    assert auth_cache.stats()['failures'] == 2
+
+
+@pytest.mark.parametrize('header', [None, 'Token abc', 'Bearer ', 'Bearer'])
+def test_missing_or_malformed_bearer_header(verifier, header):
+    headers = {'Authorization': header} if header is not None else {}
+    req = Request(EnvironBuilder(method='GET', headers=headers).get_environ())
+    with pytest.raises(auth_cache.AuthError):
+        auth_cache.verify_request(req)
+    assert verifier == []
+
+
+def test_invalidate_forces_verification(verifier):
+    auth_cache.verify_token('token-b')
+    auth_cache.invalidate('token-b')
+    auth_cache.verify_token('token-b')
+    assert verifier == ['token-b', 'token-b']
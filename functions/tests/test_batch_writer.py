@@ -0,0 +1,124 @@
+# functions/tests/test_batch_writer.py
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from google.api_core import exceptions
+
+
+def record_batches(db, fail_first=0, error=exceptions.Aborted):
+    """commit_hook que anota el tamaño de cada batch y falla los primeros fail_first."""
+    sizes = []
+    lock = threading.Lock()
+
+    def hook(writes):
+        with lock:
+            sizes.append(len(writes))
+            if len(sizes) <= fail_first:
+                raise error('fallo simulado')
+    db.commit_hook = hook
+    return sizes
+
+
+def test_writes_are_committed_in_bounded_chunks(main_module, db):
+    sizes = record_batches(db)
+    with main_module.ChunkedBatchWriter(db, chunk_size=50) as writer:
+        for index in range(120):
+            writer.set(db.document(f'items/i{index:03d}'), {'n': index}, kind='items')
+        summary = writer.drain()
+
+    assert sorted(sizes) == [20, 50, 50]
+    assert summary['committed'] == {'items': 120} and summary['failed'] == {}
+    assert len([path for path in db.docs if path.startswith('items/')]) == 120
+
+
+def test_retryable_error_is_retried_with_the_same_chunk(main_module, db):
+    sizes = record_batches(db, fail_first=2)
+    with main_module.ChunkedBatchWriter(db, chunk_size=10, parallelism=1, max_retries=3) as writer:
+        for index in range(10):
+            writer.set(db.document(f'items/i{index}'), {'n': index})
+        summary = writer.drain()
+
+    assert sizes == [10, 10, 10]
+    assert summary['committed'] == {'doc': 10} and not summary['failedItems']
+
+
+def test_non_retryable_chunk_falls_back_to_one_by_one(main_module, db):
+    sizes = record_batches(db)
+    with main_module.ChunkedBatchWriter(db, chunk_size=10, parallelism=1) as writer:
+        for index in range(5):
+            writer.set(db.document(f'items/i{index}'), {'n': index}, key=f'i{index}')
+        # update sobre un documento inexistente: NotFound invalida todo el batch
+        writer.update(db.document('items/falta'), {'n': 0}, key='falta')
+        summary = writer.drain()
+
+    assert sizes == [6, 1, 1, 1, 1, 1, 1]
+    assert summary['committed'] == {'doc': 5} and summary['failed'] == {'doc': 1}
+    assert [item['key'] for item in summary['failedItems']] == ['falta']
+    assert db.data('items/i4') == {'n': 4}
+
+
+def test_exhausted_retries_fall_back_to_one_by_one(main_module, db):
+    sizes = record_batches(db, fail_first=3)
+    with main_module.ChunkedBatchWriter(db, chunk_size=4, parallelism=1, max_retries=2) as writer:
+        for index in range(4):
+            writer.set(db.document(f'items/i{index}'), {'n': index})
+        summary = writer.drain()
+
+    assert sizes == [4, 4, 4, 1, 1, 1, 1]
+    assert summary['committed'] == {'doc': 4}
+
+
+def test_failed_group_fails_together_and_others_commit(main_module, db):
+    record_batches(db)
+    with main_module.ChunkedBatchWriter(db, chunk_size=10, parallelism=1) as writer:
+        with writer.group():
+            writer.update(db.document('users/u1'), {'openRiskAlert': True}, kind='risk', key='u1')
+            writer.set(db.document('users/u1/recommendations/r1'), {'type': 'risk_alert'}, kind='alerts', key='u1')
+        with writer.group():
+            writer.set(db.document('users/u2'), {'openRiskAlert': True}, kind='risk', key='u2')
+            writer.set(db.document('users/u2/recommendations/r1'), {'type': 'risk_alert'}, kind='alerts', key='u2')
+        summary = writer.drain()
+
+    # users/u1 no existe: el update falla y la alerta de su grupo tampoco se escribe
+    assert db.data('users/u1/recommendations/r1') is None
+    assert db.data('users/u2')['openRiskAlert'] is True
+    assert db.data('users/u2/recommendations/r1') == {'type': 'risk_alert'}
+    assert summary['failed'] == {'risk': 1, 'alerts': 1}
+    assert {item['key'] for item in summary['failedItems']} == {'u1'}
+
+
+def test_groups_from_many_threads_are_never_split(main_module, db):
+    batches = []
+    lock = threading.Lock()
+
+    def hook(writes):
+        with lock:
+            batches.append([ref.path for _, ref, _, _ in writes])
+    db.commit_hook = hook
+
+    def produce(writer, user_index):
+        with writer.group():
+            for part in range(7):
+                writer.set(db.document(f'users/u{user_index}/parts/p{part}'), {'n': part})
+
+    with main_module.ChunkedBatchWriter(db, chunk_size=50, parallelism=4) as writer:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda index: produce(writer, index), range(200)))
+        writer.drain()
+
+    assert max(len(batch) for batch in batches) <= 50
+    for batch in batches:
+        users = {}
+        for path in batch:
+            users[path.split('/')[1]] = users.get(path.split('/')[1], 0) + 1
+        assert all(count == 7 for count in users.values())
+    assert sum(len(batch) for batch in batches) == 200 * 7
+
+
+def test_group_larger_than_batch_limit_is_rejected(main_module, db):
+    with main_module.ChunkedBatchWriter(db) as writer:
+        with pytest.raises(ValueError):
+            with writer.group():
+                for index in range(main_module.FIRESTORE_BATCH_LIMIT + 1):
+                    writer.set(db.document(f'items/i{index}'), {})
@@ -0,0 +1,114 @@
+# functions/tests/test_compiled_models.py
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import KMeans
+from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler, OneHotEncoder, StandardScaler
+
+import compiled_models
+
+NUMERIC = ['horas_estudio', 'promedio', 'asistencia']
+CATEGORICAL = ['turno', 'carrera']
+
+
+def make_rows(count, seed):
+    rng = random.Random(seed)
+    return [{
+        'horas_estudio': rng.uniform(0, 40),
+        'promedio': round(rng.uniform(5, 10), 2),
+        'asistencia': rng.randint(40, 100),
+        'turno': rng.choice(['matutino', 'vespertino']),
+        'carrera': rng.choice(['sistemas', 'industrial', 'civil', 'derecho']),
+    } for _ in range(count)]
+
+def make_preprocessor(rows):
+    preprocessor = ColumnTransformer([
+        ('num', StandardScaler(), NUMERIC[:2]),
+        ('minmax', Pipeline([('scale', MinMaxScaler())]), NUMERIC[2:]),
+        ('cat', OneHotEncoder(handle_unknown='ignore'), CATEGORICAL),
+    ])
+    preprocessor.fit(pd.DataFrame(rows))
+    return preprocessor
+
+def sklearn_transform(preprocessor, rows):
+    X = preprocessor.transform(pd.DataFrame(rows).reindex(columns=list(preprocessor.feature_names_in_)))
+    return np.asarray(X.toarray() if hasattr(X, 'toarray') else X, dtype=np.float64)
+
+def export(tmp_path, preprocessor, model, samples):
+    spec, arrays = compiled_models.compile_pipeline(preprocessor, model)
+    compiled_models.attach_parity(spec, arrays, preprocessor, model, samples)
+    path = tmp_path / 'modelo.npz'
+    compiled_models.save_compiled(spec, arrays, path)
+    return path
+
+
+@pytest.fixture(scope='module')
+def training_rows():
+    return make_rows(300, seed=1)
+
+@pytest.fixture(scope='module')
+def preprocessor(training_rows):
+    return make_preprocessor(training_rows)
+
+
+def test_kmeans_matches_sklearn_exactly(tmp_path, training_rows, preprocessor):
+    model = KMeans(n_clusters=4, n_init=3, random_state=0).fit(sklearn_transform(preprocessor, training_rows))
+    compiled = compiled_models.load_compiled(export(tmp_path, preprocessor, model, training_rows[:50]))
+
+    rows = make_rows(200, seed=2)
+    expected_X = sklearn_transform(preprocessor, rows)
+    got_X = compiled.transform(rows)
+
+    assert np.array_equal(got_X, expected_X)
+    assert np.array_equal(compiled.predict(got_X), model.predict(expected_X))
+
+
+@pytest.mark.parametrize('n_classes', [2, 3])
+def test_logistic_matches_sklearn_exactly(tmp_path, training_rows, preprocessor, n_classes):
+    X_train = sklearn_transform(preprocessor, training_rows)
+    labels = [index % n_classes for index in range(len(training_rows))]
+    model = LogisticRegression(max_iter=500).fit(X_train, labels)
+    compiled = compiled_models.load_compiled(export(tmp_path, preprocessor, model, training_rows[:50]))
+
+    rows = make_rows(200, seed=3)
+    expected_X = sklearn_transform(preprocessor, rows)
+    got_X = compiled.transform(rows)
+
+    assert np.array_equal(got_X, expected_X)
+    assert np.array_equal(compiled.predict_proba(got_X), model.predict_proba(expected_X))
+
+
+def test_unknown_category_is_ignored_like_sklearn(tmp_path, training_rows, preprocessor):
+    model = KMeans(n_clusters=2, n_init=1, random_state=0).fit(sklearn_transform(preprocessor, training_rows))
+    compiled = compiled_models.load_compiled(export(tmp_path, preprocessor, model, training_rows[:10]))
+    rows = make_rows(5, seed=4)
+    rows[0]['carrera'] = 'medicina'
+
+    assert np.array_equal(compiled.transform(rows), sklearn_transform(preprocessor, rows))
+
+
+def test_load_rejects_artifact_without_exact_parity(tmp_path, training_rows, preprocessor):
+    model = KMeans(n_clusters=4, n_init=1, random_state=0).fit(sklearn_transform(preprocessor, training_rows))
+    spec, arrays = compiled_models.compile_pipeline(preprocessor, model)
+    compiled_models.attach_parity(spec, arrays, preprocessor, model, training_rows[:20])
+    arrays['parity_X'] = np.nextafter(arrays['parity_X'], np.inf)
+    path = tmp_path / 'alterado.npz'
+    compiled_models.save_compiled(spec, arrays, path)
+
+    with pytest.raises(compiled_models.ParityError):
+        compiled_models.load_compiled(path)
+
+
+def test_load_rejects_artifact_without_parity_samples(tmp_path, training_rows, preprocessor):
+    model = KMeans(n_clusters=2, n_init=1, random_state=0).fit(sklearn_transform(preprocessor, training_rows))
+    spec, arrays = compiled_models.compile_pipeline(preprocessor, model)
+    path = tmp_path / 'sin_paridad.npz'
+    compiled_models.save_compiled(spec, arrays, path)
+
+    with pytest.raises(compiled_models.ParityError):
+        compiled_models.load_compiled(path)
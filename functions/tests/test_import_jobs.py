@@ -0,0 +1,133 @@
+# functions/tests/test_import_jobs.py
+import datetime
+import hashlib
+import io
+import types
+
+import firebase_admin.functions
+import pytest
+
+USER_ID = 'user_jobs'
+SCHEDULE = [{'materia': 'Cálculo', 'diaSemana': 'Lunes', 'horaInicio': '08:00', 'horaFin': '09:30'}]
+END_DATE = datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(weeks=4)
+
+
+class FakeQueue:
+    def __init__(self):
+        self.tasks = []
+        self.error = None
+
+    def enqueue(self, data, options=None):
+        if self.error is not None:
+            raise self.error
+        self.tasks.append(data)
+
+
+class FakeExtractor:
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    def extract(self, file_bytes, mime_type):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return list(SCHEDULE)
+
+
+@pytest.fixture
+def jobs(main_module, monkeypatch):
+    main = main_module
+    env = types.SimpleNamespace(main=main, queue=FakeQueue(), extractor=FakeExtractor(), staged={})
+
+    def stage(user_id, staging_id, upload):
+        path = f'{main.IMPORT_STAGING_PREFIX}/{user_id}/{staging_id}'
+        env.staged[path] = upload.content
+        return path
+
+    monkeypatch.setattr(firebase_admin.functions, 'task_queue', lambda name: env.queue)
+    monkeypatch.setattr(main, 'stage_import_file', stage)
+    monkeypatch.setattr(main, 'load_staged_import_file', lambda path: io.BytesIO(env.staged[path]))
+    monkeypatch.setattr(main, 'delete_staged_import_file', lambda path: env.staged.pop(path, None))
+    monkeypatch.setattr(main.schedule_upload, 'prepare_for_model', lambda staged_file, mime_type: (staged_file.read(), mime_type))
+    monkeypatch.setattr(main.schedule_extraction, 'get_extractor', lambda db: env.extractor)
+    return env
+
+def make_upload(content=b'%PDF-horario'):
+    return types.SimpleNamespace(content=content, sha256=hashlib.sha256(content).hexdigest(),
+                                 mime_type='application/pdf', size=len(content))
+
+def start(jobs, db):
+    return jobs.main.start_import_job(db, USER_ID, make_upload(), END_DATE, 'events')
+
+
+def test_job_runs_once_and_cleans_up(jobs, db):
+    job_id, job, enqueued = start(jobs, db)
+    assert enqueued and jobs.queue.tasks == [{'userId': USER_ID, 'jobId': job_id, 'dispatch': 1}]
+
+    # Un reintento del cliente mientras está en cola devuelve el mismo trabajo
+    assert start(jobs, db) == (job_id, db.data(f'users/{USER_ID}/importJobs/{job_id}'), False)
+
+    jobs.main.run_import_job(db, USER_ID, job_id, dispatch=1)
+
+    job = db.data(f'users/{USER_ID}/importJobs/{job_id}')
+    assert (job['status'], job['stage'], job['attempts']) == ('done', 'done', 1)
+    assert job['result']['eventsCreated'] > 0
+    assert jobs.staged == {}
+
+
+def test_enqueue_failure_fails_job_and_deletes_staged_file(jobs, db):
+    jobs.queue.error = RuntimeError('cola no disponible')
+
+    with pytest.raises(RuntimeError):
+        start(jobs, db)
+
+    (job,) = [data for path, data in db.docs.items() if '/importJobs/' in path]
+    assert job['status'] == 'failed' and 'No se pudo encolar' in job['error']
+    assert jobs.staged == {}
+
+
+def test_finished_job_reruns_with_new_dispatch_and_ignores_stale_task(jobs, db):
+    job_id, _, _ = start(jobs, db)
+    jobs.main.run_import_job(db, USER_ID, job_id, dispatch=1)
+
+    _, job, enqueued = start(jobs, db)
+    assert enqueued and job['dispatches'] == 2
+
+    # La tarea del primer despacho sigue en la cola: no debe ejecutar nada
+    jobs.main.run_import_job(db, USER_ID, job_id, dispatch=1)
+    assert jobs.extractor.calls == 1
+    assert db.data(f'users/{USER_ID}/importJobs/{job_id}')['status'] == 'queued'
+
+    jobs.main.run_import_job(db, USER_ID, job_id, dispatch=2)
+    assert jobs.extractor.calls == 2
+    assert db.data(f'users/{USER_ID}/importJobs/{job_id}')['status'] == 'done'
+
+
+def test_invalid_model_answer_fails_without_retry(jobs, db):
+    job_id, _, _ = start(jobs, db)
+    jobs.extractor.error = ValueError('JSON inválido')
+
+    jobs.main.run_import_job(db, USER_ID, job_id, dispatch=1)
+
+    job = db.data(f'users/{USER_ID}/importJobs/{job_id}')
+    assert (job['status'], job['attempts']) == ('failed', 1)
+    assert 'JSON inválido' in job['error']
+    assert jobs.staged == {}
+
+
+def test_transient_error_retries_until_max_attempts(jobs, db, monkeypatch):
+    monkeypatch.setattr(jobs.main, 'IMPORT_JOB_MAX_ATTEMPTS', 2)
+    job_id, _, _ = start(jobs, db)
+    jobs.extractor.error = RuntimeError('Gemini no responde')
+
+    with pytest.raises(RuntimeError):
+        jobs.main.run_import_job(db, USER_ID, job_id, dispatch=1)
+    job = db.data(f'users/{USER_ID}/importJobs/{job_id}')
+    assert (job['status'], job['attempts']) == ('queued', 1)
+    assert jobs.staged
+
+    jobs.main.run_import_job(db, USER_ID, job_id, dispatch=1)
+    job = db.data(f'users/{USER_ID}/importJobs/{job_id}')
+    assert (job['status'], job['attempts']) == ('failed', 2)
+    assert jobs.staged == {}
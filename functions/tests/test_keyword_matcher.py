@@ -0,0 +1,69 @@
+# functions/tests/test_keyword_matcher.py
+import random
+
+import pytest
+
+import keyword_matcher
+from keyword_matcher import DEFAULT_KEYWORD_CATEGORIES, KeywordMatcher
+
+
+def brute_force(categories, title):
+    """La semántica original: `keyword in title` sobre el texto normalizado."""
+    keywords = {}
+    for category, spec in categories.items():
+        for keyword in spec['keywords']:
+            keyword_norm = keyword_matcher.unicode_normalize(keyword).strip()
+            weight = float(spec.get('weight', 1.0))
+            if keyword_norm not in keywords or weight > keywords[keyword_norm][1]:
+                keywords[keyword_norm] = (category, weight)
+    title_norm = keyword_matcher.unicode_normalize(title)
+    return {keyword: value for keyword, value in keywords.items() if keyword in title_norm}
+
+def random_titles(count, seed):
+    rng = random.Random(seed)
+    pieces = [keyword for spec in DEFAULT_KEYWORD_CATEGORIES.values() for keyword in spec['keywords']]
+    pieces += ['Clase', 'de', 'Cálculo', 'ÁLGEBRA', 'entregaremos', 'Exposiciones', 'pre', 'sentación', 'x']
+    titles = []
+    for _ in range(count):
+        words = [rng.choice(pieces) for _ in range(rng.randint(1, 4))]
+        words = [word.upper() if rng.random() < 0.2 else word.capitalize() if rng.random() < 0.3 else word
+                 for word in words]
+        titles.append(rng.choice([' ', '', '-']).join(words))
+    return titles
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_find_all_matches_substring_semantics(seed):
+    matcher = KeywordMatcher(DEFAULT_KEYWORD_CATEGORIES)
+    for title in random_titles(400, seed):
+        expected = brute_force(DEFAULT_KEYWORD_CATEGORIES, title)
+        got = {match.keyword: (match.category, match.weight) for match in matcher.find_all(title)}
+        assert got == expected, title
+
+
+def test_match_returns_highest_weight():
+    matcher = KeywordMatcher(DEFAULT_KEYWORD_CATEGORIES)
+    for title in random_titles(1000, seed=11):
+        expected = brute_force(DEFAULT_KEYWORD_CATEGORIES, title)
+        match = matcher.match(title)
+        if not expected:
+            assert match is None
+        else:
+            assert match.weight == max(weight for _, weight in expected.values())
+
+
+def test_shorter_keyword_sharing_a_prefix_is_not_shadowed():
+    categories = {
+        'exam': {'weight': 3.0, 'keywords': ['test']},
+        'other': {'weight': 1.0, 'keywords': ['testing']},
+    }
+    match = KeywordMatcher(categories).match('Testing de software')
+    assert (match.keyword, match.category) == ('test', 'exam')
+
+
+def test_accents_and_case_are_ignored():
+    matcher = KeywordMatcher(DEFAULT_KEYWORD_CATEGORIES)
+    assert matcher.match('PRESENTACIÓN final').category == 'exam'
+    assert matcher.match('Revisión de Álgebra').keyword == 'revision'
+    assert matcher.match('Comida con amigos') is None
+    assert keyword_matcher.normalize('Ñandú Évora') == keyword_matcher.unicode_normalize('Ñandú Évora')
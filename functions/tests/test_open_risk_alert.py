@@ -0,0 +1,66 @@
+# functions/tests/test_open_risk_alert.py
+import pytest
+
+from fake_firestore import write_and_trigger
+
+USER_ID = 'user_alerts'
+
+
+@pytest.fixture
+def recommend(main_module, db):
+    db.document(f'users/{USER_ID}').set({'onboardingComplete': True})
+
+    def write(recommendation_id, data):
+        write_and_trigger(db, main_module.on_recommendation_written,
+                          f'users/{USER_ID}/recommendations/{recommendation_id}', data,
+                          userId=USER_ID, recommendationId=recommendation_id)
+        return db.data(f'users/{USER_ID}')
+    return write
+
+
+def test_flag_follows_the_open_alert(recommend):
+    user = recommend('r1', {'type': 'risk_alert', 'viewed': False})
+    assert user['openRiskAlert'] is True and user['openRiskAlertId'] == 'r1'
+
+    user = recommend('r1', {'type': 'risk_alert', 'viewed': True})
+    assert user['openRiskAlert'] is False and 'openRiskAlertId' not in user
+
+
+def test_deleting_the_open_alert_clears_the_flag(recommend):
+    recommend('r1', {'type': 'risk_alert', 'viewed': False})
+    user = recommend('r1', None)
+    assert user['openRiskAlert'] is False
+
+
+def test_closing_another_alert_keeps_the_flag(recommend):
+    recommend('r1', {'type': 'risk_alert', 'viewed': False})
+    recommend('r2', {'type': 'risk_alert', 'viewed': False})
+
+    user = recommend('r2', {'type': 'risk_alert', 'viewed': True})
+
+    assert user['openRiskAlert'] is True and user['openRiskAlertId'] == 'r1'
+
+
+def test_other_recommendations_do_not_touch_the_flag(recommend, db):
+    commits_before = db.commits
+    user = recommend('tip', {'type': 'study_tip', 'viewed': False})
+    assert 'openRiskAlert' not in user
+    assert db.commits - commits_before == 1
+
+
+def test_nightly_alert_is_not_duplicated_while_one_is_open(main_module, db, recommend):
+    main = main_module
+    with main.ChunkedBatchWriter(db, label='test') as writer:
+        main.write_user_risk(db, writer, USER_ID, db.data(f'users/{USER_ID}'), {'riskScore': 0.99}, 0.99)
+    user = db.data(f'users/{USER_ID}')
+    assert user['openRiskAlertId'] == 'risk_alert_1'
+    assert db.data(f'users/{USER_ID}/recommendations/risk_alert_1')['viewed'] is False
+
+    with main.ChunkedBatchWriter(db, label='test') as writer:
+        assert main.write_user_risk(db, writer, USER_ID, user, {}, 0.99) is False
+
+    # El usuario cierra la alerta: el trigger baja el flag y la siguiente se crea
+    user = recommend('risk_alert_1', {'type': 'risk_alert', 'viewed': True})
+    with main.ChunkedBatchWriter(db, label='test') as writer:
+        assert main.write_user_risk(db, writer, USER_ID, user, {}, 0.99) is True
+    assert db.data(f'users/{USER_ID}')['openRiskAlertId'] == 'risk_alert_2'
@@ -0,0 +1,47 @@
+# functions/tests/test_profile_batch.py
+import json
+
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+
+def make_request(body, content_type='application/json'):
+    data = body if isinstance(body, str) else json.dumps(body)
+    return Request(EnvironBuilder(method='POST', data=data, content_type=content_type).get_environ())
+
+
+def test_top_level_list_is_a_batch(main_module):
+    items = main_module.parse_profile_batch(make_request([{'edad': 20}, {'edad': 21}]))
+    assert items == [{'edad': 20}, {'edad': 21}]
+
+
+def test_items_object_is_a_batch(main_module):
+    assert main_module.parse_profile_batch(make_request({'items': [{'edad': 20}]})) == [{'edad': 20}]
+
+
+def test_single_profile_is_not_a_batch(main_module):
+    assert main_module.parse_profile_batch(make_request({'data': {'edad': 20}})) is None
+
+
+@pytest.mark.parametrize('body', ['"texto"', '3', 'null'])
+def test_scalar_body_is_a_validation_error(main_module, body):
+    with pytest.raises(ValueError, match='objeto o una lista'):
+        main_module.parse_profile_batch(make_request(body))
+
+
+def test_items_must_be_a_list(main_module):
+    with pytest.raises(ValueError, match="'items'"):
+        main_module.parse_profile_batch(make_request({'items': {'edad': 20}}))
+
+
+def test_jsonl_keeps_per_line_errors(main_module):
+    items = main_module.parse_profile_batch(make_request('{"edad": 20}\n\n{roto\n', 'application/x-ndjson'))
+    assert items[0] == {'edad': 20}
+    assert isinstance(items[1], ValueError) and 'Línea 3' in str(items[1])
+
+
+def test_batch_size_is_limited(main_module, monkeypatch):
+    monkeypatch.setattr(main_module, 'PROFILE_BATCH_MAX_ITEMS', 2)
+    with pytest.raises(ValueError, match='Demasiados'):
+        main_module.parse_profile_batch(make_request([{}, {}, {}]))
@@ -0,0 +1,71 @@
+# functions/tests/test_recluster.py
+import numpy as np
+import pytest
+from google.api_core import exceptions
+
+
+class ThresholdPreprocessor:
+    feature_names_in_ = np.array(['score'])
+
+    def transform(self, df):
+        return df[['score']].to_numpy(dtype=float)
+
+
+class ThresholdModel:
+    def predict(self, X):
+        return (X[:, 0] >= 50).astype(int)
+
+
+@pytest.fixture
+def recluster(main_module, db, monkeypatch):
+    main = main_module
+    models = ((ThresholdPreprocessor(), ThresholdModel()), 'kmeans-v1')
+    monkeypatch.setattr(main, 'load_scoring_models', lambda *names: models)
+    monkeypatch.setattr(main, 'RECLUSTER_PAGE_SIZE', 4)
+    for index in range(10):
+        db.document(f'users/u{index:02d}').set({
+            'onboardingComplete': True,
+            'onboardingData': {'score': index * 10},
+            'cluster': 0,
+        })
+    return main
+
+
+def fail_writes_for(user_ids):
+    def hook(writes):
+        if any(ref.id in user_ids and 'cluster' in (data or {}) for _, ref, data, _ in writes):
+            raise exceptions.PermissionDenied('denegado')
+    return hook
+
+
+def test_failed_cluster_writes_do_not_block_the_cursor(recluster, db):
+    db.commit_hook = fail_writes_for({'u06', 'u09'})
+
+    checkpoint = recluster.run_recluster_job(db)
+
+    assert checkpoint['status'] == 'completed'
+    assert checkpoint['cursor'] == 'u09'
+    assert checkpoint['processed'] == 10
+    assert sorted(checkpoint['failedIds']) == ['u06', 'u09']
+    assert checkpoint['writeErrors'] == 2
+    assert checkpoint['changed'] == 3
+    assert [db.data(f'users/u{index:02d}')['cluster'] for index in range(10)] == [0] * 5 + [1, 0, 1, 1, 0]
+
+
+def test_next_sweep_retries_failed_ids(recluster, db):
+    db.commit_hook = fail_writes_for({'u06', 'u09'})
+    recluster.run_recluster_job(db)
+    db.commit_hook = fail_writes_for({'u09'})
+
+    checkpoint = recluster.run_recluster_job(db)
+
+    assert checkpoint['failedIds'] == ['u09']
+    assert db.data('users/u06')['cluster'] == 1
+
+    db.commit_hook = None
+    checkpoint = recluster.run_recluster_job(db)
+
+    assert checkpoint['failedIds'] == []
+    assert checkpoint['changed'] == 5
+    assert db.data('jobs/reclusterProfiles')['failedIds'] == []
+    assert [db.data(f'users/u{index:02d}')['cluster'] for index in range(10)] == [0] * 5 + [1] * 5
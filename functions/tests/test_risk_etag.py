@@ -0,0 +1,78 @@
+# functions/tests/test_risk_etag.py
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+USER_ID = 'user_etag'
+
+
+@pytest.fixture
+def calculate(main_module, db, monkeypatch):
+    main = main_module
+    base = {'risk': 0.4}
+    calls = []
+
+    def predict_base_risks(profiles):
+        calls.append([user_id for user_id, _ in profiles])
+        return {user_id: base['risk'] for user_id, _ in profiles}, {}, 'regression-v1'
+
+    monkeypatch.setattr(main, 'predict_base_risks', predict_base_risks)
+    monkeypatch.setattr(main.auth_cache, 'verify_request', lambda req: {'uid': USER_ID})
+    db.document(f'users/{USER_ID}').set({'onboardingComplete': True, 'onboardingData': {}})
+
+    def call(if_none_match=None, force=False):
+        headers = {'If-None-Match': if_none_match} if if_none_match else {}
+        query = {'force': 'true'} if force else {}
+        req = Request(EnvironBuilder(method='GET', headers=headers, query_string=query).get_environ())
+        return main.calculate_risk.__wrapped__(req)
+
+    call.base = base
+    call.calls = calls
+    return call
+
+
+def test_unchanged_risk_answers_304_with_same_etag(calculate):
+    first = calculate()
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    second = calculate(if_none_match=etag)
+
+    assert second.status_code == 304
+    assert second.headers['ETag'] == etag
+    assert second.get_data() == b''
+    # La segunda respuesta sale del riesgo guardado, sin volver a inferir
+    assert len(calculate.calls) == 1
+
+
+def test_recomputed_risk_with_same_content_keeps_etag(calculate):
+    etag = calculate().headers['ETag']
+    forced = calculate(if_none_match=etag, force=True)
+
+    assert len(calculate.calls) == 2
+    assert forced.status_code == 304
+
+
+def test_changed_risk_gets_new_etag(calculate):
+    etag = calculate().headers['ETag']
+    calculate.base['risk'] = 0.9
+
+    changed = calculate(if_none_match=etag, force=True)
+
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert changed.get_json()['baseRisk'] == 0.9
+
+
+@pytest.mark.parametrize('header', ['W/{etag}', '"otro", {etag}', '*'])
+def test_weak_list_and_wildcard_validators_match(calculate, header):
+    etag = calculate().headers['ETag']
+    assert calculate(if_none_match=header.format(etag=etag)).status_code == 304
+
+
+def test_stale_validator_gets_full_response(calculate):
+    calculate()
+    response = calculate(if_none_match='"viejo"')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    assert response.get_json()['cached'] is True
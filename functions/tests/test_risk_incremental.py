@@ -0,0 +1,58 @@
+# functions/tests/test_risk_incremental.py
+import datetime
+
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+from fake_firestore import write_and_trigger
+
+USER_ID = 'user_incremental'
+
+
+def setup_user(main, db, monkeypatch):
+    monkeypatch.setattr(main, 'predict_base_risks',
+                        lambda profiles: ({user_id: 0.3 for user_id, _ in profiles}, {}, 'regression-v1'))
+    monkeypatch.setattr(main.auth_cache, 'verify_request', lambda req: {'uid': USER_ID})
+    db.document(f'users/{USER_ID}').set({'onboardingComplete': True, 'onboardingData': {'horas': 10}})
+
+
+def test_on_demand_risk_records_profile_hash(main_module, db, monkeypatch):
+    main = main_module
+    setup_user(main, db, monkeypatch)
+
+    response = main.calculate_risk.__wrapped__(Request(EnvironBuilder(method='GET').get_environ()))
+
+    assert response.status_code == 200
+    user_data = db.data(f'users/{USER_ID}')
+    assert user_data['riskProfileHash'] == main.profile_hash({'horas': 10})
+    assert not main.needs_full_rescore(user_data, 'regression-v1')
+
+
+def test_activity_changes_do_not_force_base_rescore(main_module, db, monkeypatch):
+    main = main_module
+    setup_user(main, db, monkeypatch)
+    main.calculate_risk.__wrapped__(Request(EnvironBuilder(method='GET').get_environ()))
+    user_before = db.data(f'users/{USER_ID}')
+
+    write_and_trigger(db, main.on_task_written, f'users/{USER_ID}/tasks/t1',
+                      {'completed': False, 'dueDate': datetime.datetime.now() - datetime.timedelta(days=1)},
+                      userId=USER_ID, taskId='t1')
+
+    # El trigger solo toca el rollup; el usuario sigue limpio
+    assert db.data(f'users/{USER_ID}') == user_before
+    assert not main.needs_full_rescore(user_before, 'regression-v1')
+    # ...y el refresco recoge la tarea vencida desde el rollup
+    with main.ChunkedBatchWriter(db, label='test') as writer:
+        changed, _ = main.refresh_user_risk(db, writer, USER_ID, user_before)
+    assert changed
+    assert db.data(f'users/{USER_ID}')['riskMetrics']['overdueTasks'] == 1
+
+
+def test_profile_or_model_change_forces_base_rescore(main_module, db, monkeypatch):
+    main = main_module
+    setup_user(main, db, monkeypatch)
+    main.calculate_risk.__wrapped__(Request(EnvironBuilder(method='GET').get_environ()))
+    user_data = db.data(f'users/{USER_ID}')
+
+    assert main.needs_full_rescore(user_data, 'regression-v2')
+    assert main.needs_full_rescore(dict(user_data, onboardingData={'horas': 11}), 'regression-v1')
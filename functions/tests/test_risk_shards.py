@@ -0,0 +1,53 @@
+# functions/tests/test_risk_shards.py
+import random
+
+import pytest
+
+
+def seed_users(db, count, seed=7):
+    rng = random.Random(seed)
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    user_ids = [''.join(rng.choice(alphabet) for _ in range(28)) for _ in range(count)]
+    for user_id in user_ids:
+        db.collection('users').document(user_id).set({'onboardingComplete': True, 'onboardingData': {}})
+    db.collection('users').document('sin_onboarding').set({'onboardingComplete': False})
+    return sorted(user_ids)
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 3, 7, 16])
+def test_shard_ranges_partition_users_at_query_time(main_module, db, shard_count):
+    main = main_module
+    user_ids = seed_users(db, 300)
+
+    seen = []
+    for shard_index in range(shard_count):
+        reads_before = db.document_reads
+        id_range = main.shard_id_range(shard_index, shard_count)
+        shard_ids = [doc.id for page in main.iter_onboarded_user_pages(db, 50, None, id_range) for doc in page]
+        # Cada shard solo lee sus propios usuarios
+        assert db.document_reads - reads_before == len(shard_ids)
+        assert all(main.user_shard(user_id, shard_count) == shard_index for user_id in shard_ids)
+        seen.extend(shard_ids)
+
+    assert sorted(seen) == user_ids
+
+
+def test_shard_cursor_resumes_inside_its_range(main_module, db):
+    main = main_module
+    user_ids = seed_users(db, 200)
+    id_range = main.shard_id_range(1, 4)
+    shard_ids = [doc.id for page in main.iter_onboarded_user_pages(db, 10, None, id_range) for doc in page]
+
+    resumed = [doc.id for page in main.iter_onboarded_user_pages(db, 10, shard_ids[4], id_range) for doc in page]
+
+    assert resumed == shard_ids[5:]
+    assert set(shard_ids) < set(user_ids)
+
+
+def test_shard_ranges_are_contiguous(main_module):
+    main = main_module
+    ranges = [main.shard_id_range(index, 5) for index in range(5)]
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    assert main.shard_id_range(None, 5) == (None, None)
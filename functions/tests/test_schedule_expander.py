@@ -0,0 +1,70 @@
+# functions/tests/test_schedule_expander.py
+import datetime
+
+import pytest
+import pytz
+
+import schedule_expander
+from schedule_expander import ClassSlot, expand_series, expand_weekly, expand_with_rrule
+
+
+def keys(items):
+    return [schedule_expander._key(item) for item in items]
+
+
+@pytest.mark.parametrize('start_date, weeks', [
+    (datetime.date(2025, 1, 6), 20),
+    (datetime.date(2025, 1, 8), 3),     # empieza a mitad de semana
+    (datetime.date(2024, 12, 30), 0),   # until el mismo día
+])
+def test_matches_rrule_path(start_date, weeks):
+    slots = schedule_expander.synthetic_slots(30, seed=weeks)
+    until = datetime.datetime.combine(start_date + datetime.timedelta(weeks=weeks), datetime.time.min)
+
+    assert keys(expand_weekly(slots, start_date, until)) == keys(expand_with_rrule(slots, start_date, until))
+
+
+@pytest.mark.parametrize('tz_name', ['America/Mexico_City', 'Europe/Madrid', 'America/Santiago', 'UTC'])
+def test_matches_rrule_across_dst_transitions(tz_name):
+    slots = schedule_expander.transition_slots()
+    start_date = datetime.date(2015, 12, 28)
+    until = datetime.datetime(2023, 1, 1)
+
+    assert keys(expand_weekly(slots, start_date, until, tz_name)) == \
+        keys(expand_with_rrule(slots, start_date, until, tz_name))
+
+
+def test_empty_inputs_yield_nothing():
+    slot = ClassSlot(0, datetime.time(8), datetime.time(9), {})
+    assert list(expand_weekly([], datetime.date(2025, 1, 6), datetime.date(2025, 2, 1))) == []
+    assert list(expand_weekly([slot], datetime.date(2025, 1, 7), datetime.date(2025, 1, 12))) == []
+
+
+def test_series_expansion_honours_window_dtstart_until_and_exceptions():
+    series = {
+        'title': 'Cálculo',
+        'rrule': schedule_expander.weekly_rrule(0, datetime.date(2025, 2, 24)),
+        'dtstart': '2025-01-13',
+        'startTime': '08:00',
+        'endTime': '09:30',
+        'timezone': 'America/Mexico_City',
+        'exceptions': ['2025-02-03'],
+    }
+    tz = pytz.timezone('America/Mexico_City')
+    window_start = tz.localize(datetime.datetime(2025, 1, 1))
+    window_end = tz.localize(datetime.datetime(2025, 12, 31))
+
+    occurrences = dict(expand_series({'s1': series}, window_start, window_end))
+
+    expected_dates = ['20250113', '20250120', '20250127', '20250210', '20250217', '20250224']
+    assert list(occurrences) == [f's1_{day}' for day in expected_dates]
+    first = occurrences['s1_20250113']
+    assert first['start'] == tz.localize(datetime.datetime(2025, 1, 13, 8))
+    assert first['title'] == 'Cálculo' and 'rrule' not in first
+
+
+def test_invalid_series_is_skipped():
+    tz = pytz.utc
+    window = (tz.localize(datetime.datetime(2025, 1, 1)), tz.localize(datetime.datetime(2025, 2, 1)))
+    bad = {'rrule': 'FREQ=DAILY', 'dtstart': '2025-01-01', 'startTime': '08:00', 'endTime': '09:00'}
+    assert list(expand_series({'bad': bad}, *window)) == []
@@ -0,0 +1,75 @@
+# functions/tests/test_schedule_extraction.py
+import datetime
+import json
+
+import pytest
+
+import schedule_extraction
+from schedule_extraction import CachedScheduleExtractor, FakeScheduleExtractor, ScheduleExtractor
+
+SCHEDULE = [{'materia': 'Cálculo', 'diaSemana': 'lunes', 'horaInicio': '08:00', 'horaFin': '09:30'}]
+FILE = b'%PDF-horario'
+
+
+@pytest.fixture
+def cached(db):
+    return CachedScheduleExtractor(FakeScheduleExtractor(SCHEDULE), db)
+
+def cache_entries(db):
+    prefix = schedule_extraction.EXTRACTION_CACHE_COLLECTION + '/'
+    return {path: data for path, data in db.docs.items() if path.startswith(prefix)}
+
+
+def test_interface_cannot_be_instantiated():
+    with pytest.raises(TypeError):
+        ScheduleExtractor()
+
+
+def test_second_extraction_is_served_from_cache(cached, db):
+    assert cached.extract(FILE, 'application/pdf') == SCHEDULE
+    assert cached.extract(FILE, 'application/pdf') == SCHEDULE
+
+    assert cached.inner.calls == 1
+    (entry,) = cache_entries(db).values()
+    assert entry['version'] == 'fake' and entry['fileSize'] == len(FILE)
+
+
+def test_other_file_or_type_misses(cached):
+    cached.extract(FILE, 'application/pdf')
+    cached.extract(FILE, 'image/png')
+    cached.extract(FILE + b'v2', 'application/pdf')
+    assert cached.inner.calls == 3
+
+
+def test_expired_entry_calls_the_model_again(cached, db):
+    cached.extract(FILE, 'application/pdf')
+    (path,) = cache_entries(db)
+    db.docs[path]['expiresAt'] = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=1)
+
+    cached.extract(FILE, 'application/pdf')
+
+    assert cached.inner.calls == 2
+    assert db.data(path)['expiresAt'] > datetime.datetime.now(datetime.timezone.utc)
+
+
+def test_large_results_are_not_cached(cached, db, monkeypatch):
+    size = len(json.dumps(SCHEDULE, ensure_ascii=False).encode('utf-8'))
+    monkeypatch.setattr(schedule_extraction, 'EXTRACTION_CACHE_MAX_BYTES', size - 1)
+
+    assert cached.extract(FILE, 'application/pdf') == SCHEDULE
+    assert cache_entries(db) == {}
+
+    monkeypatch.setattr(schedule_extraction, 'EXTRACTION_CACHE_MAX_BYTES', size)
+    cached.extract(FILE, 'application/pdf')
+    assert len(cache_entries(db)) == 1
+
+
+def test_stats_are_logged_once_per_interval(cached, monkeypatch, capsys):
+    monkeypatch.setattr(schedule_extraction, '_stats_logged_at', None)
+    monkeypatch.setattr(schedule_extraction, 'EXTRACTION_STATS_LOG_SECONDS', 3600)
+
+    for _ in range(5):
+        cached.extract(FILE, 'application/pdf')
+
+    logged = [line for line in capsys.readouterr().out.splitlines() if 'schedule_extraction_cache' in line]
+    assert len(logged) == 1
@@ -0,0 +1,136 @@
+# functions/tests/test_schedule_import.py
+import datetime
+
+import pytest
+import pytz
+
+USER_ID = 'user_import'
+SCHEDULE = [
+    {'materia': 'Cálculo', 'diaSemana': 'Lunes', 'horaInicio': '08:00', 'horaFin': '09:30'},
+    {'materia': 'Física', 'diaSemana': 'miércoles', 'horaInicio': '10:00', 'horaFin': '11:00'},
+]
+
+
+@pytest.fixture
+def end_date():
+    return datetime.datetime.now() + datetime.timedelta(weeks=6)
+
+def imported_events(db):
+    prefix = f'users/{USER_ID}/events/'
+    return {path[len(prefix):]: data for path, data in db.docs.items()
+            if path.startswith(prefix) and '/' not in path[len(prefix):]}
+
+def start_of_week():
+    today = datetime.datetime.now(pytz.timezone('America/Mexico_City')).date()
+    return today - datetime.timedelta(days=today.weekday())
+
+
+def test_reimporting_the_same_schedule_writes_nothing(main_module, db, end_date):
+    main = main_module
+    status, body = main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'events')
+    assert status == 200
+    first = imported_events(db)
+    assert body['eventsCreated'] == len(first) > 0
+
+    commits_before = db.commits
+    status, body = main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'events')
+
+    assert status == 200
+    assert (body['eventsCreated'], body['eventsUnchanged'], body['eventsRemoved']) == (0, len(first), 0)
+    assert imported_events(db) == first
+    assert db.commits == commits_before
+
+
+def test_removed_class_is_deleted_and_new_class_created(main_module, db, end_date):
+    main = main_module
+    main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'events')
+    physics_ids = {event_id for event_id, event in imported_events(db).items() if event['title'] == 'Física'}
+
+    changed = [SCHEDULE[0], {'materia': 'Química', 'diaSemana': 'Viernes', 'horaInicio': '12:00', 'horaFin': '13:00'}]
+    status, body = main.write_imported_schedule(db, USER_ID, changed, end_date, 'events')
+
+    events = imported_events(db)
+    assert status == 200
+    assert body['eventsRemoved'] == len(physics_ids)
+    assert not physics_ids & set(events)
+    assert {event['title'] for event in events.values()} == {'Cálculo', 'Química'}
+
+
+def test_diff_leaves_user_and_past_events_alone(main_module, db, end_date):
+    main = main_module
+    week_start = datetime.datetime.combine(start_of_week(), datetime.time(8))
+    events_ref = db.collection(f'users/{USER_ID}/events')
+    events_ref.document('mio').set({'title': 'Dentista', 'start': week_start + datetime.timedelta(days=2)})
+    events_ref.document('pasado').set({'title': 'Cálculo', 'source': main.IMPORT_EVENT_SOURCE,
+                                       'start': week_start - datetime.timedelta(days=30)})
+    # Importación anterior a los ids deterministas: se reconoce por la nota
+    events_ref.document('legacy').set({'title': 'Cálculo', 'notes': main.IMPORT_EVENT_NOTES,
+                                       'start': week_start + datetime.timedelta(days=7)})
+
+    status, body = main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'events')
+
+    events = imported_events(db)
+    assert status == 200
+    assert body['eventsRemoved'] == 1
+    assert {'mio', 'pasado'} <= set(events) and 'legacy' not in events
+
+
+def test_existing_lookup_only_reads_from_since(main_module, db):
+    main = main_module
+    events_ref = db.collection(f'users/{USER_ID}/events')
+    since = datetime.datetime(2026, 1, 5, tzinfo=datetime.timezone.utc)
+    for day in range(-60, 10):
+        events_ref.document(f'sched_{day + 100}').set({
+            'source': main.IMPORT_EVENT_SOURCE, 'start': since + datetime.timedelta(days=day)})
+
+    reads_before = db.document_reads
+    event_ids = main.existing_imported_event_ids(db, USER_ID, since)
+
+    assert len(event_ids) == 10
+    assert db.document_reads - reads_before == 10
+
+
+def test_series_mode_keeps_the_instances_the_client_reads(main_module, db, end_date):
+    main = main_module
+    main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'events')
+    instances = set(imported_events(db))
+
+    status, body = main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'series')
+
+    events = imported_events(db)
+    series = {path for path in db.docs if path.startswith(f'users/{USER_ID}/classSeries/')}
+    assert status == 200
+    assert (body['eventsRemoved'], body['eventsUpdated'], body['seriesCreated']) == (0, len(instances), 2)
+    assert set(events) == instances
+    assert {f"users/{USER_ID}/classSeries/{event['seriesId']}" for event in events.values()} == series
+
+    commits_before = db.commits
+    status, body = main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'series')
+    assert (body['eventsUnchanged'], body['seriesUnchanged']) == (len(instances), 2)
+    assert db.commits == commits_before
+
+
+def test_series_instances_are_counted_once(main_module, db, end_date):
+    main = main_module
+    now = datetime.datetime.now()
+    main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'events')
+    by_events = main.scan_user_activity_metrics(db, USER_ID, now)
+
+    main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'series')
+
+    assert main.scan_user_activity_metrics(db, USER_ID, now) == by_events
+    rollup = main.build_activity_rollup(db, USER_ID, now)
+    assert rollup['upcoming'] == {} and len(rollup['series']) == 2
+    assert main.metrics_from_rollup(rollup, now)[0] == by_events
+
+
+def test_back_to_events_mode_unmarks_instances_and_drops_series(main_module, db, end_date):
+    main = main_module
+    main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'series')
+
+    status, body = main.write_imported_schedule(db, USER_ID, SCHEDULE, end_date, 'events')
+
+    assert status == 200
+    assert body['seriesRemoved'] == 2 and body['eventsRemoved'] == 0
+    assert not any('seriesId' in event for event in imported_events(db).values())
+    assert not any(path.startswith(f'users/{USER_ID}/classSeries/') for path in db.docs)
@@ -0,0 +1,98 @@
+# functions/tests/test_schedule_upload.py
+import base64
+import hashlib
+import io
+import json
+
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+import schedule_upload
+from schedule_upload import UploadError, UploadTooLarge, read_upload
+
+PDF = b'%PDF-1.7 horario ' * 100
+
+
+def make_request(**kwargs):
+    return Request(EnvironBuilder(method='POST', **kwargs).get_environ())
+
+def multipart_request(content, **fields):
+    return make_request(data={'file': (io.BytesIO(content), 'horario.pdf', 'application/pdf'), **fields})
+
+
+def test_multipart_uses_the_parsed_file_without_copying(monkeypatch):
+    spooled = []
+    monkeypatch.setattr(schedule_upload, 'spool_to_tempfile', lambda stream: spooled.append(stream))
+    req = multipart_request(PDF, endDate='2026-12-01', storeAs='series')
+
+    with read_upload(req) as upload:
+        assert upload.file is req.files['file'].stream
+        assert (upload.mime_type, upload.size, upload.sha256) == ('application/pdf', len(PDF), hashlib.sha256(PDF).hexdigest())
+        assert upload.params == {'endDate': '2026-12-01', 'storeAs': 'series'}
+        assert upload.open().read() == PDF
+    assert spooled == []
+
+
+def test_raw_body_takes_params_from_query():
+    req = make_request(data=PDF, content_type='application/pdf', query_string={'endDate': '2026-12-01', 'async': 'true'})
+
+    with read_upload(req) as upload:
+        assert upload.params == {'endDate': '2026-12-01', 'async': 'true'}
+        assert (upload.mime_type, upload.size) == ('application/pdf', len(PDF))
+        assert upload.open().read() == PDF
+
+
+def test_json_base64_body():
+    body = {'fileData': base64.b64encode(PDF).decode(), 'fileType': 'image/png', 'endDate': '2026-12-01'}
+    req = make_request(data=json.dumps(body), content_type='application/json')
+
+    with read_upload(req) as upload:
+        assert (upload.mime_type, upload.sha256) == ('image/png', hashlib.sha256(PDF).hexdigest())
+        assert upload.open().read() == PDF
+
+
+@pytest.mark.parametrize('kind', ['multipart', 'raw', 'json'])
+def test_oversized_body_is_rejected_before_parsing(monkeypatch, kind):
+    monkeypatch.setattr(schedule_upload, 'UPLOAD_MAX_BYTES', 1024)
+    content = b'x' * (1024 + schedule_upload.UPLOAD_BODY_OVERHEAD_BYTES * 2)
+    if kind == 'multipart':
+        req = multipart_request(content)
+    elif kind == 'raw':
+        req = make_request(data=content, content_type='application/pdf')
+    else:
+        req = make_request(data=json.dumps({'fileData': base64.b64encode(content).decode()}), content_type='application/json')
+
+    with pytest.raises(UploadTooLarge):
+        read_upload(req)
+    # Ni el formulario ni el cuerpo se llegaron a leer
+    assert not {'form', 'files', '_cached_data'} & set(vars(req))
+
+
+def test_file_over_limit_inside_the_multipart_margin_is_rejected(monkeypatch):
+    monkeypatch.setattr(schedule_upload, 'UPLOAD_MAX_BYTES', 1024)
+    with pytest.raises(UploadTooLarge):
+        read_upload(multipart_request(b'x' * 1025))
+
+
+def test_empty_file_is_rejected():
+    with pytest.raises(UploadError, match='Empty'):
+        read_upload(make_request(data=b'', content_type='application/pdf'))
+
+
+def test_pdf_is_sent_unchanged():
+    assert schedule_upload.prepare_for_model(io.BytesIO(PDF), 'application/pdf') == (PDF, 'application/pdf')
+
+
+def test_large_image_is_recompressed_from_the_file(monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    monkeypatch.setattr(schedule_upload, 'UPLOAD_IMAGE_MAX_SIDE', 256)
+    png = io.BytesIO()
+    Image.radial_gradient('L').resize((1024, 1024)).convert('RGB').save(png, format='PNG')
+    png.seek(0)
+
+    data, mime_type = schedule_upload.prepare_for_model(png, 'image/png')
+
+    assert mime_type == 'image/jpeg' and len(data) < len(png.getvalue())
+    with Image.open(io.BytesIO(data)) as image:
+        assert max(image.size) == 256